@@ -0,0 +1,87 @@
+import time
+
+import torch
+from torch.utils.data import DataLoader
+
+from utils.parser_utils import get_args
+
+args, device = get_args()
+
+from utils.dataset_tools import check_download_dataset
+from data import ConvertToThreeChannels, FewShotLearningDatasetParallel
+from torchvision import transforms
+from few_shot_learning_system import EmbeddingMAMLFewShotClassifier, VGGMAMLFewShotClassifier, \
+    MatchingNetworkFewShotClassifier
+
+# Times meta training iterations of every classifier type in the NCHW (contiguous_format) and NHWC (channels_last)
+# memory formats. Takes the same arguments as train_continual_learning_few_shot_system.py, e.g.
+# python benchmark_memory_format.py --name_of_args_json_file experiment_config/<experiment>.json
+
+classifier_types = {'maml++_high-end': EmbeddingMAMLFewShotClassifier,
+                    'maml++_low-end': VGGMAMLFewShotClassifier,
+                    'vgg-matching_network': MatchingNetworkFewShotClassifier}
+memory_formats = ['contiguous_format', 'channels_last']
+num_warmup_iters = 2
+num_timed_iters = 10
+
+check_download_dataset(dataset_name=args.dataset_name)
+
+if args.image_channels == 3:
+    transforms = [transforms.Resize(size=(args.image_height, args.image_width)), transforms.ToTensor(),
+                  ConvertToThreeChannels(),
+                  transforms.Normalize((0.485, 0.456, 0.406), (0.229, 0.224, 0.225))]
+elif args.image_channels == 1:
+    transforms = [transforms.Resize(size=(args.image_height, args.image_width)), transforms.ToTensor()]
+
+train_setup_dict = dict(dataset_name=args.dataset_name,
+                        indexes_of_folders_indicating_class=args.indexes_of_folders_indicating_class,
+                        train_val_test_split=args.train_val_test_split,
+                        labels_as_int=args.labels_as_int, transforms=transforms,
+                        num_classes_per_set=args.num_classes_per_set,
+                        num_samples_per_support_class=args.num_samples_per_support_class,
+                        num_samples_per_target_class=args.num_samples_per_target_class,
+                        seed=args.seed,
+                        sets_are_pre_split=args.sets_are_pre_split,
+                        load_into_memory=args.load_into_memory, set_name='train',
+                        num_tasks_per_epoch=(num_warmup_iters + num_timed_iters) * args.batch_size,
+                        num_channels=args.image_channels,
+                        num_support_sets=args.num_support_sets,
+                        overwrite_classes_in_each_task=args.overwrite_classes_in_each_task,
+                        class_change_interval=args.class_change_interval)
+
+# the batches are loaded up front, so only the model iterations are timed
+data_batches = list(DataLoader(FewShotLearningDatasetParallel(**train_setup_dict), batch_size=args.batch_size,
+                               num_workers=args.num_dataprovider_workers))
+
+
+def synchronize():
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+
+results = dict()
+
+for classifier_type, classifier_class in classifier_types.items():
+    for memory_format in memory_formats:
+        args.classifier_type = classifier_type
+        args.memory_format = memory_format
+        model = classifier_class(**args.__dict__)
+
+        for idx, data_batch in enumerate(data_batches):
+            if idx == num_warmup_iters:
+                synchronize()
+                start_time = time.time()
+
+            model.run_train_iter(data_batch=data_batch, epoch=0, current_iter=idx)
+
+        synchronize()
+        results[(classifier_type, memory_format)] = (time.time() - start_time) / num_timed_iters
+
+        del model
+
+print("{:<24}{:>20}{:>20}{:>10}".format('classifier_type', 'contiguous_format', 'channels_last', 'speedup'))
+for classifier_type in classifier_types:
+    nchw_time = results[(classifier_type, 'contiguous_format')]
+    nhwc_time = results[(classifier_type, 'channels_last')]
+    print("{:<24}{:>18.4f} s{:>18.4f} s{:>9.2f}x".format(classifier_type, nchw_time, nhwc_time,
+                                                          nchw_time / nhwc_time))
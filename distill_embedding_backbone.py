@@ -0,0 +1,114 @@
+import os
+
+import numpy as np
+import torch.nn as nn
+from torch.optim import AdamW
+from torch.utils.data import DataLoader
+
+from utils.parser_utils import get_args, extract_args_from_json, Bunch
+
+args, device = get_args()
+
+from utils.dataset_tools import check_download_dataset
+from utils.storage import build_experiment_folder, save_to_json
+from data import ConvertToThreeChannels, FewShotLearningDatasetParallel
+from torchvision import transforms
+from few_shot_learning_system import EmbeddingMAMLFewShotClassifier
+
+# Distills the dense net embedding of a trained maml++_high-end system (the teacher) into a thinner dense net (the
+# student), e.g.
+# python distill_embedding_backbone.py --name_of_args_json_file experiment_config/<student experiment>.json
+#   --distillation_teacher_name_of_args_json_file experiment_config/<teacher experiment>.json
+# The student backbone is configured by num_filters, num_stages, num_blocks_per_stage and embedding_stem_num_filters
+# of the student config, and is projected to the teacher's embedding width, so the teacher's classifier, inner loop
+# learning rates and critic are reused unchanged. The student is saved to its experiment folder as
+# saved_models/train_model_distilled, which loads into an EmbeddingMAMLFewShotClassifier built from the student config.
+
+teacher_args_dict = extract_args_from_json(args.distillation_teacher_name_of_args_json_file, dict(args.__dict__))
+for key in list(teacher_args_dict.keys()):
+    if str(teacher_args_dict[key]).lower() == "true":
+        teacher_args_dict[key] = True
+    elif str(teacher_args_dict[key]).lower() == "false":
+        teacher_args_dict[key] = False
+teacher_args = Bunch(teacher_args_dict)
+
+teacher = EmbeddingMAMLFewShotClassifier(**teacher_args.__dict__)
+teacher_saved_models_filepath, _, _ = build_experiment_folder(experiment_name=teacher_args.experiment_name)
+teacher.load_model(model_save_dir=teacher_saved_models_filepath, model_name="train_model",
+                   model_idx=args.distillation_teacher_model_idx)
+teacher.eval()
+
+teacher_classifier = teacher.classifier.module if isinstance(teacher.classifier, nn.DataParallel) \
+    else teacher.classifier
+args.embedding_output_num_filters = int(teacher_classifier.input_shape[1])
+student = EmbeddingMAMLFewShotClassifier(**args.__dict__)
+
+student.load_state_dict({name: value for name, value in teacher.state_dict().items()
+                         if not name.startswith('dense_net_embedding.')}, strict=False)
+# only the student backbone is optimized, every other parameter keeps the teacher's values
+distillation_optimizer = AdamW(student.dense_net_embedding.parameters(), lr=args.distillation_learning_rate,
+                               weight_decay=args.weight_decay)
+
+
+def count_parameters(module):
+    return sum([param.numel() for param in module.parameters()])
+
+
+print("teacher embedding parameters", count_parameters(teacher.dense_net_embedding),
+      "student embedding parameters", count_parameters(student.dense_net_embedding))
+
+check_download_dataset(dataset_name=args.dataset_name)
+
+if args.image_channels == 3:
+    transforms = [transforms.Resize(size=(args.image_height, args.image_width)), transforms.ToTensor(),
+                  ConvertToThreeChannels(),
+                  transforms.Normalize((0.485, 0.456, 0.406), (0.229, 0.224, 0.225))]
+elif args.image_channels == 1:
+    transforms = [transforms.Resize(size=(args.image_height, args.image_width)), transforms.ToTensor()]
+
+train_setup_dict = dict(dataset_name=args.dataset_name,
+                        indexes_of_folders_indicating_class=args.indexes_of_folders_indicating_class,
+                        train_val_test_split=args.train_val_test_split,
+                        labels_as_int=args.labels_as_int, transforms=transforms,
+                        num_classes_per_set=args.num_classes_per_set,
+                        num_samples_per_support_class=args.num_samples_per_support_class,
+                        num_samples_per_target_class=args.num_samples_per_target_class,
+                        seed=args.seed,
+                        sets_are_pre_split=args.sets_are_pre_split,
+                        load_into_memory=args.load_into_memory, set_name='train',
+                        num_tasks_per_epoch=args.distillation_num_iters * args.batch_size,
+                        num_channels=args.image_channels,
+                        num_support_sets=args.num_support_sets,
+                        overwrite_classes_in_each_task=args.overwrite_classes_in_each_task,
+                        class_change_interval=args.class_change_interval)
+
+train_data = DataLoader(FewShotLearningDatasetParallel(**train_setup_dict), batch_size=args.batch_size,
+                        num_workers=args.num_dataprovider_workers)
+
+saved_models_filepath, logs_filepath, _ = build_experiment_folder(experiment_name=args.experiment_name)
+distillation_losses = {'loss': [], 'embedding_loss': [], 'prediction_loss': []}
+
+for idx, data_batch in enumerate(train_data):
+    # the classifier runs in evaluation mode, as in the evaluation forward passes, while the student backbone
+    # normalizes with batch statistics and re-estimates its running statistics
+    student.eval()
+    student.dense_net_embedding.train()
+
+    losses = student.get_distillation_losses(teacher=teacher, data_batch=data_batch)
+
+    student.zero_grad()
+    losses['loss'].backward()
+    distillation_optimizer.step()
+
+    for key, value in losses.items():
+        distillation_losses[key].append(float(value))
+
+    if idx % args.total_iter_per_epoch == 0:
+        summary = ["{}: {:.4f}".format(key, np.mean(value[-args.total_iter_per_epoch:]))
+                   for key, value in distillation_losses.items()]
+        print("iter {}: {}".format(idx, ", ".join(summary)))
+
+student.save_model(model_save_dir=os.path.join(saved_models_filepath, "train_model_distilled"),
+                   state={'current_iter': 0, 'distillation_teacher': teacher_args.experiment_name})
+save_to_json(filename=os.path.join(logs_filepath, "distillation_statistics.json"), dict_to_store=distillation_losses)
+print("saved the distilled model to", os.path.join(saved_models_filepath, "train_model_distilled"))
@@ -2,8 +2,13 @@ import os
 import time
 
 import numpy as np
+import torch
 import tqdm
 
+from quantized_inference import evaluate_quantized_inference
+from utils.distributed import is_distributed, is_main_process, shard_data_loader, broadcast_module, \
+    broadcast_object, gather_metrics
+from utils.parameter_server import is_parameter_server_worker
 from utils.storage import build_experiment_folder, save_statistics, save_to_json
 
 class ExperimentBuilder(object):
@@ -68,6 +73,19 @@ class ExperimentBuilder(object):
                 self.create_summary_csv = True
 
         self.data = data_dict
+
+        if is_distributed():
+            # every rank trains and validates on its own shard of the tasks, starting from the weights and the
+            # experiment state of rank 0, while the test set is evaluated by rank 0 alone
+            self.data['train'] = shard_data_loader(self.data['train'])
+            self.data['val'] = shard_data_loader(self.data['val'])
+            broadcast_module(self.model)
+            self.state = broadcast_object(self.state)
+            self.start_epoch = int(self.state['current_iter'] / total_iter_per_epoch)
+
+        if is_parameter_server_worker():
+            self.model.pull_parameter_server_parameters()
+
         self.total_iter_per_epoch = total_iter_per_epoch
         self.batch_size = batch_size
         self.total_epochs = total_epochs
@@ -82,6 +100,39 @@ class ExperimentBuilder(object):
         self.epochs_done_in_this_run = 0
         print(self.state['current_iter'], int(total_iter_per_epoch * total_epochs))
 
+    def sync_metrics(self, total_losses):
+        """
+        Replaces the device tensors stored in a total losses dictionary by python floats. All pending values are copied
+        to the host in one batched transfer, instead of one blocking transfer per metric.
+        :param total_losses: A dictionary of lists of metric values, updated in place.
+        :return: The updated total_losses dictionary.
+        """
+        pending = [(key, idx) for key, values in total_losses.items() for idx, value in enumerate(values)
+                   if torch.is_tensor(value)]
+
+        if len(pending) > 0:
+            host_values = torch.stack([total_losses[key][idx].float().reshape(()) for key, idx in pending]).cpu()
+            for (key, idx), value in zip(pending, host_values.tolist()):
+                total_losses[key][idx] = value
+
+        return total_losses
+
+    def add_metrics(self, losses, total_losses):
+        """
+        Appends the metrics of an iteration to the total losses dictionary, without synchronizing with the device.
+        :param losses: The metric dictionary of the current iteration.
+        :param total_losses: The current total losses dictionary to be updated.
+        :return: The updated total_losses dictionary.
+        """
+        for key, value in zip(list(losses.keys()), list(losses.values())):
+            value = value.detach() if torch.is_tensor(value) else float(value)
+            if key not in total_losses:
+                total_losses[key] = [value]
+            else:
+                total_losses[key].append(value)
+
+        return total_losses
+
     def build_summary_dict(self, total_losses, phase, summary_losses=None):
         """
         Builds/Updates a summary dict directly from the metric dict of the current iteration.
@@ -129,30 +180,32 @@ class ExperimentBuilder(object):
         :param total_losses: The current total losses dictionary to be updated.
         :param current_iter: The current training iteration in relation to the whole experiment.
         :param pbar_train: The progress bar of the training.
-        :return: Updates total_losses, train_losses, current_iter
+        :return: Updates total_losses, train_losses, current_iter. train_losses is None on iterations where the
+        metrics are not synchronized with the device.
         """
 
         losses, _ = self.model.run_train_iter(data_batch=train_sample, epoch=epoch_idx, current_iter=current_iter)
 
-        for key, value in zip(list(losses.keys()), list(losses.values())):
-            if 'saved_logits' not in key:
-                if key not in total_losses:
-                    total_losses[key] = [float(value)]
-                else:
-                    total_losses[key].append(float(value))
-            else:
-                np.save(
-                    os.path.join(self.samples_filepath, 'saved_{}_{}_logits'.format('train', current_iter)),
-                    value.detach().cpu().numpy())
+        if 'saved_logits' in losses:
+            np.save(
+                os.path.join(self.samples_filepath, 'saved_{}_{}_logits'.format('train', current_iter)),
+                losses['saved_logits'].detach().cpu().numpy())
+            del losses['saved_logits']
 
-        train_losses = self.build_summary_dict(total_losses=total_losses, phase="train")
-        train_output_update = self.build_loss_summary_string(losses)
+        total_losses = self.add_metrics(losses=losses, total_losses=total_losses)
 
         pbar_train.update(1)
-        pbar_train.set_description("training phase {} -> {}".format(self.epoch, train_output_update))
-
         current_iter += 1
 
+        # the metrics are only copied to the host every metrics_sync_interval iterations and at the end of each epoch
+        train_losses = None
+        if current_iter % self.metrics_sync_interval == 0 or current_iter % self.total_iter_per_epoch == 0:
+            total_losses = self.sync_metrics(total_losses=total_losses)
+            train_losses = self.build_summary_dict(total_losses=total_losses, phase="train")
+            train_output_update = self.build_loss_summary_string(
+                {key: value[-1] for key, value in total_losses.items()})
+            pbar_train.set_description("training phase {} -> {}".format(self.epoch, train_output_update))
+
         return train_losses, total_losses, current_iter
 
     def evaluation_iteration(self, val_sample, total_losses, pbar_val, phase):
@@ -161,22 +214,22 @@ class ExperimentBuilder(object):
         :param val_sample: A sample from the data provider
         :param total_losses: The current total losses dictionary to be updated.
         :param pbar_val: The progress bar of the val stage.
-        :return: The updated val_losses, total_losses
+        :return: The updated val_losses, total_losses. val_losses is None on iterations where the metrics are not
+        synchronized with the device.
         """
 
         losses, _ = self.model.run_validation_iter(data_batch=val_sample)
-        for key, value in zip(list(losses.keys()), list(losses.values())):
-            if key not in total_losses:
-                total_losses[key] = [float(value)]
-            else:
-                total_losses[key].append(float(value))
-
-        val_losses = self.build_summary_dict(total_losses=total_losses, phase=phase)
-        val_output_update = self.build_loss_summary_string(losses)
+        total_losses = self.add_metrics(losses=losses, total_losses=total_losses)
 
         pbar_val.update(1)
-        pbar_val.set_description(
-            "val_phase {} -> {}".format(self.epoch, val_output_update))
+
+        val_losses = None
+        if pbar_val.n % self.metrics_sync_interval == 0:
+            total_losses = self.sync_metrics(total_losses=total_losses)
+            val_losses = self.build_summary_dict(total_losses=total_losses, phase=phase)
+            val_output_update = self.build_loss_summary_string({key: value[-1] for key, value in total_losses.items()})
+            pbar_val.set_description(
+                "val_phase {} -> {}".format(self.epoch, val_output_update))
 
         return val_losses, total_losses
 
@@ -192,11 +245,13 @@ class ExperimentBuilder(object):
 
         per_model_per_batch_preds[model_idx].extend(list(per_task_preds))
 
-        val_output_update = self.build_loss_summary_string(losses)
-
         pbar_test.update(1)
-        pbar_test.set_description(
-            "val_phase {} -> {}".format(self.epoch, val_output_update))
+
+        if pbar_test.n % self.metrics_sync_interval == 0:
+            latest_losses = self.sync_metrics(total_losses={key: [value] for key, value in losses.items()})
+            val_output_update = self.build_loss_summary_string({key: value[-1] for key, value in latest_losses.items()})
+            pbar_test.set_description(
+                "val_phase {} -> {}".format(self.epoch, val_output_update))
 
         return per_model_per_batch_preds
 
@@ -251,12 +306,16 @@ class ExperimentBuilder(object):
         epoch_summary_losses["epoch"] = self.epoch
         epoch_summary_losses['epoch_run_time'] = time.time() - start_time
 
+        start_time = time.time()
+
+        if not is_main_process():
+            return start_time, state
+
         if create_summary_csv:
             self.summary_statistics_filepath = save_statistics(self.logs_filepath, list(epoch_summary_losses.keys()),
                                                                create=True)
             self.create_summary_csv = False
 
-        start_time = time.time()
         print("epoch {} -> {}".format(epoch_summary_losses["epoch"], epoch_summary_string))
 
         self.summary_statistics_filepath = save_statistics(self.logs_filepath,
@@ -325,6 +384,55 @@ class ExperimentBuilder(object):
         print(test_losses)
         print("saved test performance at", summary_statistics_filepath)
 
+    def check_mixed_precision_accuracy(self):
+        """
+        Compares the accuracy of the model with bf16 autocast against its float32 accuracy on a fixed bank of
+        validation episodes. If the accuracy drops by more than mixed_precision_accuracy_tolerance the model falls back
+        to float32. In a distributed experiment every rank checks its own validation shard and the decision of rank 0 is
+        used by all ranks, so that they keep training in the same precision.
+        """
+        episode_bank = []
+        for val_sample in self.data['val']:
+            episode_bank.append(self.convert_into_continual_tasks(val_sample))
+            if len(episode_bank) >= self.mixed_precision_guard_num_batches:
+                break
+
+        accuracies = dict()
+        for use_bf16_autocast in [False, True]:
+            self.model.use_bf16_autocast = use_bf16_autocast
+            accuracies[use_bf16_autocast] = np.mean(
+                [float(self.model.run_validation_iter(data_batch=val_sample)[0]['accuracy'])
+                 for val_sample in episode_bank])
+
+        accuracy_drop = accuracies[False] - accuracies[True]
+        print("mixed precision guard: fp32 accuracy {:.4f}, bf16 accuracy {:.4f}".format(accuracies[False],
+                                                                                       accuracies[True]))
+        if accuracy_drop > self.mixed_precision_accuracy_tolerance:
+            print("bf16 accuracy drop of {:.4f} exceeds the tolerance, falling back to fp32".format(accuracy_drop))
+            self.model.use_bf16_autocast = False
+
+        if is_distributed():
+            self.model.use_bf16_autocast = broadcast_object(self.model.use_bf16_autocast)
+
+    def check_quantized_inference_accuracy(self):
+        """
+        Exports every task of a fixed bank of test episodes as an int8 quantized cpu inference module and reports its
+        target set accuracy and query scoring time against the float32 export of the same adapted classifier.
+        """
+        episode_bank = []
+        for test_sample in self.data['test']:
+            episode_bank.append(self.convert_into_continual_tasks(test_sample))
+            if len(episode_bank) >= self.quantized_inference_num_batches:
+                break
+
+        results = evaluate_quantized_inference(model=self.model, episode_bank=episode_bank,
+                                               backend=self.quantized_inference_backend)
+        print("quantized inference: fp32 accuracy {:.4f}, int8 accuracy {:.4f}, delta {:.4f}, "
+              "query scoring speedup {:.2f}x".format(results['fp32_accuracy'], results['int8_accuracy'],
+                                                     results['accuracy_delta'], results['scoring_speedup']))
+        save_to_json(filename=os.path.join(self.logs_filepath, "quantized_inference_statistics.json"),
+                     dict_to_store=results)
+
     def run_experiment(self):
         """
         Runs a full training experiment with evaluations of the model on the val set at every epoch. Furthermore,
@@ -364,6 +472,11 @@ class ExperimentBuilder(object):
                                                                                      total_losses=total_losses,
                                                                                      pbar_val=pbar_val, phase='val')
 
+                            total_losses = self.sync_metrics(total_losses=total_losses)
+                            if is_distributed():
+                                total_losses = gather_metrics(total_losses=total_losses)
+                            val_losses = self.build_summary_dict(total_losses=total_losses, phase='val')
+
                             if val_losses["val_accuracy_mean"] > self.state['best_val_acc']:
                                 print("Best validation accuracy", val_losses["val_accuracy_mean"])
                                 self.state['best_val_acc'] = val_losses["val_accuracy_mean"]
@@ -371,6 +484,10 @@ class ExperimentBuilder(object):
                                 self.state['best_epoch'] = int(
                                     self.state['best_val_iter'] / self.total_iter_per_epoch)
 
+                        if self.model.use_bf16_autocast:
+                            # checked on the model trained so far, until it falls back to fp32
+                            self.check_mixed_precision_accuracy()
+
                         self.epoch += 1
                         self.state = self.merge_two_dicts(first_dict=self.merge_two_dicts(first_dict=self.state,
                                                                                           second_dict=train_losses),
@@ -383,13 +500,21 @@ class ExperimentBuilder(object):
                                                                                  train_losses=train_losses,
                                                                                  val_losses=val_losses,
                                                                                  state=self.state)
-                        self.save_models(model=self.model, epoch=self.epoch, state=self.state)
+                        if is_main_process():
+                            self.save_models(model=self.model, epoch=self.epoch, state=self.state)
 
                         self.total_losses = dict()
 
                         self.epochs_done_in_this_run += 1
                         # print(self.state['per_epoch_statistics']['val_accuracy_mean'])
-                        save_to_json(filename=os.path.join(self.logs_filepath, "summary_statistics.json"),
-                                     dict_to_store=self.state['per_epoch_statistics'])
+                        if is_main_process():
+                            save_to_json(filename=os.path.join(self.logs_filepath, "summary_statistics.json"),
+                                         dict_to_store=self.state['per_epoch_statistics'])
+
+            if not is_main_process():
+                return
 
             self.evaluate_test_set_using_the_best_models(top_n_models=5)
+
+            if self.quantized_inference_num_batches > 0 and hasattr(self.model, 'export_quantized_classifier'):
+                self.check_quantized_inference_accuracy()
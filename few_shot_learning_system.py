@@ -1,5 +1,10 @@
+import contextlib
+import copy
+import functools
+import math
 import os
-from collections import OrderedDict, defaultdict
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import torch
@@ -7,11 +12,15 @@ import torch.nn as nn
 import torch.nn.functional as F
 from torch import optim
 from torch.optim import AdamW
+from torch.utils.checkpoint import checkpoint
 
 from meta_neural_network_architectures import VGGActivationNormNetwork, \
-    VGGActivationNormNetworkWithAttention
+    VGGActivationNormNetworkWithAttention, RidgeRegressionHead, set_weight_memory_format
 from meta_optimizer import LSLRGradientDescentLearningRule
-from pytorch_utils import int_to_one_hot
+from pytorch_utils import int_to_one_hot, conjugate_gradient
+from quantized_inference import build_quantizable_classifier, quantize_classifier
+from utils.distributed import is_distributed, all_reduce_gradients
+from utils.parameter_server import is_parameter_server_worker, pull_parameters, push_gradients
 from standard_neural_network_architectures import TaskRelationalEmbedding, \
     SqueezeExciteDenseNetEmbeddingSmallNetwork, CriticNetwork, VGGEmbeddingNetwork
 
@@ -44,6 +53,7 @@ class MAMLFewShotClassifier(nn.Module):
         super(MAMLFewShotClassifier, self).__init__()
         self.batch_size = batch_size
         self.current_epoch = -1
+        self.parameter_server_version = 0
         self.rng = set_torch_seed(seed=seed)
         self.num_classes_per_set = num_classes_per_set
         self.num_samples_per_support_class = num_samples_per_support_class
@@ -74,6 +84,7 @@ class MAMLFewShotClassifier(nn.Module):
           self.device = torch.cuda.current_device()
 
         self.clip_grads = True
+        self.classifier_requires_double_backward = False
         self.rng = set_torch_seed(seed=seed)
         self.build_module()
 
@@ -145,7 +156,8 @@ class MAMLFewShotClassifier(nn.Module):
         loss_weights = torch.Tensor(loss_weights).to(device=self.device)
         return loss_weights
 
-    def apply_inner_loop_update(self, loss, names_weights_copy, use_second_order, current_step_idx):
+    def apply_inner_loop_update(self, loss, names_weights_copy, use_second_order, current_step_idx,
+                                detach_inner_loop_history=False, anchor_names_weights_copy=None, retain_graph=False):
         """
         Applies an inner loop update given current step's loss, the weights to update, a flag indicating whether to use
         second order derivatives and the current step's index.
@@ -153,11 +165,20 @@ class MAMLFewShotClassifier(nn.Module):
         :param names_weights_copy: A dictionary with names to parameters to update.
         :param use_second_order: A boolean flag of whether to use second order derivatives.
         :param current_step_idx: Current step's index.
+        :param detach_inner_loop_history: A boolean flag of whether to detach the updated weights from the graph of the
+        previous steps, such that the graph of this step is freed as soon as the update is applied.
+        :param anchor_names_weights_copy: If given, the update is applied as a first order step whose result is
+        reattached to these weights (see reattach_fast_weights), which truncates the meta-backpropagation at this step.
+        :param retain_graph: A boolean flag of whether to keep the graph of the loss after a first order update, for
+        losses that share their forward pass with the outer loop loss.
         :return: A dictionary with the updated weights (name, param)
         """
+        first_order_update = detach_inner_loop_history or anchor_names_weights_copy is not None
+        create_graph = use_second_order and not first_order_update
         self.classifier.zero_grad(params=names_weights_copy)
         grads = torch.autograd.grad(loss, names_weights_copy.values(),
-                                    create_graph=use_second_order, allow_unused=True)
+                                    create_graph=create_graph, retain_graph=create_graph or retain_graph,
+                                    allow_unused=True)
         names_grads_copy = dict(zip(names_weights_copy.keys(), grads))
 
         for key, grad in names_grads_copy.items():
@@ -168,8 +189,682 @@ class MAMLFewShotClassifier(nn.Module):
                                                                      names_grads_wrt_params_dict=names_grads_copy,
                                                                      num_step=current_step_idx)
 
+        if anchor_names_weights_copy is not None:
+            names_weights_copy = self.reattach_fast_weights(names_weights_copy=names_weights_copy,
+                                                            anchor_names_weights_copy=anchor_names_weights_copy)
+        elif detach_inner_loop_history:
+            names_weights_copy = {name: value.detach().requires_grad_() for name, value in
+                                  names_weights_copy.items()}
+
+        return names_weights_copy
+
+    def reattach_fast_weights(self, names_weights_copy, anchor_names_weights_copy):
+        """
+        Reattaches fast weights computed without keeping their history to a set of anchor weights that are still in the
+        graph, as w_anchor + (w - w_anchor).detach(). The values are unchanged, while the gradient w.r.t. w is passed
+        on unchanged to w_anchor, i.e. the steps in between are treated as first order.
+        :param names_weights_copy: A dictionary with the fast weights to reattach.
+        :param anchor_names_weights_copy: A dictionary with the anchor weights.
+        :return: A dictionary with the reattached fast weights.
+        """
+        return {name: anchor_names_weights_copy[name] + (value - anchor_names_weights_copy[name]).detach()
+                for name, value in names_weights_copy.items()}
+
+    def outside_meta_backprop_horizon(self, step, num_steps, meta_backprop_horizon):
+        """
+        Returns whether an inner loop step lies outside of the last meta_backprop_horizon steps of a sequence of
+        num_steps steps, in which case the meta-backpropagation is truncated at that step. A negative horizon disables
+        the truncation.
+        :param step: The index of the step within the sequence.
+        :param num_steps: The number of steps in the sequence.
+        :param meta_backprop_horizon: The number of final steps to backpropagate through.
+        """
+        return 0 <= meta_backprop_horizon < num_steps - step
+
+    def uses_first_order_meta_gradient(self):
+        """
+        Returns whether the selected meta_gradient_type treats the inner loop as a black box (first order MAML, reptile
+        and implicit MAML), in which case the inner loop history does not need to be kept in the graph.
+        """
+        assert self.meta_gradient_type in ['maml', 'first_order_maml', 'reptile', 'imaml'], \
+            'meta_gradient_type should be one of maml, first_order_maml, reptile or imaml'
+        return self.meta_gradient_type != 'maml'
+
+    def get_outer_loop_weights(self, names_weights_copy, initial_names_weights_copy):
+        """
+        Returns the fast weights to use for a target set forward pass that contributes to the outer loop loss. Under
+        first order MAML the detached fast weights are reattached to the initial weights as w_0 + (w_n - w_0), which
+        passes the gradient of the target loss w.r.t. w_n on to the meta-parameters unchanged. Under reptile the fast
+        weights stay detached, their meta-gradient is given by get_reptile_loss instead. Under implicit MAML the weights
+        are returned as they are, such that the gradient of the target loss w.r.t. them can be taken by
+        get_implicit_meta_gradient_loss.
+        :param names_weights_copy: A dictionary with the current fast weights.
+        :param initial_names_weights_copy: A dictionary with the fast weights at the start of the inner loop.
+        :return: A dictionary with the weights to use for the target set forward pass.
+        """
+        if self.meta_gradient_type == 'first_order_maml':
+            return self.reattach_fast_weights(names_weights_copy=names_weights_copy,
+                                              anchor_names_weights_copy=initial_names_weights_copy)
+        elif self.meta_gradient_type == 'reptile':
+            return {name: value.detach() for name, value in names_weights_copy.items()}
+
         return names_weights_copy
 
+    def get_surrogate_meta_gradient_loss(self, initial_names_weights_copy, names_meta_gradients):
+        """
+        Builds a surrogate loss whose gradient w.r.t. the inner loop meta-parameters is a given meta-gradient, such
+        that meta-gradients computed outside of autograd can go through the usual meta_update. The value of the
+        surrogate is zeroed out, such that the reported losses are unaffected.
+        :param initial_names_weights_copy: A dictionary with the fast weights at the start of the inner loop.
+        :param names_meta_gradients: A dictionary with the meta-gradient of each of the fast weights.
+        :return: The surrogate loss.
+        """
+        surrogate_loss = 0.
+        for name, initial_value in initial_names_weights_copy.items():
+            if names_meta_gradients[name] is not None:
+                # the initial weights are repeated once per device, hence the division
+                surrogate_loss = surrogate_loss + torch.sum(
+                    initial_value * names_meta_gradients[name].detach()) / initial_value.shape[0]
+
+        return surrogate_loss - surrogate_loss.detach()
+
+    def get_reptile_loss(self, names_weights_copy, initial_names_weights_copy):
+        """
+        Builds a surrogate loss whose gradient w.r.t. the inner loop meta-parameters is the reptile direction
+        (w_0 - w_n).
+        :param names_weights_copy: A dictionary with the fast weights at the end of the inner loop.
+        :param initial_names_weights_copy: A dictionary with the fast weights at the start of the inner loop.
+        :return: The surrogate loss.
+        """
+        return self.get_surrogate_meta_gradient_loss(
+            initial_names_weights_copy=initial_names_weights_copy,
+            names_meta_gradients={name: initial_value - names_weights_copy[name] for name, initial_value in
+                                  initial_names_weights_copy.items()})
+
+    def get_proximal_loss(self, names_weights_copy, initial_names_weights_copy):
+        """
+        Returns the proximal regularization term (lambda / 2) * ||w - w_0||^2 of the implicit MAML inner loop, which
+        keeps the adapted fast weights close to the meta-parameters.
+        :param names_weights_copy: A dictionary with the current fast weights.
+        :param initial_names_weights_copy: A dictionary with the fast weights at the start of the inner loop.
+        :return: The proximal loss.
+        """
+        proximal_loss = 0.
+        for name, value in names_weights_copy.items():
+            proximal_loss = proximal_loss + torch.sum((value - initial_names_weights_copy[name].detach()) ** 2)
+
+        return 0.5 * self.imaml_proximal_lambda * proximal_loss
+
+    def get_implicit_meta_gradient_loss(self, target_loss, x_support_set, y_support_set, num_step,
+                                        names_weights_copy, initial_names_weights_copy):
+        """
+        Computes the implicit MAML meta-gradient of the target loss through the fixed point of the proximally
+        regularized inner loop, g = (I + H / lambda)^-1 dL_target/dw, where H is the hessian of the support set loss
+        at the adapted fast weights. The system is solved with conjugate gradient, using hessian vector products, so
+        the memory needed does not depend on the number of inner loop steps. The meta-gradient is returned as a
+        surrogate loss to be added to the outer loop loss.
+        :param target_loss: The outer loop loss of the task, computed using names_weights_copy.
+        :param x_support_set: The support set inputs of all of the task's sub-tasks, of shape b, c, h, w.
+        :param y_support_set: The support set targets of all of the task's sub-tasks.
+        :param num_step: The inner loop step of the last support set pass, whose batch norm parameters to use for the
+        support set pass.
+        :param names_weights_copy: A dictionary with the adapted (detached) fast weights.
+        :param initial_names_weights_copy: A dictionary with the fast weights at the start of the inner loop.
+        :return: The surrogate loss carrying the implicit meta-gradient.
+        """
+        names = list(names_weights_copy.keys())
+        fast_weights = [names_weights_copy[name] for name in names]
+
+        target_grads = torch.autograd.grad(target_loss, fast_weights, retain_graph=True, allow_unused=True)
+        target_grads = [torch.zeros_like(weight) if grad is None else grad for weight, grad in
+                        zip(fast_weights, target_grads)]
+
+        # the extra support set pass must not update the batch norm running statistics a second time
+        running_statistics = [stat.data.clone() for stat in self.classifier.get_batch_norm_stats()]
+        support_outputs = self.net_forward(x=x_support_set, y=y_support_set, weights=names_weights_copy,
+                                           backup_running_statistics=False, training=True, num_step=num_step,
+                                           return_features=True)
+        support_grads = torch.autograd.grad(support_outputs['loss'], fast_weights, create_graph=True,
+                                            allow_unused=True)
+        used_idx = [idx for idx, grad in enumerate(support_grads) if grad is not None]
+
+        def matrix_vector_product(vectors):
+            hessian_vector_products = torch.autograd.grad([support_grads[idx] for idx in used_idx],
+                                                          [fast_weights[idx] for idx in used_idx],
+                                                          grad_outputs=[vectors[idx] for idx in used_idx],
+                                                          retain_graph=True, allow_unused=True)
+            products = list(vectors)
+            for idx, hessian_vector_product in zip(used_idx, hessian_vector_products):
+                if hessian_vector_product is not None:
+                    products[idx] = vectors[idx] + hessian_vector_product / self.imaml_proximal_lambda
+            return products
+
+        implicit_grads = conjugate_gradient(matrix_vector_product=matrix_vector_product, b=target_grads,
+                                            num_steps=self.imaml_cg_steps)
+
+        # the statistics are saved by the graphs of the task's forward passes, which the hessian vector products and
+        # the meta-update still backpropagate through, so they are restored through .data without bumping their
+        # version, as in checkpoint_support_set_steps
+        for stat, value in zip(self.classifier.get_batch_norm_stats(), running_statistics):
+            stat.data.copy_(value)
+
+        return self.get_surrogate_meta_gradient_loss(initial_names_weights_copy=initial_names_weights_copy,
+                                                     names_meta_gradients=dict(zip(names, implicit_grads)))
+
+    def use_inner_loop_checkpointing(self, use_second_order, training_phase, detach_inner_loop_history):
+        """
+        Returns whether the support set inner loop should be run in checkpointed segments. Checkpointing only pays off
+        when the whole unrolled second order graph is kept for the outer loop, and it is not combined with the multi
+        step loss, which interleaves target set passes with the support set steps.
+        """
+        return self.inner_loop_checkpoint_interval > 0 and use_second_order and training_phase and \
+               not detach_inner_loop_history and not self.use_multi_step_loss_optimization and \
+               self.meta_backprop_horizon < 0
+
+    def checkpoint_support_set_steps(self, x_support_set_sub_tasks, y_support_set_sub_tasks, names_weights_copy,
+                                     use_second_order, step_idx):
+        """
+        Runs the support set inner loop steps of a segment of consecutive sub-tasks under activation checkpointing.
+        The activations of the segment are discarded after the forward pass and recomputed during the backward pass,
+        such that only the fast weights at the segment boundaries are kept alive until the meta-update. The batch norm
+        running statistics are restored after a recomputation, so they are only updated once per step.
+        :param x_support_set_sub_tasks: The support set inputs of the segment's sub-tasks, one sub-task per entry.
+        :param y_support_set_sub_tasks: The support set targets of the segment's sub-tasks, one sub-task per entry.
+        :param names_weights_copy: A dictionary with the fast weights at the start of the segment.
+        :param use_second_order: A boolean flag of whether to use second order derivatives.
+        :param step_idx: The index of the first inner loop step of the segment.
+        :return: A dictionary with the fast weights at the end of the segment.
+        """
+        names = list(names_weights_copy.keys())
+        num_calls = [0]
+
+        def run_segment(*weights):
+            recomputing = num_calls[0] > 0
+            num_calls[0] += 1
+            if recomputing:
+                running_statistics = [param.data.clone() for name, param in self.classifier.named_parameters()
+                                      if 'running_' in name]
+            try:
+                segment_names_weights_copy = dict(zip(names, weights))
+                current_step_idx = step_idx
+                for x_support_set_sub_task, y_support_set_sub_task in zip(x_support_set_sub_tasks,
+                                                                          y_support_set_sub_tasks):
+                    for num_step in range(self.num_support_set_steps):
+                        support_outputs = self.net_forward(x=x_support_set_sub_task,
+                                                           y=y_support_set_sub_task,
+                                                           weights=segment_names_weights_copy,
+                                                           backup_running_statistics=
+                                                           True if (num_step == 0) else False,
+                                                           training=True,
+                                                           num_step=current_step_idx,
+                                                           return_features=True)
+
+                        segment_names_weights_copy = self.apply_inner_loop_update(
+                            loss=support_outputs['loss'], names_weights_copy=segment_names_weights_copy,
+                            use_second_order=use_second_order, current_step_idx=current_step_idx)
+                        current_step_idx += 1
+
+                return tuple(segment_names_weights_copy[name] for name in names)
+            finally:
+                if recomputing:
+                    for param, value in zip([param for name, param in self.classifier.named_parameters()
+                                             if 'running_' in name], running_statistics):
+                        param.data.copy_(value)
+
+        weights = checkpoint(run_segment, *[names_weights_copy[name] for name in names], use_reentrant=False)
+
+        return dict(zip(names, weights))
+
+    def autocast(self):
+        """
+        Returns the autocast context used for the network forward passes. With use_bf16_autocast set, the classifier,
+        the embedding backbone and the critic run in bfloat16, while the fast weights, the inner loop learning rates
+        and the loss reductions stay in float32.
+        """
+        return torch.autocast(device_type='cuda' if torch.cuda.is_available() else 'cpu', dtype=torch.bfloat16,
+                              enabled=self.use_bf16_autocast)
+
+    def requires_double_backward(self, use_second_order, training_phase):
+        """
+        Returns whether the outer loop differentiates through the inner loop gradients, either through second order
+        MAML or through the Hessian vector products of the implicit meta gradient.
+        :param use_second_order: Whether second order derivatives are in use.
+        :param training_phase: Whether this is a training phase (True) or an evaluation phase (False)
+        """
+        if not training_phase:
+            return False
+
+        return self.meta_gradient_type == 'imaml' or (use_second_order and not self.uses_first_order_meta_gradient())
+
+    def to_memory_format(self):
+        """
+        Converts the convolutional parameters to the memory format set by memory_format, and makes the meta conv layers
+        pass their fast weights to F.conv2d in that format as well.
+        """
+        memory_format = getattr(torch, self.memory_format)
+        self.to(memory_format=memory_format)
+        set_weight_memory_format(module=self, memory_format=memory_format)
+
+    def images_to_device(self, x):
+        """
+        Moves a batch of episode images to the device, converting it to the memory format set by memory_format. This
+        is the only place the images are converted, every later layer keeps the format of its input.
+        :param x: An image batch of shape b, c, h, w
+        :return: The image batch on the device.
+        """
+        return x.to(device=self.device, memory_format=getattr(torch, self.memory_format))
+
+    def compile_classifier(self):
+        """
+        Compiles the functional forward pass of the classifier when compile_inner_loop_classifier is set. Multi gpu
+        (DataParallel) classifiers keep using their standard forward pass.
+        """
+        if self.compile_inner_loop_classifier and hasattr(self.classifier, 'compile_functional_forward'):
+            self.classifier.compile_functional_forward()
+
+    def classifier_forward(self, x, params, training, backup_running_statistics, num_step, return_features=False):
+        """
+        Runs the classifier with the given fast weights. With compile_inner_loop_classifier set, this goes through the
+        functional forward pass of the classifier, compiled unless the current forward needs to differentiate through
+        the inner loop gradients, which compiled graphs do not support. With fused_target_set_inference set, passes
+        that build no graph (the graph free evaluation target set passes) run the fused inference forward pass.
+        :param x: A data batch of shape b, c, h, w
+        :param params: A dictionary containing the weights to pass to the network.
+        :param training: A flag indicating whether the current process phase is a training or evaluation.
+        :param backup_running_statistics: A flag indicating whether to backup the batch norm running statistics.
+        :param num_step: An integer indicating the number of the step in the inner loop.
+        :param return_features: Whether to also return the classifier features.
+        :return: The classifier output.
+        """
+        params = self.compose_low_rank_fast_weights(params)
+
+        if self.head_only_adaptation:
+            # x holds the features computed by compute_trunk_features
+            preds = self.classifier.head_forward(features=x, params=params)
+            return (preds, x) if return_features else preds
+
+        if self.fused_target_set_inference and not torch.is_grad_enabled() and \
+                hasattr(self.classifier, 'fused_forward'):
+            fused_params = self.classifier.get_fused_params(num_step=num_step, params=params)
+            return self.classifier.fused_forward(x=x, fused_params=fused_params, return_features=return_features)
+
+        if self.compile_inner_loop_classifier and hasattr(self.classifier, 'run_functional_forward'):
+            return self.classifier.run_functional_forward(x=x, params=params, training=training,
+                                                          backup_running_statistics=backup_running_statistics,
+                                                          num_step=num_step, return_features=return_features,
+                                                          use_compiled=not self.classifier_requires_double_backward)
+
+        return self.classifier.forward(x=x, params=params, training=training,
+                                       backup_running_statistics=backup_running_statistics, num_step=num_step,
+                                       return_features=return_features)
+
+    def select_adapted_weights(self, names_weights_copy):
+        """
+        Returns the fast weights the inner loop adapts. With head_only_adaptation set (ANIL), only the linear head is
+        adapted and the rest of the classifier uses its meta-parameters.
+        :param names_weights_copy: A dictionary with the fast weights of every inner loop parameter.
+        """
+        if not self.head_only_adaptation:
+            return names_weights_copy
+
+        return {name: value for name, value in names_weights_copy.items() if name.startswith('layer_dict.linear')}
+
+    def build_low_rank_fast_weights(self, names_weights_copy):
+        """
+        With low_rank_fast_weights_rank r > 0, every adapted conv and linear weight W with more than r rows and
+        columns is adapted as W + A B, where W stays at its meta-parameters and only the rank r factors A and B are
+        inner loop parameters. The meta-learned initial factors are created here, A as zeros so that the update starts
+        at zero.
+        :param names_weights_copy: A dictionary with the inner loop parameters of the classifier.
+        :return: The dictionary with the factored weights replaced by their factors, to initialise the inner loop
+        optimizer with.
+        """
+        if self.low_rank_fast_weights_rank <= 0:
+            return names_weights_copy
+
+        rank = self.low_rank_fast_weights_rank
+        self.low_rank_factors = nn.ParameterDict()
+        for name, value in names_weights_copy.items():
+            num_rows = value.shape[0]
+            num_columns = value.numel() // max(num_rows, 1)
+            if value.dim() >= 2 and min(num_rows, num_columns) > rank:
+                key = name.replace('.', '-')
+                self.low_rank_factors['{}-low_rank_a'.format(key)] = nn.Parameter(
+                    torch.zeros((num_rows, rank), device=value.device))
+                self.low_rank_factors['{}-low_rank_b'.format(key)] = nn.Parameter(
+                    torch.randn((rank, num_columns), device=value.device) / math.sqrt(num_columns))
+
+        return self.to_low_rank_fast_weights(names_weights_copy, repeat_factors=False)
+
+    def to_low_rank_fast_weights(self, names_weights_copy, repeat_factors=True):
+        """
+        Replaces the weights that are adapted at low rank by their initial factors (see build_low_rank_fast_weights).
+        :param names_weights_copy: A dictionary with the fast weights, repeated once per device.
+        :param repeat_factors: Whether to repeat the factors once per device, as the fast weights.
+        :return: A dictionary with the fast weights to adapt in the inner loop.
+        """
+        if self.low_rank_fast_weights_rank <= 0:
+            return names_weights_copy
+
+        low_rank_names_weights_copy = dict()
+        for name, value in names_weights_copy.items():
+            key = name.replace('.', '-')
+            if '{}-low_rank_a'.format(key) not in self.low_rank_factors:
+                low_rank_names_weights_copy[name] = value
+                continue
+
+            for factor_name in ['low_rank_a', 'low_rank_b']:
+                factor = self.low_rank_factors['{}-{}'.format(key, factor_name)]
+                if repeat_factors:
+                    factor = factor.unsqueeze(0).repeat([value.shape[0]] + [1 for i in range(len(factor.shape))])
+                low_rank_names_weights_copy['{}.{}'.format(name, factor_name)] = factor
+
+        return low_rank_names_weights_copy
+
+    def compose_low_rank_fast_weights(self, names_weights_copy):
+        """
+        Maps fast weights with low rank factors (see to_low_rank_fast_weights) to the full weights the classifier
+        expects, W + A B with W the meta-parameters of the classifier.
+        :param names_weights_copy: A dictionary with the fast weights, repeated once per device, or None.
+        :return: A dictionary with the full fast weights.
+        """
+        if self.low_rank_fast_weights_rank <= 0 or names_weights_copy is None:
+            return names_weights_copy
+
+        classifier_params = {name.replace('module.', ''): param for name, param in self.classifier.named_parameters()}
+        composed_names_weights_copy = dict()
+        for name, value in names_weights_copy.items():
+            if name.endswith('.low_rank_a'):
+                weight_name = name[:-len('.low_rank_a')]
+                weight = classifier_params[weight_name]
+                update = torch.matmul(value, names_weights_copy['{}.low_rank_b'.format(weight_name)])
+                composed_names_weights_copy[weight_name] = weight.unsqueeze(0) + update.view(
+                    (update.shape[0],) + tuple(weight.shape))
+            elif not name.endswith('.low_rank_b'):
+                composed_names_weights_copy[name] = value
+
+        return composed_names_weights_copy
+
+    def compute_trunk_features(self, x, backup_running_statistics=False):
+        """
+        Runs the classifier up to its linear head, with the meta-parameters and the batch norm of the first inner loop
+        step. With head_only_adaptation set the inner loop only adapts the head, so these features are computed once
+        and every inner loop and critic step only runs the head on them (see classifier_forward).
+        :param x: A batch of classifier inputs of shape b, c, h, w.
+        :param backup_running_statistics: Whether to backup the batch norm running statistics.
+        :return: The features of shape b, c, h, w.
+        """
+        with self.autocast():
+            features = self.classifier.trunk_forward(x=x, num_step=0, training=True,
+                                                     backup_running_statistics=backup_running_statistics)
+
+        return features.float()
+
+    def compute_support_set_trunk_features(self, x_support_set):
+        """
+        Computes the trunk features of every support set sub-task of a task, once per sub-task.
+        :param x_support_set: The classifier inputs of the task's support sets, of shape num_support_sets, ..., c, h, w
+        :return: The features, of shape num_support_sets, b, c, h, w.
+        """
+        return torch.stack([self.compute_trunk_features(
+            x=x_support_set_sub_task.reshape((-1,) + tuple(x_support_set.shape[-3:])),
+            backup_running_statistics=True) for x_support_set_sub_task in x_support_set])
+
+    def ridge_regression_forward_task(self, x_support_set_task, y_support_set_task, x_target_set_task,
+                                      y_target_set_task, graph_free, restore_batch_norm_stats, backward_scale=None):
+        """
+        The forward_task of the ridge_regression_head mode. The classifier up to its linear head runs once on every
+        support set sub-task and on the target set, and the linear head is replaced by a RidgeRegressionHead, whose
+        closed form fit is updated as each support set arrives. There are no inner loop gradient steps, so there is no
+        multi step loss and no critic update, and the pre and post update metrics are the same.
+        :param x_support_set_task: The classifier inputs of the task's support sets, of shape num_support_sets, ...,
+        c, h, w, on the device.
+        :param y_support_set_task: The support set targets of the task, of shape num_support_sets, ...
+        :param x_target_set_task: The classifier inputs of the task's target set, of shape b, c, h, w, on the device.
+        :param y_target_set_task: The target set targets of the task, of shape b, on the device.
+        :param graph_free: Whether graph free evaluation is in use for the current forward pass.
+        :param restore_batch_norm_stats: Whether to restore the batch norm statistics snapshot by forward_task.
+        :param backward_scale: See forward_task.
+        :return: A dictionary with the same lists as the one returned by forward_task.
+        """
+        with self.graph_free_context(graph_free):
+            support_features = self.compute_support_set_trunk_features(x_support_set=x_support_set_task)
+            target_features = self.compute_trunk_features(x=x_target_set_task)
+            support_features = F.adaptive_avg_pool2d(support_features.view((-1,) + support_features.shape[-3:]),
+                                                     1).view(support_features.shape[0], support_features.shape[1], -1)
+            target_features = F.adaptive_avg_pool2d(target_features, 1).view(target_features.shape[0], -1)
+
+            state = self.ridge_regression_layer.initial_state(num_features=target_features.shape[-1],
+                                                              device=target_features.device)
+            for x_support_set_sub_task, y_support_set_sub_task in zip(support_features, y_support_set_task):
+                state = self.ridge_regression_layer.update(state=state, x=x_support_set_sub_task,
+                                                           y=y_support_set_sub_task.reshape(-1).to(self.device))
+
+            target_preds = self.ridge_regression_layer.forward(x=target_features, state=state)
+            loss = F.cross_entropy(target_preds, y_target_set_task)
+            accuracy = torch.eq(target_preds.argmax(dim=1), y_target_set_task).float().mean()
+
+        if backward_scale is not None:
+            (loss * backward_scale).backward()
+            loss = loss.detach()
+
+        if restore_batch_norm_stats:
+            self.classifier.restore_batch_norm_stats()
+
+        return {'total_per_step_losses': [loss],
+                'total_per_step_accuracies': [accuracy],
+                'per_task_preds': [target_preds.detach()],
+                'pre_target_loss_update_loss': [loss],
+                'pre_target_loss_update_acc': [accuracy],
+                'post_target_loss_update_loss': [loss],
+                'post_target_loss_update_acc': [accuracy],
+                'support_set_steps_taken': [torch.zeros((), device=self.device)]}
+
+    def support_set_converged(self, support_outputs, y_support_set, previous_support_loss, num_steps_taken,
+                              training_phase):
+        """
+        Returns whether the inner loop on a support set sub-task can stop before num_support_set_steps. Only used at
+        evaluation time with eval_early_exit_tolerance > 0: after at least eval_early_exit_min_steps steps, the inner
+        loop stops once the support set is fit perfectly or the support loss changed by at most a relative
+        eval_early_exit_tolerance over the last step. The check copies the support loss to the host after every step.
+        :param support_outputs: The outputs of the last support set forward pass.
+        :param y_support_set: The support set targets.
+        :param previous_support_loss: The support loss of the previous step, or None at the first step.
+        :param num_steps_taken: The number of steps taken on the sub-task, including the last one.
+        :param training_phase: Whether this is a training phase (True) or an evaluation phase (False)
+        """
+        if training_phase or self.eval_early_exit_tolerance <= 0 or \
+                num_steps_taken < max(self.eval_early_exit_min_steps, 1):
+            return False
+
+        support_accuracy = torch.eq(support_outputs['preds'].argmax(dim=1), y_support_set).float().mean()
+        if float(support_accuracy) == 1.:
+            return True
+
+        if previous_support_loss is None:
+            return False
+
+        # the losses are detached before copying them to the host, the support loss is still part of the graph
+        previous_support_loss = float(previous_support_loss.detach())
+        return abs(previous_support_loss - float(support_outputs['loss'].detach())) <= \
+               self.eval_early_exit_tolerance * max(abs(previous_support_loss), 1e-12)
+
+    def use_graph_free_evaluation(self, training_phase):
+        """
+        Returns whether the current forward pass is an evaluation pass that only builds the graphs needed for the
+        inner loop updates (see graph_free_context).
+        :param training_phase: Whether this is a training phase (True) or an evaluation phase (False)
+        """
+        return self.graph_free_evaluation and not training_phase
+
+    def graph_free_context(self, graph_free, inference_mode=True):
+        """
+        Returns the context for forward passes whose graph is not needed at evaluation time. Target set passes run in
+        inference mode, while passes whose outputs are fed into the inner loop (e.g. the embedding backbone) run under
+        no_grad, as inference tensors can not be saved for the backward pass of the support set updates.
+        :param graph_free: Whether graph free evaluation is in use for the current forward pass.
+        :param inference_mode: Whether to use inference mode (True) or no_grad (False).
+        """
+        if not graph_free:
+            return contextlib.nullcontext()
+
+        return torch.inference_mode() if inference_mode else torch.no_grad()
+
+    def embed_images(self, x):
+        """
+        Maps a batch of images to the classifier inputs. The identity, unless the system has an embedding backbone.
+        :param x: An image batch of shape b, c, h, w, on the device.
+        :return: The classifier inputs.
+        """
+        return x
+
+    def get_inference_embedding(self):
+        """
+        Returns a cpu copy of the module applied by embed_images, to be exported with the classifier, or None if the
+        system has no embedding backbone.
+        """
+        return None
+
+    def adapt_to_support_set(self, x_support_set, y_support_set):
+        """
+        Adapts the fast weights of the classifier to the support sets of a single task with first order inner loop
+        updates, as in an evaluation forward pass. The batch norm running statistics are left unchanged.
+        :param x_support_set: The classifier inputs of the task's support sets, of shape num_support_sets, ..., c, h, w
+        :param y_support_set: The targets of the task's support sets, of shape num_support_sets, ...
+        :return: A tuple of the adapted fast weights and the inner loop step the target set is evaluated at (the first
+        step with head_only_adaptation set, whose batch norm the trunk features are computed with).
+        """
+        names_weights_copy = self.get_inner_loop_parameter_dict(self.classifier.named_parameters())
+        num_devices = torch.cuda.device_count() if torch.cuda.is_available() else 1
+
+        names_weights_copy = {
+            name.replace('module.', ''): value.detach().unsqueeze(0).repeat(
+                [num_devices] + [1 for i in range(len(value.shape))]).requires_grad_() for
+            name, value in names_weights_copy.items()}
+        names_weights_copy = self.select_adapted_weights(names_weights_copy)
+        names_weights_copy = {name: value.detach().requires_grad_() for name, value in
+                              self.to_low_rank_fast_weights(names_weights_copy).items()}
+
+        self.classifier.snapshot_batch_norm_stats()
+        step_idx = 0
+
+        if self.head_only_adaptation:
+            with torch.no_grad():
+                x_support_set = self.compute_support_set_trunk_features(x_support_set=x_support_set)
+
+        for x_support_set_sub_task, y_support_set_sub_task in zip(x_support_set, y_support_set):
+            x_support_set_sub_task = x_support_set_sub_task.reshape((-1,) + tuple(x_support_set.shape[-3:]))
+            y_support_set_sub_task = y_support_set_sub_task.reshape(-1)
+
+            for num_step in range(self.num_support_set_steps):
+                support_outputs = self.net_forward(x=x_support_set_sub_task, y=y_support_set_sub_task,
+                                                   weights=names_weights_copy,
+                                                   backup_running_statistics=num_step == 0, training=True,
+                                                   num_step=step_idx)
+                names_weights_copy = self.apply_inner_loop_update(loss=support_outputs['loss'],
+                                                                  names_weights_copy=names_weights_copy,
+                                                                  use_second_order=False,
+                                                                  current_step_idx=step_idx,
+                                                                  detach_inner_loop_history=True)
+                step_idx += 1
+                if self.use_multi_step_loss_optimization:
+                    step_idx += 1
+
+        self.classifier.restore_batch_norm_stats()
+
+        if self.head_only_adaptation:
+            step_idx = 0
+
+        return names_weights_copy, step_idx
+
+    def export_quantized_classifier(self, x_support_set, y_support_set, backend='fbgemm'):
+        """
+        Adapts the classifier to the support sets of a single task and exports it as a cpu inference module whose conv
+        and linear layers are statically quantized to int8, with the activation ranges calibrated on the support set.
+        :param x_support_set: The support set images of a single task, of shape num_support_sets, ..., c, h, w
+        :param y_support_set: The support set targets of the task, of shape num_support_sets, ...
+        :param backend: The quantized engine to target, 'fbgemm' for x86 or 'qnnpack' for arm cpus.
+        :return: A tuple of the float inference module, with the batch norm folded into the convs, and its quantized
+        copy. Both take cpu images of shape b, c, h, w and return the logits.
+        """
+        self.eval()
+        c, h, w = x_support_set.shape[-3:]
+        support_images = x_support_set.reshape(-1, c, h, w)
+
+        with torch.no_grad():
+            support_inputs = self.embed_images(self.images_to_device(support_images))
+        support_inputs = support_inputs.reshape(tuple(x_support_set.shape[:-3]) + tuple(support_inputs.shape[-3:]))
+
+        names_weights_copy, num_step = self.adapt_to_support_set(x_support_set=support_inputs,
+                                                                 y_support_set=y_support_set.to(self.device))
+
+        classifier = self.classifier.module if isinstance(self.classifier, nn.DataParallel) else self.classifier
+        float_classifier = build_quantizable_classifier(classifier=classifier, num_step=num_step,
+                                                        params=self.compose_low_rank_fast_weights(names_weights_copy),
+                                                        embedding=self.get_inference_embedding())
+        quantized_classifier = quantize_classifier(quantizable_classifier=float_classifier,
+                                                   calibration_inputs=support_images.cpu().contiguous(),
+                                                   backend=backend)
+
+        return float_classifier, quantized_classifier
+
+    def use_concurrent_tasks(self, num_tasks, training_phase):
+        """
+        Returns whether the tasks of a meta batch run concurrently in worker threads (see run_tasks). Concurrent tasks
+        share the batch norm running statistics, which the fused target set inference normalizes with, so evaluation
+        with fused_target_set_inference runs the tasks one after the other, each from the same statistics.
+        :param num_tasks: The number of tasks in the meta batch.
+        :param training_phase: Whether this is a training phase (True) or an evaluation phase (False)
+        """
+        if self.fused_target_set_inference and not training_phase:
+            return False
+
+        return self.num_task_threads > 1 and num_tasks > 1
+
+    def run_tasks(self, task_function, tasks, training_phase):
+        """
+        Runs task_function on every task of the meta batch. With num_task_threads > 1 the tasks run concurrently in
+        worker threads, each building its own autograd graph, with the intra-op threads divided between the workers
+        so that many core cpus are kept busy by small tasks. Kernels and autograd release the GIL, so the workers
+        overlap everywhere but in the python glue. The batch norm running statistics are shared by the workers.
+        :param task_function: A function taking the arguments of a single task.
+        :param tasks: A list with the argument tuple of every task.
+        :param training_phase: Whether this is a training phase (True) or an evaluation phase (False)
+        :return: A list with the outputs of task_function, in task order.
+        """
+        if not self.use_concurrent_tasks(num_tasks=len(tasks), training_phase=training_phase):
+            return [task_function(*task) for task in tasks]
+
+        num_workers = min(self.num_task_threads, len(tasks))
+        num_intra_op_threads = torch.get_num_threads()
+        grad_enabled = torch.is_grad_enabled()
+
+        def run_task(task):
+            # the grad mode is thread local, so it is set again in every worker
+            with torch.set_grad_enabled(grad_enabled):
+                return task_function(*task)
+
+        try:
+            # the intra-op thread pool is shared by the whole process, it is divided between the workers for the
+            # duration of the meta batch
+            torch.set_num_threads(max(1, num_intra_op_threads // num_workers))
+            with ThreadPoolExecutor(max_workers=num_workers) as executor:
+                task_outputs = list(executor.map(run_task, tasks))
+        finally:
+            torch.set_num_threads(num_intra_op_threads)
+
+        return task_outputs
+
+    def use_streaming_task_backward(self, training_phase):
+        """
+        Returns whether every task of a training meta batch backpropagates its share of the outer loss right after
+        its inner loop (see forward_task), instead of meta_update backpropagating the mean loss of the meta batch.
+        Only one task's unrolled inner loop graph is then alive at a time (num_task_threads with concurrent tasks),
+        so the peak memory does not grow with the batch size.
+        :param training_phase: Whether this is a training phase (True) or an evaluation phase (False)
+        """
+        return self.stream_task_backward and training_phase
+
     def get_inner_loop_parameter_dict(self, params, exclude_strings=None):
         """
         Returns a dictionary with the parameters to use for inner loop updates.
@@ -287,8 +982,12 @@ class MAMLFewShotClassifier(nn.Module):
         Applies an outer loop update on the meta-parameters of the model.
         :param loss: The current crossentropy loss.
         """
-        self.optimizer.zero_grad()
-        loss.backward(retain_graph=retain_graph)
+        if not self.use_streaming_task_backward(training_phase=True):
+            self.optimizer.zero_grad()
+            loss.backward(retain_graph=retain_graph)
+        if is_distributed() and not is_parameter_server_worker():
+            # averages the meta-gradients, including those of the inner loop learning rates, across the ranks
+            all_reduce_gradients(self.trainable_parameters())
         if 'imagenet' in self.dataset_name:
             for name, param in self.trainable_names_parameters(exclude_params_with_string=exclude_string_list):
                 #
@@ -304,8 +1003,36 @@ class MAMLFewShotClassifier(nn.Module):
                 if self.clip_grads and param.grad is not None and param.requires_grad and "softmax":
                     param.grad.data.clamp_(-10, 10)
 
+        if is_parameter_server_worker():
+            # the parameter server steps its copy of the optimizer and returns the updated meta-parameters
+            version, parameters = push_gradients(
+                gradients={name: param.grad for name, param in self.named_parameters()
+                           if param.requires_grad and param.grad is not None},
+                version=self.parameter_server_version, epoch=self.current_epoch)
+            self.load_parameter_server_parameters(version=version, parameters=parameters)
+            return
+
         self.optimizer.step()
 
+    def load_parameter_server_parameters(self, version, parameters):
+        """
+        Loads meta-parameters received from the parameter server.
+        :param version: The number of updates the parameter server had applied to the meta-parameters.
+        :param parameters: A dictionary of the meta-parameters, keyed by parameter name.
+        """
+        self.parameter_server_version = version
+        with torch.no_grad():
+            for name, param in self.named_parameters():
+                if name in parameters:
+                    param.copy_(parameters[name])
+
+    def pull_parameter_server_parameters(self):
+        """
+        Loads the current meta-parameters of the parameter server.
+        """
+        version, parameters = pull_parameters()
+        self.load_parameter_server_parameters(version=version, parameters=parameters)
+
 
 class EmbeddingMAMLFewShotClassifier(MAMLFewShotClassifier):
     def __init__(self, batch_size, seed, num_classes_per_set, num_samples_per_support_class,
@@ -376,7 +1103,9 @@ class EmbeddingMAMLFewShotClassifier(MAMLFewShotClassifier):
             im_shape=torch.cat([x_support_set, x_target_set], dim=0).shape, num_filters=self.num_filters,
             num_blocks_per_stage=self.num_blocks_per_stage,
             num_stages=self.num_stages, average_pool_outputs=False, dropout_rate=self.dropout_rate,
-            output_spatial_dimensionality=self.output_spatial_dimensionality, use_channel_wise_attention=True)
+            output_spatial_dimensionality=self.output_spatial_dimensionality, use_channel_wise_attention=True,
+            memory_efficient=self.dense_net_memory_efficient, stem_num_filters=self.embedding_stem_num_filters,
+            output_num_filters=self.embedding_output_num_filters if self.embedding_output_num_filters > 0 else None)
 
         task_features = self.dense_net_embedding.forward(
             x=torch.cat([x_support_set, x_target_set], dim=0), dropout_training=True)
@@ -443,6 +1172,7 @@ class EmbeddingMAMLFewShotClassifier(MAMLFewShotClassifier):
             learnable_learning_rates=self.learnable_learning_rates,
             init_learning_rate=self.init_learning_rate)
 
+        names_weights_copy = self.build_low_rank_fast_weights(names_weights_copy)
         self.inner_loop_optimizer.initialise(names_weights_dict=names_weights_copy)
         print("Inner Loop parameters")
         num_params = 0
@@ -471,6 +1201,10 @@ class EmbeddingMAMLFewShotClassifier(MAMLFewShotClassifier):
                 num_params += product
         print('Total Memory parameters', num_params)
 
+        if self.ridge_regression_head:
+            self.ridge_regression_layer = RidgeRegressionHead(num_output_classes=output_units,
+                                                              init_lambda=self.ridge_regression_init_lambda)
+
         self.exclude_list = None
         self.switch_opt_params(exclude_list=self.exclude_list)
 
@@ -484,6 +1218,9 @@ class EmbeddingMAMLFewShotClassifier(MAMLFewShotClassifier):
             else:
                 self.to(self.device)
 
+        self.to_memory_format()
+        self.compile_classifier()
+
     def switch_opt_params(self, exclude_list):
         print("current trainable params")
         for name, param in self.trainable_names_parameters(exclude_params_with_string=exclude_list):
@@ -494,6 +1231,92 @@ class EmbeddingMAMLFewShotClassifier(MAMLFewShotClassifier):
         self.scheduler = optim.lr_scheduler.CosineAnnealingLR(optimizer=self.optimizer, T_max=self.total_epochs,
                                                               eta_min=self.min_learning_rate)
 
+    def embed_images(self, x):
+        """
+        Maps a batch of images to the classifier inputs with the dense net embedding, without dropout.
+        :param x: An image batch of shape b, c, h, w, on the device.
+        :return: The image embeddings.
+        """
+        with self.autocast():
+            image_embedding = self.dense_net_embedding.forward(x=x, dropout_training=False)
+
+        return image_embedding.float()
+
+    def get_inference_embedding(self):
+        """
+        Returns a cpu copy of the dense net embedding in evaluation mode, which stays in float in exported inference
+        modules.
+        """
+        dense_net_embedding = self.dense_net_embedding.module if isinstance(self.dense_net_embedding, nn.DataParallel) \
+            else self.dense_net_embedding
+
+        return copy.deepcopy(dense_net_embedding).cpu().eval()
+
+    def get_distillation_losses(self, teacher, data_batch):
+        """
+        Computes the losses that distill the dense net embedding of a trained teacher system into the (thinner) dense
+        net embedding of this system, whose other parameters are copies of the teacher's. The student embedding is
+        matched to the teacher embedding with a mean squared error, and the target set predictions the classifier
+        makes on the student embeddings, with the fast weights adapted on the teacher's support set embeddings, are
+        matched to its predictions on the teacher embeddings with a temperature scaled KL divergence.
+        :param teacher: A trained EmbeddingMAMLFewShotClassifier.
+        :param data_batch: A data batch containing the support and target sets.
+        :return: A dictionary with the embedding loss, the prediction loss and their weighted sum as the loss.
+        """
+        x_support_set, x_target_set, y_support_set, y_target_set, _, _ = data_batch
+        temperature = self.distillation_temperature
+        embedding_losses = []
+        prediction_losses = []
+
+        for x_support_set_task, y_support_set_task, x_target_set_task, y_target_set_task in \
+                zip(x_support_set, y_support_set, x_target_set, y_target_set):
+            c, h, w = x_target_set_task.shape[-3:]
+            num_support_samples = int(np.prod(x_support_set_task.shape[:-3]))
+            images = self.images_to_device(torch.cat([x_support_set_task.reshape(-1, c, h, w),
+                                                      x_target_set_task.reshape(-1, c, h, w)], dim=0))
+            y_target_set_task = y_target_set_task.view(-1).to(self.device)
+
+            with torch.no_grad():
+                teacher_embedding = teacher.embed_images(images)
+
+            names_weights_copy, num_step = self.adapt_to_support_set(
+                x_support_set=teacher_embedding[:num_support_samples].reshape(
+                    tuple(x_support_set_task.shape[:-3]) + tuple(teacher_embedding.shape[-3:])),
+                y_support_set=y_support_set_task.to(self.device))
+            names_weights_copy = {name: value.detach() for name, value in names_weights_copy.items()}
+
+            with self.autocast():
+                student_embedding = self.dense_net_embedding.forward(x=images, dropout_training=False)
+            student_embedding = student_embedding.float()
+            embedding_losses.append(F.mse_loss(student_embedding, teacher_embedding))
+
+            self.classifier.snapshot_batch_norm_stats()
+            teacher_inputs = teacher_embedding[num_support_samples:]
+            student_inputs = student_embedding[num_support_samples:]
+            if self.head_only_adaptation:
+                with torch.no_grad():
+                    teacher_inputs = self.compute_trunk_features(x=teacher_inputs)
+                student_inputs = self.compute_trunk_features(x=student_inputs)
+            with torch.no_grad():
+                teacher_preds = self.net_forward(x=teacher_inputs, y=y_target_set_task,
+                                                 weights=names_weights_copy, backup_running_statistics=False,
+                                                 training=True, num_step=num_step)['preds']
+            student_preds = self.net_forward(x=student_inputs, y=y_target_set_task,
+                                             weights=names_weights_copy, backup_running_statistics=False,
+                                             training=True, num_step=num_step)['preds']
+            self.classifier.restore_batch_norm_stats()
+
+            prediction_losses.append(F.kl_div(F.log_softmax(student_preds / temperature, dim=1),
+                                              F.softmax(teacher_preds / temperature, dim=1),
+                                              reduction='batchmean') * temperature ** 2)
+
+        losses = {'embedding_loss': torch.stack(embedding_losses).mean(),
+                  'prediction_loss': torch.stack(prediction_losses).mean()}
+        losses['loss'] = self.distillation_embedding_loss_weight * losses['embedding_loss'] + \
+                         losses['prediction_loss']
+
+        return losses
+
     def net_forward(self, x, y, weights, backup_running_statistics, training, num_step,
                     return_features=False):
         """
@@ -512,28 +1335,32 @@ class EmbeddingMAMLFewShotClassifier(MAMLFewShotClassifier):
         """
         outputs = {"loss": 0., "preds": 0, "features": 0.}
         if return_features:
-            outputs['preds'], outputs['features'] = self.classifier.forward(x=x, params=weights,
-                                                                            training=training,
-                                                                            backup_running_statistics=backup_running_statistics,
-                                                                            num_step=num_step,
-                                                                            return_features=return_features)
+            with self.autocast():
+                outputs['preds'], outputs['features'] = self.classifier_forward(x=x, params=weights,
+                                                                                training=training,
+                                                                                backup_running_statistics=backup_running_statistics,
+                                                                                num_step=num_step,
+                                                                                return_features=return_features)
             if type(outputs['preds']) == tuple:
                 if len(outputs['preds']) == 2:
                     outputs['preds'] = outputs['preds'][0]
 
+            outputs['preds'] = outputs['preds'].float()
             outputs['loss'] = F.cross_entropy(outputs['preds'], y)
 
 
         else:
-            outputs['preds'] = self.classifier.forward(x=x, params=weights,
-                                                       training=training,
-                                                       backup_running_statistics=backup_running_statistics,
-                                                       num_step=num_step)
+            with self.autocast():
+                outputs['preds'] = self.classifier_forward(x=x, params=weights,
+                                                           training=training,
+                                                           backup_running_statistics=backup_running_statistics,
+                                                           num_step=num_step)
 
             if type(outputs['preds']) == tuple:
                 if len(outputs['preds']) == 2:
                     outputs['preds'] = outputs['preds'][0]
 
+            outputs['preds'] = outputs['preds'].float()
             outputs['loss'] = F.cross_entropy(outputs['preds'], y)
 
         return outputs
@@ -560,76 +1387,104 @@ class EmbeddingMAMLFewShotClassifier(MAMLFewShotClassifier):
 
         return loss_weights
 
-    def forward(self, data_batch, epoch, use_second_order, use_multi_step_loss_optimization, num_steps, training_phase):
+    def forward_task(self, x_support_set_task, y_support_set_task, x_target_set_task, y_target_set_task,
+                     use_second_order, training_phase, graph_free, importance_vector, restore_batch_norm_stats,
+                     backward_scale=None):
         """
-        Runs a forward outer loop pass on the batch of tasks using the MAML/++ framework.
-        :param data_batch: A data batch containing the support and target sets.
-        :param epoch: Current epoch's index
+        Runs the inner loop and the target set losses of a single task of the meta batch. The tasks only share the
+        meta-parameters, so run_tasks can run them concurrently, each with its own autograd graph.
+        :param x_support_set_task: The support set images of the task.
+        :param y_support_set_task: The support set targets of the task.
+        :param x_target_set_task: The target set images of the task.
+        :param y_target_set_task: The target set targets of the task.
         :param use_second_order: A boolean saying whether to use second order derivatives.
-        :param use_multi_step_loss_optimization: Whether to optimize on the outer loop using just the last step's
-        target loss (True) or whether to use multi step loss which improves the stability of the system (False)
-        :param num_steps: Number of inner loop steps.
         :param training_phase: Whether this is a training phase (True) or an evaluation phase (False)
-        :return: A dictionary with the collected losses of the current outer forward propagation.
+        :param graph_free: Whether graph free evaluation is in use for the current forward pass.
+        :param importance_vector: The weights of the pre and post critic update target losses.
+        :param restore_batch_norm_stats: Whether to snapshot the batch norm statistics before the task and restore
+        them after it.
+        :param backward_scale: If not None, the task's outer loss is scaled by it and backpropagated into the
+        meta-gradients before returning, and only detached losses are returned, so that the task's graph is freed.
+        :return: A dictionary with the task's losses, accuracies and predictions, each in a list that forward
+        concatenates across the tasks of the meta batch.
         """
-
-        x_support_set, x_target_set, y_support_set, y_target_set, _, _ = data_batch
-
-        self.classifier.zero_grad()
-
         total_per_step_losses = []
-
         total_per_step_accuracies = []
-
         per_task_preds = []
-        num_losses = 2
-        importance_vector = torch.Tensor([1.0 / num_losses for i in range(num_losses)]).to(self.device)
-        step_magnitude = (1.0 / num_losses) / self.total_epochs
-        current_epoch_step_magnitude = torch.ones(1).to(self.device) * (step_magnitude * (epoch + 1))
-        importance_vector[0] = importance_vector[0] - current_epoch_step_magnitude
-        importance_vector[1] = importance_vector[1] + current_epoch_step_magnitude
         pre_target_loss_update_loss = []
         pre_target_loss_update_acc = []
         post_target_loss_update_loss = []
         post_target_loss_update_acc = []
+        support_set_steps_taken = []
 
+        names_weights_copy = self.get_inner_loop_parameter_dict(self.classifier.named_parameters())
 
-        for task_id, (x_support_set_task, y_support_set_task, x_target_set_task, y_target_set_task) in \
-                enumerate(zip(x_support_set,
-                              y_support_set,
-                              x_target_set,
-                              y_target_set)):
-
-            names_weights_copy = self.get_inner_loop_parameter_dict(self.classifier.named_parameters())
-
-            num_devices = torch.cuda.device_count() if torch.cuda.is_available() else 1
-
-            names_weights_copy = {
-                name.replace('module.', ''): value.unsqueeze(0).repeat(
-                    [num_devices] + [1 for i in range(len(value.shape))]) for
-                name, value in names_weights_copy.items()}
-
-            c, h, w = x_target_set_task.shape[-3:]
-
-            x_target_set_task = x_target_set_task.view(-1, c, h, w).to(self.device)
-            y_target_set_task = y_target_set_task.view(-1).to(self.device)
-            x_support_set_task = x_support_set_task.view(-1, c, h, w).to(self.device)
-            y_support_set_task = y_support_set_task.to(self.device)
-
+        num_devices = torch.cuda.device_count() if torch.cuda.is_available() else 1
+
+        names_weights_copy = {
+            name.replace('module.', ''): value.unsqueeze(0).repeat(
+                [num_devices] + [1 for i in range(len(value.shape))]) for
+            name, value in names_weights_copy.items()}
+        names_weights_copy = self.to_low_rank_fast_weights(self.select_adapted_weights(names_weights_copy))
+        if graph_free:
+            names_weights_copy = {name: value.detach().requires_grad_() for name, value in
+                                  names_weights_copy.items()}
+        if restore_batch_norm_stats:
+            self.classifier.snapshot_batch_norm_stats()
+        initial_names_weights_copy = names_weights_copy
+        detach_inner_loop_history = graph_free or self.uses_first_order_meta_gradient()
+
+        c, h, w = x_target_set_task.shape[-3:]
+
+        x_target_set_task = self.images_to_device(x_target_set_task.view(-1, c, h, w))
+        y_target_set_task = y_target_set_task.view(-1).to(self.device)
+        x_support_set_task = self.images_to_device(x_support_set_task.view(-1, c, h, w))
+        y_support_set_task = y_support_set_task.to(self.device)
+
+        with self.autocast(), self.graph_free_context(graph_free, inference_mode=False):
             image_embedding = self.dense_net_embedding.forward(
                 x=torch.cat([x_support_set_task, x_target_set_task], dim=0), dropout_training=True)
-
-            x_support_set_task = image_embedding[:x_support_set_task.shape[0]]
-            x_target_set_task = image_embedding[x_support_set_task.shape[0]:]
-
-            x_support_set_task = x_support_set_task.view(
-                (self.num_support_sets, self.num_classes_per_set, self.num_samples_per_support_class,
-                 x_support_set_task.shape[-3],
-                 x_support_set_task.shape[-2], x_support_set_task.shape[-1]))
-
-            target_set_per_step_loss = []
-            importance_weights = self.get_per_step_loss_importance_vector(current_epoch=self.current_epoch)
-            step_idx = 0
+        image_embedding = image_embedding.float()
+
+        x_support_set_task = image_embedding[:x_support_set_task.shape[0]]
+        x_target_set_task = image_embedding[x_support_set_task.shape[0]:]
+
+        x_support_set_task = x_support_set_task.view(
+            (self.num_support_sets, self.num_classes_per_set, self.num_samples_per_support_class,
+             x_support_set_task.shape[-3],
+             x_support_set_task.shape[-2], x_support_set_task.shape[-1]))
+
+        if self.ridge_regression_head:
+            return self.ridge_regression_forward_task(
+                x_support_set_task=x_support_set_task, y_support_set_task=y_support_set_task,
+                x_target_set_task=x_target_set_task, y_target_set_task=y_target_set_task, graph_free=graph_free,
+                restore_batch_norm_stats=restore_batch_norm_stats, backward_scale=backward_scale)
+
+        if self.head_only_adaptation:
+            with self.graph_free_context(graph_free, inference_mode=False):
+                x_support_set_task = self.compute_support_set_trunk_features(x_support_set=x_support_set_task)
+                x_target_set_task = self.compute_trunk_features(x=x_target_set_task)
+
+        target_set_per_step_loss = []
+        importance_weights = self.get_per_step_loss_importance_vector(current_epoch=self.current_epoch)
+        step_idx = 0
+        last_support_step_idx = 0
+        if self.use_inner_loop_checkpointing(use_second_order=use_second_order, training_phase=training_phase,
+                                             detach_inner_loop_history=detach_inner_loop_history):
+            x_support_set_sub_tasks = x_support_set_task.view(
+                (self.num_support_sets, -1, x_support_set_task.shape[-3], x_support_set_task.shape[-2],
+                 x_support_set_task.shape[-1]))
+            y_support_set_sub_tasks = y_support_set_task.view(self.num_support_sets, -1)
+            task_embedding = None
+
+            for segment_start in range(0, self.num_support_sets, self.inner_loop_checkpoint_interval):
+                segment_end = min(segment_start + self.inner_loop_checkpoint_interval, self.num_support_sets)
+                names_weights_copy = self.checkpoint_support_set_steps(
+                    x_support_set_sub_tasks=x_support_set_sub_tasks[segment_start:segment_end],
+                    y_support_set_sub_tasks=y_support_set_sub_tasks[segment_start:segment_end],
+                    names_weights_copy=names_weights_copy, use_second_order=use_second_order, step_idx=step_idx)
+                step_idx += (segment_end - segment_start) * self.num_support_set_steps
+        else:
             for sub_task_id, (x_support_set_sub_task, y_support_set_sub_task) in enumerate(zip(x_support_set_task,
                                                                                                y_support_set_task)):
 
@@ -649,6 +1504,8 @@ class EmbeddingMAMLFewShotClassifier(MAMLFewShotClassifier):
                     task_embedding = None
                 # print(x_target_set_task.shape, x_target_set_task_features.shape)
 
+                previous_support_loss = None
+                num_steps_taken = 0
                 for num_step in range(self.num_support_set_steps):
 
                     support_outputs = self.net_forward(x=x_support_set_sub_task,
@@ -660,105 +1517,238 @@ class EmbeddingMAMLFewShotClassifier(MAMLFewShotClassifier):
                                                        num_step=step_idx,
                                                        return_features=True)
 
-                    names_weights_copy = self.apply_inner_loop_update(loss=support_outputs['loss'],
+                    truncate_step = not detach_inner_loop_history and self.outside_meta_backprop_horizon(
+                        step=sub_task_id * self.num_support_set_steps + num_step,
+                        num_steps=self.num_support_sets * self.num_support_set_steps,
+                        meta_backprop_horizon=self.meta_backprop_horizon)
+                    last_support_step_idx = step_idx
+                    support_loss = support_outputs['loss']
+                    if self.meta_gradient_type == 'imaml':
+                        support_loss = support_loss + self.get_proximal_loss(names_weights_copy,
+                                                                             initial_names_weights_copy)
+
+                    names_weights_copy = self.apply_inner_loop_update(loss=support_loss,
                                                                       names_weights_copy=names_weights_copy,
                                                                       use_second_order=use_second_order,
-                                                                      current_step_idx=step_idx)
+                                                                      current_step_idx=step_idx,
+                                                                      detach_inner_loop_history=
+                                                                      detach_inner_loop_history,
+                                                                      anchor_names_weights_copy=
+                                                                      initial_names_weights_copy if
+                                                                      truncate_step else None)
                     step_idx += 1
                     if self.use_multi_step_loss_optimization:
-                        target_outputs = self.net_forward(x=x_target_set_task,
-                                                          y=y_target_set_task, weights=names_weights_copy,
-                                                          backup_running_statistics=False, training=True,
-                                                          num_step=step_idx,
-                                                          return_features=True)
+                        with self.graph_free_context(graph_free):
+                            target_outputs = self.net_forward(x=x_target_set_task,
+                                                              y=y_target_set_task,
+                                                              weights=self.get_outer_loop_weights(
+                                                                  names_weights_copy, initial_names_weights_copy),
+                                                              backup_running_statistics=False, training=True,
+                                                              num_step=step_idx,
+                                                              return_features=True)
                         target_set_per_step_loss.append(target_outputs['loss'])
                         step_idx += 1
 
-            if not self.use_multi_step_loss_optimization:
+                    num_steps_taken += 1
+                    if self.support_set_converged(support_outputs=support_outputs,
+                                                  y_support_set=y_support_set_sub_task,
+                                                  previous_support_loss=previous_support_loss,
+                                                  num_steps_taken=num_steps_taken, training_phase=training_phase):
+                        num_skipped_steps = self.num_support_set_steps - num_steps_taken
+                        # the fast weights stay the same over the skipped steps, the later steps keep their step
+                        # indexes
+                        step_idx += num_skipped_steps
+                        if self.use_multi_step_loss_optimization:
+                            target_set_per_step_loss.extend([target_set_per_step_loss[-1]] * num_skipped_steps)
+                            step_idx += num_skipped_steps
+                        break
+                    previous_support_loss = support_outputs['loss'].detach()
+
+                support_set_steps_taken.append(num_steps_taken)
+
+        if not self.use_multi_step_loss_optimization:
+            with self.graph_free_context(graph_free):
                 target_outputs = self.net_forward(x=x_target_set_task,
-                                                  y=y_target_set_task, weights=names_weights_copy,
-                                                  backup_running_statistics=False, training=True,
-                                                  num_step=step_idx,
-                                                  return_features=True)
-                target_set_loss = target_outputs['loss']
-                step_idx += 1
-            else:
-                target_set_loss = torch.sum(
-                    torch.stack(target_set_per_step_loss, dim=0) * importance_weights)
-
-            for num_step in range(self.num_target_set_steps):
-                target_outputs = self.net_forward(x=x_target_set_task,
-                                                  y=y_target_set_task, weights=names_weights_copy,
+                                                  y=y_target_set_task,
+                                                  weights=self.get_outer_loop_weights(names_weights_copy,
+                                                                                      initial_names_weights_copy),
                                                   backup_running_statistics=False, training=True,
                                                   num_step=step_idx,
                                                   return_features=True)
+            target_set_loss = target_outputs['loss']
+            step_idx += 1
+        else:
+            target_set_loss = torch.sum(
+                torch.stack(target_set_per_step_loss, dim=0) * importance_weights)
+
+        critic_anchor_names_weights_copy = names_weights_copy
+        # the target set loss of the critic steps is part of the outer loop loss, so the critic updates keep its graph
+        # alive, including the first order ones and the ones truncated by critic_meta_backprop_horizon
+        for num_step in range(self.num_target_set_steps):
+            # under implicit MAML the critic steps are treated as first order steps from the fixed point
+            truncate_step = self.meta_gradient_type == 'imaml' or (
+                    not detach_inner_loop_history and self.outside_meta_backprop_horizon(
+                step=num_step, num_steps=self.num_target_set_steps,
+                meta_backprop_horizon=self.critic_meta_backprop_horizon))
+            target_outputs = self.net_forward(x=x_target_set_task,
+                                              y=y_target_set_task, weights=names_weights_copy,
+                                              backup_running_statistics=False, training=True,
+                                              num_step=step_idx,
+                                              return_features=True)
+            with self.autocast():
                 predicted_loss = self.critic_network.forward(logits=target_outputs['preds'],
                                                              task_embedding=task_embedding)
+            predicted_loss = predicted_loss.float()
+
+            names_weights_copy = self.apply_inner_loop_update(loss=predicted_loss,
+                                                              names_weights_copy=names_weights_copy,
+                                                              use_second_order=use_second_order,
+                                                              current_step_idx=step_idx,
+                                                              detach_inner_loop_history=detach_inner_loop_history,
+                                                              anchor_names_weights_copy=
+                                                              critic_anchor_names_weights_copy if
+                                                              truncate_step else None,
+                                                              retain_graph=True)
+            step_idx += 1
 
-                names_weights_copy = self.apply_inner_loop_update(loss=predicted_loss,
-                                                                  names_weights_copy=names_weights_copy,
-                                                                  use_second_order=use_second_order,
-                                                                  current_step_idx=step_idx)
-                step_idx += 1
-
-            if self.num_target_set_steps > 0:
+        if self.num_target_set_steps > 0:
+            with self.graph_free_context(graph_free):
                 post_update_outputs = self.net_forward(
                     x=x_target_set_task,
-                    y=y_target_set_task, weights=names_weights_copy,
+                    y=y_target_set_task,
+                    weights=self.get_outer_loop_weights(names_weights_copy, initial_names_weights_copy),
                     backup_running_statistics=False, training=True,
                     num_step=step_idx,
                     return_features=True)
-                post_update_loss, post_update_target_preds, post_updated_target_features = post_update_outputs[
-                                                                                               'loss'], \
-                                                                                           post_update_outputs[
-                                                                                               'preds'], \
-                                                                                           post_update_outputs[
-                                                                                               'features']
-                step_idx += 1
-            else:
-                post_update_loss, post_update_target_preds, post_updated_target_features = target_set_loss, \
-                                                                                           target_outputs['preds'], \
-                                                                                           target_outputs[
-                                                                                               'features']
+            post_update_loss, post_update_target_preds, post_updated_target_features = post_update_outputs[
+                                                                                           'loss'], \
+                                                                                       post_update_outputs[
+                                                                                           'preds'], \
+                                                                                       post_update_outputs[
+                                                                                           'features']
+            step_idx += 1
+        else:
+            post_update_loss, post_update_target_preds, post_updated_target_features = target_set_loss, \
+                                                                                       target_outputs['preds'], \
+                                                                                       target_outputs[
+                                                                                           'features']
+
+        pre_target_loss_update_loss.append(target_set_loss)
+        pre_softmax_target_preds = F.softmax(target_outputs['preds'], dim=1).argmax(dim=1)
+        pre_update_accuracy = torch.eq(pre_softmax_target_preds,
+                                       y_target_set_task).float().mean()
+        pre_target_loss_update_acc.append(pre_update_accuracy)
+
+        post_target_loss_update_loss.append(post_update_loss)
+        post_softmax_target_preds = F.softmax(post_update_target_preds, dim=1).argmax(dim=1)
+        post_update_accuracy = torch.eq(post_softmax_target_preds,
+                                        y_target_set_task).float().mean()
+        post_target_loss_update_acc.append(post_update_accuracy)
+
+        loss = target_outputs['loss'] * importance_vector[0] + post_update_loss * importance_vector[1]
+
+        if self.meta_gradient_type == 'reptile':
+            loss = loss + self.get_reptile_loss(names_weights_copy, initial_names_weights_copy)
+        elif self.meta_gradient_type == 'imaml' and training_phase:
+            loss = loss + self.get_implicit_meta_gradient_loss(
+                target_loss=loss,
+                x_support_set=x_support_set_task.view(-1, x_support_set_task.shape[-3],
+                                                      x_support_set_task.shape[-2], x_support_set_task.shape[-1]),
+                y_support_set=y_support_set_task.view(-1),
+                num_step=last_support_step_idx,
+                names_weights_copy=critic_anchor_names_weights_copy,
+                initial_names_weights_copy=initial_names_weights_copy)
+
+        if graph_free:
+            loss = loss.detach()
+
+        if backward_scale is not None:
+            (loss * backward_scale).backward()
+            loss = loss.detach()
+            pre_target_loss_update_loss = [value.detach() for value in pre_target_loss_update_loss]
+            post_target_loss_update_loss = [value.detach() for value in post_target_loss_update_loss]
+
+        total_per_step_losses.append(loss)
+        total_per_step_accuracies.append(post_update_accuracy)
+
+        per_task_preds.append(post_update_target_preds.detach())
+
+        if restore_batch_norm_stats:
+            self.classifier.restore_batch_norm_stats()
+
+        return {'total_per_step_losses': total_per_step_losses,
+                'total_per_step_accuracies': total_per_step_accuracies,
+                'per_task_preds': per_task_preds,
+                'pre_target_loss_update_loss': pre_target_loss_update_loss,
+                'pre_target_loss_update_acc': pre_target_loss_update_acc,
+                'post_target_loss_update_loss': post_target_loss_update_loss,
+                'post_target_loss_update_acc': post_target_loss_update_acc,
+                'support_set_steps_taken': [torch.tensor(support_set_steps_taken or [self.num_support_set_steps],
+                                                         dtype=torch.float32, device=self.device).mean()]}
 
-            pre_target_loss_update_loss.append(target_set_loss)
-            pre_softmax_target_preds = F.softmax(target_outputs['preds'], dim=1).argmax(dim=1)
-            pre_update_accuracy = torch.eq(pre_softmax_target_preds,
-                                           y_target_set_task).data.cpu().float().mean()
-            pre_target_loss_update_acc.append(pre_update_accuracy)
+    def forward(self, data_batch, epoch, use_second_order, use_multi_step_loss_optimization, num_steps, training_phase):
+        """
+        Runs a forward outer loop pass on the batch of tasks using the MAML/++ framework.
+        :param data_batch: A data batch containing the support and target sets.
+        :param epoch: Current epoch's index
+        :param use_second_order: A boolean saying whether to use second order derivatives.
+        :param use_multi_step_loss_optimization: Whether to optimize on the outer loop using just the last step's
+        target loss (True) or whether to use multi step loss which improves the stability of the system (False)
+        :param num_steps: Number of inner loop steps.
+        :param training_phase: Whether this is a training phase (True) or an evaluation phase (False)
+        :return: A dictionary with the collected losses of the current outer forward propagation.
+        """
 
-            post_target_loss_update_loss.append(post_update_loss)
-            post_softmax_target_preds = F.softmax(post_update_target_preds, dim=1).argmax(dim=1)
-            post_update_accuracy = torch.eq(post_softmax_target_preds,
-                                            y_target_set_task).data.cpu().float().mean()
-            post_target_loss_update_acc.append(post_update_accuracy)
+        x_support_set, x_target_set, y_support_set, y_target_set, _, _ = data_batch
 
-            loss = target_outputs['loss'] * importance_vector[0] + post_update_loss * importance_vector[1]
+        self.classifier.zero_grad()
+        self.classifier_requires_double_backward = self.requires_double_backward(use_second_order=use_second_order,
+                                                                                 training_phase=training_phase)
+        graph_free = self.use_graph_free_evaluation(training_phase=training_phase)
 
-            total_per_step_losses.append(loss)
-            total_per_step_accuracies.append(post_update_accuracy)
+        num_losses = 2
+        importance_vector = torch.Tensor([1.0 / num_losses for i in range(num_losses)]).to(self.device)
+        step_magnitude = (1.0 / num_losses) / self.total_epochs
+        current_epoch_step_magnitude = torch.ones(1).to(self.device) * (step_magnitude * (epoch + 1))
+        importance_vector[0] = importance_vector[0] - current_epoch_step_magnitude
+        importance_vector[1] = importance_vector[1] + current_epoch_step_magnitude
 
-            per_task_preds.append(post_update_target_preds.detach().cpu().numpy())
+        concurrent_tasks = self.use_concurrent_tasks(num_tasks=len(x_support_set), training_phase=training_phase)
+        if concurrent_tasks and not training_phase:
+            self.classifier.snapshot_batch_norm_stats()
 
-            if not training_phase:
-                self.classifier.restore_backup_stats()
+        stream_backward = self.use_streaming_task_backward(training_phase=training_phase)
+        if stream_backward:
+            # the tasks accumulate their meta-gradients as they finish, meta_update only steps the optimizer
+            self.optimizer.zero_grad()
+
+        task_outputs = self.run_tasks(
+            task_function=functools.partial(self.forward_task, use_second_order=use_second_order,
+                                            training_phase=training_phase, graph_free=graph_free,
+                                            importance_vector=importance_vector,
+                                            restore_batch_norm_stats=not training_phase and not concurrent_tasks,
+                                            backward_scale=1. / len(x_support_set) if stream_backward else None),
+            tasks=list(zip(x_support_set, y_support_set, x_target_set, y_target_set)),
+            training_phase=training_phase)
 
-                x_support_set_sub_task = x_support_set_sub_task.to(torch.device('cpu'))
-                y_support_set_sub_task = y_support_set_sub_task.to(torch.device('cpu'))
-                x_target_set_task = x_target_set_task.to(torch.device('cpu'))
-                y_target_set_task = y_target_set_task.to(torch.device('cpu'))
+        if concurrent_tasks and not training_phase:
+            self.classifier.restore_batch_norm_stats()
+
+        meta_batch_outputs = {key: [value for outputs in task_outputs for value in outputs[key]]
+                              for key in task_outputs[0]}
 
         loss_metric_dict = dict()
-        loss_metric_dict['pre_target_loss_update_loss'] = post_target_loss_update_loss
-        loss_metric_dict['pre_target_loss_update_acc'] = pre_target_loss_update_acc
-        loss_metric_dict['post_target_loss_update_loss'] = post_target_loss_update_loss
-        loss_metric_dict['post_target_loss_update_acc'] = post_target_loss_update_acc
+        loss_metric_dict['pre_target_loss_update_loss'] = meta_batch_outputs['post_target_loss_update_loss']
+        loss_metric_dict['pre_target_loss_update_acc'] = meta_batch_outputs['pre_target_loss_update_acc']
+        loss_metric_dict['post_target_loss_update_loss'] = meta_batch_outputs['post_target_loss_update_loss']
+        loss_metric_dict['post_target_loss_update_acc'] = meta_batch_outputs['post_target_loss_update_acc']
+        loss_metric_dict['support_set_steps_taken'] = meta_batch_outputs['support_set_steps_taken']
 
-        losses = self.get_across_task_loss_metrics(total_losses=total_per_step_losses,
-                                                   total_accuracies=total_per_step_accuracies,
-                                                   loss_metrics_dict=loss_metric_dict)
+        losses = self.get_across_task_loss_metrics(
+            total_losses=meta_batch_outputs['total_per_step_losses'],
+            total_accuracies=meta_batch_outputs['total_per_step_accuracies'], loss_metrics_dict=loss_metric_dict)
 
-        return losses, per_task_preds
+        return losses, torch.stack(meta_batch_outputs['per_task_preds'])
 
     def load_model(self, model_save_dir, model_name, model_idx):
         """
@@ -821,7 +1811,7 @@ class EmbeddingMAMLFewShotClassifier(MAMLFewShotClassifier):
 
         losses, per_task_preds = self.evaluation_forward_prop(data_batch=data_batch, epoch=self.current_epoch)
 
-        return losses, per_task_preds
+        return losses, per_task_preds.cpu().numpy()
 
     def save_model(self, model_save_dir, state):
         """
@@ -847,10 +1837,12 @@ class EmbeddingMAMLFewShotClassifier(MAMLFewShotClassifier):
         for name, value in loss_metrics_dict.items():
             losses[name] = torch.stack(value).mean()
 
-        for idx_num_step, (name, learning_rate_num_step) in enumerate(self.inner_loop_optimizer.named_parameters()):
-            for idx, learning_rate in enumerate(learning_rate_num_step.mean().view(1)):
-                losses['task_learning_rate_num_step_{}_{}'.format(idx_num_step,
-                                                                  name)] = learning_rate.detach().cpu().numpy()
+        # the learning rates stay on the device, to be copied to the host together with the rest of the metrics
+        named_learning_rates = list(self.inner_loop_optimizer.named_parameters())
+        learning_rates = torch.stack([learning_rate_num_step.mean() for name, learning_rate_num_step in
+                                      named_learning_rates]).detach()
+        for idx_num_step, (name, learning_rate_num_step) in enumerate(named_learning_rates):
+            losses['task_learning_rate_num_step_{}_{}'.format(idx_num_step, name)] = learning_rates[idx_num_step]
 
         return losses
 
@@ -972,6 +1964,7 @@ class VGGMAMLFewShotClassifier(MAMLFewShotClassifier):
             learnable_learning_rates=self.learnable_learning_rates,
             init_learning_rate=self.init_learning_rate)
 
+        names_weights_copy = self.build_low_rank_fast_weights(names_weights_copy)
         self.inner_loop_optimizer.initialise(names_weights_dict=names_weights_copy)
         print("Inner Loop parameters")
         for key, value in self.inner_loop_optimizer.named_parameters():
@@ -993,6 +1986,10 @@ class VGGMAMLFewShotClassifier(MAMLFewShotClassifier):
                 num_params += product
         print('Total Memory parameters', num_params)
 
+        if self.ridge_regression_head:
+            self.ridge_regression_layer = RidgeRegressionHead(num_output_classes=output_units,
+                                                              init_lambda=self.ridge_regression_init_lambda)
+
         self.exclude_list = None
         self.switch_opt_params(exclude_list=self.exclude_list)
 
@@ -1007,6 +2004,9 @@ class VGGMAMLFewShotClassifier(MAMLFewShotClassifier):
             else:
                 self.to(self.device)
 
+        self.to_memory_format()
+        self.compile_classifier()
+
     def switch_opt_params(self, exclude_list):
         print("current trainable params")
         for name, param in self.trainable_names_parameters(exclude_params_with_string=exclude_list):
@@ -1035,28 +2035,32 @@ class VGGMAMLFewShotClassifier(MAMLFewShotClassifier):
         """
         outputs = {"loss": 0., "preds": 0, "features": 0.}
         if return_features:
-            outputs['preds'], outputs['features'] = self.classifier.forward(x=x, params=weights,
-                                                                            training=training,
-                                                                            backup_running_statistics=backup_running_statistics,
-                                                                            num_step=num_step,
-                                                                            return_features=return_features)
+            with self.autocast():
+                outputs['preds'], outputs['features'] = self.classifier_forward(x=x, params=weights,
+                                                                                training=training,
+                                                                                backup_running_statistics=backup_running_statistics,
+                                                                                num_step=num_step,
+                                                                                return_features=return_features)
             if type(outputs['preds']) == tuple:
                 if len(outputs['preds']) == 2:
                     outputs['preds'] = outputs['preds'][0]
 
+            outputs['preds'] = outputs['preds'].float()
             outputs['loss'] = F.cross_entropy(outputs['preds'], y)
 
 
         else:
-            outputs['preds'] = self.classifier.forward(x=x, params=weights,
-                                                       training=training,
-                                                       backup_running_statistics=backup_running_statistics,
-                                                       num_step=num_step)
+            with self.autocast():
+                outputs['preds'] = self.classifier_forward(x=x, params=weights,
+                                                           training=training,
+                                                           backup_running_statistics=backup_running_statistics,
+                                                           num_step=num_step)
 
             if type(outputs['preds']) == tuple:
                 if len(outputs['preds']) == 2:
                     outputs['preds'] = outputs['preds'][0]
 
+            outputs['preds'] = outputs['preds'].float()
             outputs['loss'] = F.cross_entropy(outputs['preds'], y)
 
         return outputs
@@ -1083,62 +2087,87 @@ class VGGMAMLFewShotClassifier(MAMLFewShotClassifier):
 
         return loss_weights
 
-    def forward(self, data_batch, epoch, use_second_order, use_multi_step_loss_optimization, num_steps, training_phase):
+    def forward_task(self, x_support_set_task, y_support_set_task, x_target_set_task, y_target_set_task,
+                     use_second_order, training_phase, graph_free, importance_vector, restore_batch_norm_stats,
+                     backward_scale=None):
         """
-        Runs a forward outer loop pass on the batch of tasks using the MAML/++ framework.
-        :param data_batch: A data batch containing the support and target sets.
-        :param epoch: Current epoch's index
+        Runs the inner loop and the target set losses of a single task of the meta batch. The tasks only share the
+        meta-parameters, so run_tasks can run them concurrently, each with its own autograd graph.
+        :param x_support_set_task: The support set images of the task.
+        :param y_support_set_task: The support set targets of the task.
+        :param x_target_set_task: The target set images of the task.
+        :param y_target_set_task: The target set targets of the task.
         :param use_second_order: A boolean saying whether to use second order derivatives.
-        :param use_multi_step_loss_optimization: Whether to optimize on the outer loop using just the last step's
-        target loss (True) or whether to use multi step loss which improves the stability of the system (False)
-        :param num_steps: Number of inner loop steps.
         :param training_phase: Whether this is a training phase (True) or an evaluation phase (False)
-        :return: A dictionary with the collected losses of the current outer forward propagation.
+        :param graph_free: Whether graph free evaluation is in use for the current forward pass.
+        :param importance_vector: The weights of the pre and post critic update target losses.
+        :param restore_batch_norm_stats: Whether to snapshot the batch norm statistics before the task and restore
+        them after it.
+        :param backward_scale: If not None, the task's outer loss is scaled by it and backpropagated into the
+        meta-gradients before returning, and only detached losses are returned, so that the task's graph is freed.
+        :return: A dictionary with the task's losses, accuracies and predictions, each in a list that forward
+        concatenates across the tasks of the meta batch.
         """
-
-        x_support_set, x_target_set, y_support_set, y_target_set, _, _ = data_batch
-
-        self.classifier.zero_grad()
-
         total_per_step_losses = []
-
         total_per_step_accuracies = []
-
         per_task_preds = []
-        num_losses = 2
-        importance_vector = torch.Tensor([1.0 / num_losses for i in range(num_losses)]).to(self.device)
-        step_magnitude = (1.0 / num_losses) / self.total_epochs
-        current_epoch_step_magnitude = torch.ones(1).to(self.device) * (step_magnitude * (epoch + 1))
-
-        importance_vector[0] = importance_vector[0] - current_epoch_step_magnitude
-        importance_vector[1] = importance_vector[1] + current_epoch_step_magnitude
-
         pre_target_loss_update_loss = []
         pre_target_loss_update_acc = []
         post_target_loss_update_loss = []
         post_target_loss_update_acc = []
-
-        for task_id, (x_support_set_task, y_support_set_task, x_target_set_task, y_target_set_task) in \
-                enumerate(zip(x_support_set,
-                              y_support_set,
-                              x_target_set,
-                              y_target_set)):
-
+        support_set_steps_taken = []
+
+        c, h, w = x_target_set_task.shape[-3:]
+        x_target_set_task = self.images_to_device(x_target_set_task.view(-1, c, h, w))
+        y_target_set_task = y_target_set_task.view(-1).to(self.device)
+        x_support_set_task = self.images_to_device(
+            x_support_set_task.view(-1, c, h, w)).view(x_support_set_task.shape)
+        if self.head_only_adaptation and not self.ridge_regression_head:
+            with self.graph_free_context(graph_free, inference_mode=False):
+                x_support_set_task = self.compute_support_set_trunk_features(x_support_set=x_support_set_task)
+                x_target_set_task = self.compute_trunk_features(x=x_target_set_task)
             c, h, w = x_target_set_task.shape[-3:]
-            x_target_set_task = x_target_set_task.view(-1, c, h, w).to(self.device)
-            y_target_set_task = y_target_set_task.view(-1).to(self.device)
-            target_set_per_step_loss = []
-            importance_weights = self.get_per_step_loss_importance_vector(current_epoch=self.current_epoch)
-            step_idx = 0
-
-            names_weights_copy = self.get_inner_loop_parameter_dict(self.classifier.named_parameters())
-            num_devices = torch.cuda.device_count() if torch.cuda.is_available() else 1
-
-            names_weights_copy = {
-              name.replace('module.', ''): value.unsqueeze(0).repeat(
-                  [num_devices] + [1 for i in range(len(value.shape))]) for
-              name, value in names_weights_copy.items()}
+        target_set_per_step_loss = []
+        importance_weights = self.get_per_step_loss_importance_vector(current_epoch=self.current_epoch)
+        step_idx = 0
+        last_support_step_idx = 0
 
+        names_weights_copy = self.get_inner_loop_parameter_dict(self.classifier.named_parameters())
+        num_devices = torch.cuda.device_count() if torch.cuda.is_available() else 1
+
+        names_weights_copy = {
+          name.replace('module.', ''): value.unsqueeze(0).repeat(
+              [num_devices] + [1 for i in range(len(value.shape))]) for
+          name, value in names_weights_copy.items()}
+        names_weights_copy = self.to_low_rank_fast_weights(self.select_adapted_weights(names_weights_copy))
+        if graph_free:
+            names_weights_copy = {name: value.detach().requires_grad_() for name, value in
+                                  names_weights_copy.items()}
+        if restore_batch_norm_stats:
+            self.classifier.snapshot_batch_norm_stats()
+        initial_names_weights_copy = names_weights_copy
+        detach_inner_loop_history = graph_free or self.uses_first_order_meta_gradient()
+
+        if self.ridge_regression_head:
+            return self.ridge_regression_forward_task(
+                x_support_set_task=x_support_set_task, y_support_set_task=y_support_set_task.to(self.device),
+                x_target_set_task=x_target_set_task, y_target_set_task=y_target_set_task, graph_free=graph_free,
+                restore_batch_norm_stats=restore_batch_norm_stats, backward_scale=backward_scale)
+
+        if self.use_inner_loop_checkpointing(use_second_order=use_second_order, training_phase=training_phase,
+                                             detach_inner_loop_history=detach_inner_loop_history):
+            x_support_set_sub_tasks = x_support_set_task.view(self.num_support_sets, -1, c, h, w).to(self.device)
+            y_support_set_sub_tasks = y_support_set_task.view(self.num_support_sets, -1).to(self.device)
+            task_embedding = None
+
+            for segment_start in range(0, self.num_support_sets, self.inner_loop_checkpoint_interval):
+                segment_end = min(segment_start + self.inner_loop_checkpoint_interval, self.num_support_sets)
+                names_weights_copy = self.checkpoint_support_set_steps(
+                    x_support_set_sub_tasks=x_support_set_sub_tasks[segment_start:segment_end],
+                    y_support_set_sub_tasks=y_support_set_sub_tasks[segment_start:segment_end],
+                    names_weights_copy=names_weights_copy, use_second_order=use_second_order, step_idx=step_idx)
+                step_idx += (segment_end - segment_start) * self.num_support_set_steps
+        else:
             for sub_task_id, (x_support_set_sub_task, y_support_set_sub_task) in \
                     enumerate(zip(x_support_set_task,
                                   y_support_set_task)):
@@ -1160,6 +2189,8 @@ class VGGMAMLFewShotClassifier(MAMLFewShotClassifier):
                 else:
                     task_embedding = None
 
+                previous_support_loss = None
+                num_steps_taken = 0
                 for num_step in range(self.num_support_set_steps):
                     support_outputs = self.net_forward(x=x_support_set_sub_task,
                                                        y=y_support_set_sub_task,
@@ -1170,86 +2201,223 @@ class VGGMAMLFewShotClassifier(MAMLFewShotClassifier):
                                                        num_step=step_idx,
                                                        return_features=True)
 
-                    names_weights_copy = self.apply_inner_loop_update(loss=support_outputs['loss'],
+                    truncate_step = not detach_inner_loop_history and self.outside_meta_backprop_horizon(
+                        step=sub_task_id * self.num_support_set_steps + num_step,
+                        num_steps=self.num_support_sets * self.num_support_set_steps,
+                        meta_backprop_horizon=self.meta_backprop_horizon)
+                    last_support_step_idx = step_idx
+                    support_loss = support_outputs['loss']
+                    if self.meta_gradient_type == 'imaml':
+                        support_loss = support_loss + self.get_proximal_loss(names_weights_copy,
+                                                                             initial_names_weights_copy)
+
+                    names_weights_copy = self.apply_inner_loop_update(loss=support_loss,
                                                                       names_weights_copy=names_weights_copy,
                                                                       use_second_order=use_second_order,
-                                                                      current_step_idx=step_idx)
+                                                                      current_step_idx=step_idx,
+                                                                      detach_inner_loop_history=
+                                                                      detach_inner_loop_history,
+                                                                      anchor_names_weights_copy=
+                                                                      initial_names_weights_copy if
+                                                                      truncate_step else None)
                     step_idx += 1
 
                     if self.use_multi_step_loss_optimization:
-                        target_outputs = self.net_forward(x=x_target_set_task,
-                                                          y=y_target_set_task, weights=names_weights_copy,
-                                                          backup_running_statistics=False, training=True,
-                                                          num_step=step_idx,
-                                                          return_features=True)
+                        with self.graph_free_context(graph_free and self.num_target_set_steps == 0):
+                            target_outputs = self.net_forward(x=x_target_set_task,
+                                                              y=y_target_set_task,
+                                                              weights=self.get_outer_loop_weights(
+                                                                  names_weights_copy, initial_names_weights_copy),
+                                                              backup_running_statistics=False, training=True,
+                                                              num_step=step_idx,
+                                                              return_features=True)
                         target_set_per_step_loss.append(target_outputs['loss'])
                         step_idx += 1
 
-            if not self.use_multi_step_loss_optimization:
+                    num_steps_taken += 1
+                    if self.support_set_converged(support_outputs=support_outputs,
+                                                  y_support_set=y_support_set_sub_task,
+                                                  previous_support_loss=previous_support_loss,
+                                                  num_steps_taken=num_steps_taken, training_phase=training_phase):
+                        num_skipped_steps = self.num_support_set_steps - num_steps_taken
+                        # the fast weights stay the same over the skipped steps, the later steps keep their step
+                        # indexes
+                        step_idx += num_skipped_steps
+                        if self.use_multi_step_loss_optimization:
+                            target_set_per_step_loss.extend([target_set_per_step_loss[-1]] * num_skipped_steps)
+                            step_idx += num_skipped_steps
+                        break
+                    previous_support_loss = support_outputs['loss'].detach()
+
+                support_set_steps_taken.append(num_steps_taken)
+
+        if not self.use_multi_step_loss_optimization:
+            # the critic steps differentiate through the last target set pass
+            with self.graph_free_context(graph_free and self.num_target_set_steps == 0):
                 target_outputs = self.net_forward(x=x_target_set_task,
-                                                  y=y_target_set_task, weights=names_weights_copy,
+                                                  y=y_target_set_task,
+                                                  weights=self.get_outer_loop_weights(names_weights_copy,
+                                                                                      initial_names_weights_copy),
                                                   backup_running_statistics=False, training=True,
                                                   num_step=step_idx,
                                                   return_features=True)
-                target_set_loss = target_outputs['loss']
-                step_idx += 1
-            else:
+            target_set_loss = target_outputs['loss']
+            step_idx += 1
+        else:
 
-                target_set_loss = torch.sum(
-                    torch.stack(target_set_per_step_loss, dim=0) * importance_weights)
+            target_set_loss = torch.sum(
+                torch.stack(target_set_per_step_loss, dim=0) * importance_weights)
 
 
-            for num_step in range(self.num_target_set_steps):
+        critic_anchor_names_weights_copy = names_weights_copy
+        # the target set loss of the critic steps is part of the outer loop loss, so the critic updates keep its graph
+        # alive, including the first order ones and the ones truncated by critic_meta_backprop_horizon
+        for num_step in range(self.num_target_set_steps):
+            # under implicit MAML the critic steps are treated as first order steps from the fixed point
+            truncate_step = self.meta_gradient_type == 'imaml' or (
+                    not detach_inner_loop_history and self.outside_meta_backprop_horizon(
+                step=num_step, num_steps=self.num_target_set_steps,
+                meta_backprop_horizon=self.critic_meta_backprop_horizon))
+            with self.autocast():
                 predicted_loss = self.critic_network.forward(logits=target_outputs['preds'],
                                                              task_embedding=task_embedding)
+            predicted_loss = predicted_loss.float()
+
+            names_weights_copy = self.apply_inner_loop_update(loss=predicted_loss,
+                                                              names_weights_copy=names_weights_copy,
+                                                              use_second_order=use_second_order,
+                                                              current_step_idx=step_idx,
+                                                              detach_inner_loop_history=detach_inner_loop_history,
+                                                              anchor_names_weights_copy=
+                                                              critic_anchor_names_weights_copy if
+                                                              truncate_step else None,
+                                                              retain_graph=True)
+            step_idx += 1
+
+
+        post_update_loss, post_update_target_preds, post_updated_target_features = target_set_loss, \
+                                                                                       target_outputs['preds'], \
+                                                                                       target_outputs[
+                                                                                           'features']
+
+        pre_target_loss_update_loss.append(target_set_loss)
+        pre_softmax_target_preds = F.softmax(target_outputs['preds'], dim=1).argmax(dim=1)
+        pre_update_accuracy = torch.eq(pre_softmax_target_preds, y_target_set_task).float().mean()
+        pre_target_loss_update_acc.append(pre_update_accuracy)
+
+        post_target_loss_update_loss.append(post_update_loss)
+        post_softmax_target_preds = F.softmax(post_update_target_preds, dim=1).argmax(dim=1)
+        post_update_accuracy = torch.eq(post_softmax_target_preds, y_target_set_task).float().mean()
+        post_target_loss_update_acc.append(post_update_accuracy)
+
+        post_softmax_target_preds = F.softmax(post_update_target_preds, dim=1).argmax(dim=1)
+        post_update_accuracy = torch.eq(post_softmax_target_preds, y_target_set_task).float().mean()
+        post_target_loss_update_acc.append(post_update_accuracy)
+
+        loss = target_outputs['loss']  # * importance_vector[0] + post_update_loss * importance_vector[1]
+
+        if self.meta_gradient_type == 'reptile':
+            loss = loss + self.get_reptile_loss(names_weights_copy, initial_names_weights_copy)
+        elif self.meta_gradient_type == 'imaml' and training_phase:
+            loss = loss + self.get_implicit_meta_gradient_loss(
+                target_loss=loss,
+                x_support_set=x_support_set_task.view(-1, c, h, w).to(self.device),
+                y_support_set=y_support_set_task.view(-1).to(self.device),
+                num_step=last_support_step_idx,
+                names_weights_copy=critic_anchor_names_weights_copy,
+                initial_names_weights_copy=initial_names_weights_copy)
+
+        if graph_free:
+            loss = loss.detach()
+
+        if backward_scale is not None:
+            (loss * backward_scale).backward()
+            loss = loss.detach()
+            pre_target_loss_update_loss = [value.detach() for value in pre_target_loss_update_loss]
+            post_target_loss_update_loss = [value.detach() for value in post_target_loss_update_loss]
+
+        total_per_step_losses.append(loss)
+        total_per_step_accuracies.append(post_update_accuracy)
+
+        per_task_preds.append(post_update_target_preds.detach())
+
+        if restore_batch_norm_stats:
+            self.classifier.restore_batch_norm_stats()
+
+        return {'total_per_step_losses': total_per_step_losses,
+                'total_per_step_accuracies': total_per_step_accuracies,
+                'per_task_preds': per_task_preds,
+                'pre_target_loss_update_loss': pre_target_loss_update_loss,
+                'pre_target_loss_update_acc': pre_target_loss_update_acc,
+                'post_target_loss_update_loss': post_target_loss_update_loss,
+                'post_target_loss_update_acc': post_target_loss_update_acc,
+                'support_set_steps_taken': [torch.tensor(support_set_steps_taken or [self.num_support_set_steps],
+                                                         dtype=torch.float32, device=self.device).mean()]}
 
-                names_weights_copy = self.apply_inner_loop_update(loss=predicted_loss,
-                                                                  names_weights_copy=names_weights_copy,
-                                                                  use_second_order=use_second_order,
-                                                                  current_step_idx=step_idx)
-                step_idx += 1
+    def forward(self, data_batch, epoch, use_second_order, use_multi_step_loss_optimization, num_steps, training_phase):
+        """
+        Runs a forward outer loop pass on the batch of tasks using the MAML/++ framework.
+        :param data_batch: A data batch containing the support and target sets.
+        :param epoch: Current epoch's index
+        :param use_second_order: A boolean saying whether to use second order derivatives.
+        :param use_multi_step_loss_optimization: Whether to optimize on the outer loop using just the last step's
+        target loss (True) or whether to use multi step loss which improves the stability of the system (False)
+        :param num_steps: Number of inner loop steps.
+        :param training_phase: Whether this is a training phase (True) or an evaluation phase (False)
+        :return: A dictionary with the collected losses of the current outer forward propagation.
+        """
 
+        x_support_set, x_target_set, y_support_set, y_target_set, _, _ = data_batch
 
-            post_update_loss, post_update_target_preds, post_updated_target_features = target_set_loss, \
-                                                                                           target_outputs['preds'], \
-                                                                                           target_outputs[
-                                                                                               'features']
+        self.classifier.zero_grad()
+        self.classifier_requires_double_backward = self.requires_double_backward(use_second_order=use_second_order,
+                                                                                 training_phase=training_phase)
+        graph_free = self.use_graph_free_evaluation(training_phase=training_phase)
 
-            pre_target_loss_update_loss.append(target_set_loss)
-            pre_softmax_target_preds = F.softmax(target_outputs['preds'], dim=1).argmax(dim=1)
-            pre_update_accuracy = torch.eq(pre_softmax_target_preds, y_target_set_task).data.cpu().float().mean()
-            pre_target_loss_update_acc.append(pre_update_accuracy)
+        num_losses = 2
+        importance_vector = torch.Tensor([1.0 / num_losses for i in range(num_losses)]).to(self.device)
+        step_magnitude = (1.0 / num_losses) / self.total_epochs
+        current_epoch_step_magnitude = torch.ones(1).to(self.device) * (step_magnitude * (epoch + 1))
 
-            post_target_loss_update_loss.append(post_update_loss)
-            post_softmax_target_preds = F.softmax(post_update_target_preds, dim=1).argmax(dim=1)
-            post_update_accuracy = torch.eq(post_softmax_target_preds, y_target_set_task).data.cpu().float().mean()
-            post_target_loss_update_acc.append(post_update_accuracy)
+        importance_vector[0] = importance_vector[0] - current_epoch_step_magnitude
+        importance_vector[1] = importance_vector[1] + current_epoch_step_magnitude
 
-            post_softmax_target_preds = F.softmax(post_update_target_preds, dim=1).argmax(dim=1)
-            post_update_accuracy = torch.eq(post_softmax_target_preds, y_target_set_task).data.cpu().float().mean()
-            post_target_loss_update_acc.append(post_update_accuracy)
+        concurrent_tasks = self.use_concurrent_tasks(num_tasks=len(x_support_set), training_phase=training_phase)
+        if concurrent_tasks and not training_phase:
+            self.classifier.snapshot_batch_norm_stats()
 
-            loss = target_outputs['loss']  # * importance_vector[0] + post_update_loss * importance_vector[1]
+        stream_backward = self.use_streaming_task_backward(training_phase=training_phase)
+        if stream_backward:
+            # the tasks accumulate their meta-gradients as they finish, meta_update only steps the optimizer
+            self.optimizer.zero_grad()
 
-            total_per_step_losses.append(loss)
-            total_per_step_accuracies.append(post_update_accuracy)
+        task_outputs = self.run_tasks(
+            task_function=functools.partial(self.forward_task, use_second_order=use_second_order,
+                                            training_phase=training_phase, graph_free=graph_free,
+                                            importance_vector=importance_vector,
+                                            restore_batch_norm_stats=not training_phase and not concurrent_tasks,
+                                            backward_scale=1. / len(x_support_set) if stream_backward else None),
+            tasks=list(zip(x_support_set, y_support_set, x_target_set, y_target_set)),
+            training_phase=training_phase)
 
-            per_task_preds.append(post_update_target_preds.detach().cpu().numpy())
+        if concurrent_tasks and not training_phase:
+            self.classifier.restore_batch_norm_stats()
 
-            if not training_phase:
-                self.classifier.restore_backup_stats()
+        meta_batch_outputs = {key: [value for outputs in task_outputs for value in outputs[key]]
+                              for key in task_outputs[0]}
 
         loss_metric_dict = dict()
-        loss_metric_dict['pre_target_loss_update_loss'] = post_target_loss_update_loss
-        loss_metric_dict['pre_target_loss_update_acc'] = pre_target_loss_update_acc
-        loss_metric_dict['post_target_loss_update_loss'] = post_target_loss_update_loss
-        loss_metric_dict['post_target_loss_update_acc'] = post_target_loss_update_acc
+        loss_metric_dict['pre_target_loss_update_loss'] = meta_batch_outputs['post_target_loss_update_loss']
+        loss_metric_dict['pre_target_loss_update_acc'] = meta_batch_outputs['pre_target_loss_update_acc']
+        loss_metric_dict['post_target_loss_update_loss'] = meta_batch_outputs['post_target_loss_update_loss']
+        loss_metric_dict['post_target_loss_update_acc'] = meta_batch_outputs['post_target_loss_update_acc']
+        loss_metric_dict['support_set_steps_taken'] = meta_batch_outputs['support_set_steps_taken']
 
-        losses = self.get_across_task_loss_metrics(total_losses=total_per_step_losses,
-                                                   total_accuracies=total_per_step_accuracies,
-                                                   loss_metrics_dict=loss_metric_dict)
+        losses = self.get_across_task_loss_metrics(
+            total_losses=meta_batch_outputs['total_per_step_losses'],
+            total_accuracies=meta_batch_outputs['total_per_step_accuracies'], loss_metrics_dict=loss_metric_dict)
 
-        return losses, per_task_preds
+        return losses, torch.stack(meta_batch_outputs['per_task_preds'])
 
     def load_model(self, model_save_dir, model_name, model_idx):
         """
@@ -1311,7 +2479,7 @@ class VGGMAMLFewShotClassifier(MAMLFewShotClassifier):
 
         losses, per_task_preds = self.evaluation_forward_prop(data_batch=data_batch, epoch=self.current_epoch)
 
-        return losses, per_task_preds
+        return losses, per_task_preds.cpu().numpy()
 
     def save_model(self, model_save_dir, state):
         """
@@ -1337,30 +2505,26 @@ class VGGMAMLFewShotClassifier(MAMLFewShotClassifier):
         for name, value in loss_metrics_dict.items():
             losses[name] = torch.stack(value).mean()
 
-        for idx_num_step, (name, learning_rate_num_step) in enumerate(self.inner_loop_optimizer.named_parameters()):
-            for idx, learning_rate in enumerate(learning_rate_num_step.mean().view(1)):
-                losses['task_learning_rate_num_step_{}_{}'.format(idx_num_step,
-                                                                  name)] = learning_rate.detach().cpu().numpy()
+        # the learning rates stay on the device, to be copied to the host together with the rest of the metrics
+        named_learning_rates = list(self.inner_loop_optimizer.named_parameters())
+        learning_rates = torch.stack([learning_rate_num_step.mean() for name, learning_rate_num_step in
+                                      named_learning_rates]).detach()
+        for idx_num_step, (name, learning_rate_num_step) in enumerate(named_learning_rates):
+            losses['task_learning_rate_num_step_{}_{}'.format(idx_num_step, name)] = learning_rates[idx_num_step]
 
         return losses
 
 
 def calculate_cosine_distance(support_set_embeddings, support_set_labels, target_set_embeddings):
-    eps = 1e-10
-
-    per_task_similarities = []
-    for support_set_embedding_task, target_set_embedding_task in zip(support_set_embeddings, target_set_embeddings):
-        target_set_embedding_task = target_set_embedding_task  # sb, f
-        support_set_embedding_task = support_set_embedding_task  # num_classes, f
-
-        dot_product = torch.stack(
-            [torch.matmul(target_set_embedding_task, support_vector) for support_vector in support_set_embedding_task],
-            dim=1)
-        cosine_similarity = dot_product
-        cosine_similarity = cosine_similarity.squeeze()
-        per_task_similarities.append(cosine_similarity)
-
-    similarities = torch.stack(per_task_similarities)
+    """
+    Computes the similarities between the target set embeddings and the per class support set embeddings of every
+    task in the meta-batch, with a single batched matrix multiplication.
+    :param support_set_embeddings: The per class support set embeddings, of shape (b, num_classes, f)
+    :param support_set_labels: The one hot support set labels (unused, the embeddings are already per class).
+    :param target_set_embeddings: The target set embeddings, of shape (b, num_target_samples, f)
+    :return: The predictions and the similarities, both of shape (b, num_target_samples, num_classes)
+    """
+    similarities = torch.bmm(target_set_embeddings, support_set_embeddings.transpose(1, 2))
     preds = similarities
     return preds, similarities
 
@@ -1416,7 +2580,7 @@ class MatchingNetworkFewShotClassifier(nn.Module):
 
         self.scheduler = optim.lr_scheduler.CosineAnnealingLR(optimizer=self.optimizer, T_max=self.total_epochs,
                                                               eta_min=self.min_learning_rate)
-        self.to(self.device)
+        self.to(device=self.device, memory_format=getattr(torch, self.memory_format))
 
 
     def trainable_names_parameters(self, exclude_params_with_string=None):
@@ -1441,10 +2605,14 @@ class MatchingNetworkFewShotClassifier(nn.Module):
         data_batch = [item.to(self.device) for item in data_batch]
 
         x_support_set, x_target_set, y_support_set, y_target_set, _, _ = data_batch
+        # the tasks of this rank's shard of the meta batch, batch_size of them when not distributed
+        num_tasks = len(x_support_set)
 
         x_support_set = x_support_set.view(-1, x_support_set.shape[-3], x_support_set.shape[-2],
                                            x_support_set.shape[-1])
         x_target_set = x_target_set.view(-1, x_target_set.shape[-3], x_target_set.shape[-2], x_target_set.shape[-1])
+        x_support_set = x_support_set.contiguous(memory_format=getattr(torch, self.memory_format))
+        x_target_set = x_target_set.contiguous(memory_format=getattr(torch, self.memory_format))
         y_support_set = y_support_set.view(-1)
         y_target_set = y_target_set.view(-1)
 
@@ -1453,36 +2621,29 @@ class MatchingNetworkFewShotClassifier(nn.Module):
 
         y_support_set_one_hot = int_to_one_hot(y_support_set)
 
-        g_encoded_images = []
-
         h, w, c = x_support_set.shape[-3:]
 
-        x_support_set = x_support_set.view(size=(self.batch_size, -1, h, w, c))
-        x_target_set = x_target_set.view(size=(self.batch_size, -1, h, w, c))
-        y_support_set = y_support_set.view(size=(self.batch_size, -1))
-        y_target_set = y_target_set.view(self.batch_size, -1)
-
-        for x_support_set_task, y_support_set_task in zip(x_support_set,
-                                                          y_support_set):  # produce embeddings for support set images
-
-            support_set_cnn_embed, _ = self.classifier.forward(x=x_support_set_task)  # nsc * nc, h, w, c
-            per_class_embeddings = torch.zeros(
-                (output_units, int(np.prod(support_set_cnn_embed.shape) / (self.num_classes_per_set
-                                                                           * support_set_cnn_embed.shape[-1])),
-                 support_set_cnn_embed.shape[-1])).to(x_support_set_task.device)
-
-            counter_dict = defaultdict(lambda: 0)
-
-            for x, y in zip(support_set_cnn_embed, y_support_set_task):
-                counter_dict[y % output_units] += 1
-                per_class_embeddings[y % output_units][counter_dict[y % output_units] - 1] = x
-
-            per_class_embeddings = per_class_embeddings.mean(1)
-            g_encoded_images.append(per_class_embeddings)
+        x_support_set = x_support_set.view(size=(num_tasks, -1, h, w, c))
+        x_target_set = x_target_set.view(size=(num_tasks, -1, h, w, c))
+        y_support_set = y_support_set.view(size=(num_tasks, -1))
+        y_target_set = y_target_set.view(num_tasks, -1)
+
+        # produce embeddings for support set images, one pass per task to keep per task batch norm statistics
+        support_set_cnn_embed = torch.cat([self.classifier.forward(x=x_support_set_task)[0] for x_support_set_task in
+                                           x_support_set], dim=0)  # b * nsc * nc, f
+
+        # each class embedding is the sum of its support embeddings divided by the number of per class slots
+        # (num_support_samples / num_classes_per_set), as unused slots count as zero embeddings
+        num_slots_per_class = int(x_support_set.shape[1] / self.num_classes_per_set)
+        task_offsets = torch.arange(num_tasks, device=y_support_set.device).unsqueeze(1) * output_units
+        class_indexes = (y_support_set.long() % output_units + task_offsets).view(-1)
+        g_encoded_images = torch.zeros((num_tasks * output_units, support_set_cnn_embed.shape[-1]),
+                                       dtype=support_set_cnn_embed.dtype, device=support_set_cnn_embed.device)
+        g_encoded_images = g_encoded_images.index_add(0, class_indexes, support_set_cnn_embed) / num_slots_per_class
+        g_encoded_images = g_encoded_images.view(num_tasks, output_units, -1)
 
         f_encoded_image, _ = self.classifier.forward(x=x_target_set.view(-1, h, w, c))
-        f_encoded_image = f_encoded_image.view(self.batch_size, -1, f_encoded_image.shape[-1])
-        g_encoded_images = torch.stack(g_encoded_images, dim=0)
+        f_encoded_image = f_encoded_image.view(num_tasks, -1, f_encoded_image.shape[-1])
 
         preds, similarities = calculate_cosine_distance(support_set_embeddings=g_encoded_images,
                                                         support_set_labels=y_support_set_one_hot.float(),
@@ -1498,7 +2659,7 @@ class MatchingNetworkFewShotClassifier(nn.Module):
         losses['loss'] = loss
         losses['accuracy'] = accuracy
 
-        return losses, preds.view(self.batch_size,
+        return losses, preds.view(num_tasks,
                                   self.num_support_sets * self.num_classes_per_set *
                                   self.num_samples_per_target_class,
                                   output_units)
@@ -1549,6 +2710,8 @@ class MatchingNetworkFewShotClassifier(nn.Module):
         """
         self.optimizer.zero_grad()
         loss.backward()
+        if is_distributed():
+            all_reduce_gradients(self.trainable_parameters(exclude_list=[]))
         self.optimizer.step()
 
     def run_train_iter(self, data_batch, epoch, current_iter):
@@ -1740,7 +2903,8 @@ class FineTuneFromPretrainedFewShotClassifier(MAMLFewShotClassifier):
                 im_shape=torch.cat([x_support_set, x_target_set], dim=0).shape, num_filters=self.num_filters,
                 num_blocks_per_stage=self.num_blocks_per_stage,
                 num_stages=self.num_stages, average_pool_outputs=False, dropout_rate=self.dropout_rate,
-                output_spatial_dimensionality=self.output_spatial_dimensionality, use_channel_wise_attention=True)
+                output_spatial_dimensionality=self.output_spatial_dimensionality, use_channel_wise_attention=True,
+                memory_efficient=self.dense_net_memory_efficient)
 
             task_features = self.dense_net_embedding.forward(
                 x=torch.cat([x_support_set, x_target_set], dim=0), dropout_training=True)
@@ -1828,6 +2992,10 @@ class FineTuneFromPretrainedFewShotClassifier(MAMLFewShotClassifier):
         self.scheduler = optim.lr_scheduler.CosineAnnealingLR(optimizer=self.optimizer, T_max=self.total_epochs,
                                                               eta_min=self.min_learning_rate)
 
+    def use_streaming_task_backward(self, training_phase):
+        # the fine tuning baselines backpropagate the mean loss of the meta batch in meta_update
+        return False
+
     def net_forward(self, x, y, weights, backup_running_statistics, training, num_step,
                     return_features=False):
         """
@@ -2308,7 +3476,8 @@ class FineTuneFromScratchFewShotClassifier(MAMLFewShotClassifier):
                 im_shape=torch.cat([x_support_set, x_target_set], dim=0).shape, num_filters=self.num_filters,
                 num_blocks_per_stage=self.num_blocks_per_stage,
                 num_stages=self.num_stages, average_pool_outputs=False, dropout_rate=self.dropout_rate,
-                output_spatial_dimensionality=self.output_spatial_dimensionality, use_channel_wise_attention=True)
+                output_spatial_dimensionality=self.output_spatial_dimensionality, use_channel_wise_attention=True,
+                memory_efficient=self.dense_net_memory_efficient)
 
             task_features = self.dense_net_embedding.forward(
                 x=torch.cat([x_support_set, x_target_set], dim=0), dropout_training=True)
@@ -2396,6 +3565,10 @@ class FineTuneFromScratchFewShotClassifier(MAMLFewShotClassifier):
         self.scheduler = optim.lr_scheduler.CosineAnnealingLR(optimizer=self.optimizer, T_max=self.total_epochs,
                                                               eta_min=self.min_learning_rate)
 
+    def use_streaming_task_backward(self, training_phase):
+        # the fine tuning baselines backpropagate the mean loss of the meta batch in meta_update
+        return False
+
     def net_forward(self, x, y, weights, backup_running_statistics, training, num_step,
                     return_features=False):
         """
@@ -1,6 +1,5 @@
 import logging
 import math
-from copy import copy
 
 import numpy as np
 import torch
@@ -8,6 +7,8 @@ import torch.nn as nn
 import torch.nn.functional as F
 from torch.nn.init import _calculate_fan_in_and_fan_out
 
+from pytorch_utils import factorized_pairwise_relations, woodbury_ridge_update
+
 
 def extract_top_level_dict(current_dict):
     """
@@ -48,6 +49,26 @@ def extract_params_and_check_for_missing_keys(current_dict, layer_dict):
     return params_dict
 
 
+def clear_grads(names_params_dict):
+    """
+    Clears the gradients of the given parameters by setting them to None, without reading them back from the device.
+    Only leaf tensors are touched, as the fast weights of the inner loop never accumulate gradients. With logging at
+    DEBUG level the parameters holding non zero gradients are logged first, using a single device sync.
+    :param names_params_dict: A dictionary of names to parameters.
+    """
+    names_params = [(name, param) for name, param in names_params_dict.items()
+                    if param.is_leaf and param.grad is not None]
+
+    if len(names_params) > 0 and logging.getLogger().isEnabledFor(logging.DEBUG):
+        non_zero = torch.stack([param.grad.detach().abs().sum() for name, param in names_params]).ne(0).tolist()
+        for (name, param), is_non_zero in zip(names_params, non_zero):
+            if is_non_zero:
+                logging.debug("clearing non zero gradient of {}".format(name))
+
+    for name, param in names_params:
+        param.grad = None
+
+
 class MetaConv1dLayer(nn.Module):
     def __init__(self, in_channels, out_channels, kernel_size, stride, padding, use_bias, groups=1, dilation_rate=1):
         """
@@ -130,6 +151,7 @@ class MetaConv2dLayer(nn.Module):
             self.bias = nn.Parameter(torch.zeros(num_filters), requires_grad=True)
 
         self.groups = groups
+        self.weight_memory_format = torch.contiguous_format
 
     def forward(self, x, params=None):
         """
@@ -153,6 +175,8 @@ class MetaConv2dLayer(nn.Module):
             else:
                 weight = self.weight
                 bias = None
+        # fast weights are created in the default format, a no-op unless the layer runs in channels_last
+        weight = weight.contiguous(memory_format=self.weight_memory_format)
         out = F.conv2d(input=x, weight=weight, bias=bias, stride=self.stride,
                        padding=self.padding, dilation=self.dilation_rate, groups=self.groups)
         return out
@@ -224,6 +248,58 @@ class MetaLinearLayer(nn.Module):
             self.bias.data = self.bias.data * 0.
 
 
+class RidgeRegressionHead(nn.Module):
+    def __init__(self, num_output_classes, init_lambda=1.0, init_logit_scale=10.0):
+        """
+        A classifier head fitted in closed form with ridge regression onto one hot targets (as in R2-D2), instead of
+        with inner loop gradient steps. The regularization strength and an output scale and bias are meta-learned.
+        The fit is updated incrementally, one support set at a time, see woodbury_ridge_update.
+        :param num_output_classes: The number of output classes.
+        :param init_lambda: The initial regularization strength.
+        :param init_logit_scale: The initial scale of the regression outputs, which are used as logits.
+        """
+        super(RidgeRegressionHead, self).__init__()
+        self.num_output_classes = num_output_classes
+        self.log_lambda = nn.Parameter(torch.ones(1) * math.log(init_lambda))
+        self.logit_scale = nn.Parameter(torch.ones(1) * init_logit_scale)
+        self.logit_bias = nn.Parameter(torch.zeros(1))
+
+    def initial_state(self, num_features, device):
+        """
+        Returns the fit before any support samples are seen, a tuple of the inverse gram matrix and the weights.
+        :param num_features: The dimensionality of the features.
+        :param device: The device of the features.
+        """
+        inverse_gram = torch.eye(num_features, device=device) / torch.exp(self.log_lambda)
+        weights = torch.zeros((num_features, self.num_output_classes), device=device)
+
+        return inverse_gram, weights
+
+    def update(self, state, x, y):
+        """
+        Updates the fit with a support set.
+        :param state: The current fit, as returned by initial_state or update.
+        :param x: The support set features, of shape b, f.
+        :param y: The support set targets, of shape b.
+        :return: The updated fit.
+        """
+        inverse_gram, weights = state
+
+        return woodbury_ridge_update(inverse_gram=inverse_gram, weights=weights, x=x,
+                                     y=F.one_hot(y.long(), num_classes=self.num_output_classes).float())
+
+    def forward(self, x, state):
+        """
+        Predicts the logits of the given features with the given fit.
+        :param x: Input features, of shape b, f.
+        :param state: The fit, as returned by initial_state or update.
+        :return: Logits of shape b, num_output_classes.
+        """
+        inverse_gram, weights = state
+
+        return torch.matmul(x, weights) * self.logit_scale + self.logit_bias
+
+
 class MetaBatchNormLayer(nn.Module):
     def __init__(self, num_features, num_support_set_steps, num_target_set_steps,
                  eps=1e-5, momentum=0.1, affine=True, track_running_stats=True,
@@ -265,8 +341,8 @@ class MetaBatchNormLayer(nn.Module):
             self.weight = nn.Parameter(torch.ones(num_features),
                                        requires_grad=self.learnable_gamma)
 
-        self.backup_running_mean = torch.zeros(self.running_mean.shape)
-        self.backup_running_var = torch.ones(self.running_var.shape)
+        self.register_buffer('backup_running_mean', torch.zeros(self.running_mean.shape), persistent=False)
+        self.register_buffer('backup_running_var', torch.ones(self.running_var.shape), persistent=False)
 
         self.momentum = momentum
 
@@ -294,9 +370,8 @@ class MetaBatchNormLayer(nn.Module):
             running_var = self.running_var
             weight, bias = self.weight, self.bias
 
-        if backup_running_statistics and self.use_per_step_bn_statistics:
-            self.backup_running_mean.data = copy(self.running_mean.data)
-            self.backup_running_var.data = copy(self.running_var.data)
+        if backup_running_statistics:
+            self.backup_stats()
 
         momentum = self.momentum
         # print(running_mean.shape, running_var.shape)
@@ -305,15 +380,64 @@ class MetaBatchNormLayer(nn.Module):
 
         return output
 
+    def backup_stats(self):
+        """
+        Stores the current running statistics in the backup store, so they can be reset by restore_backup_stats.
+        """
+        if self.use_per_step_bn_statistics:
+            with torch.no_grad():
+                self.backup_running_mean.copy_(self.running_mean)
+                self.backup_running_var.copy_(self.running_var)
+
+    def get_step_affine_params(self, num_step):
+        """
+        Returns the weight and bias used at the given inner loop step.
+        :param num_step: The current inner loop step.
+        :return: A tuple of (weight, bias).
+        """
+        if self.use_per_step_bn_statistics:
+            return self.weight[num_step], self.bias[num_step]
+        else:
+            return self.weight, self.bias
+
+    def get_step_running_stats(self, num_step):
+        """
+        Returns the running statistics collected at the given inner loop step.
+        :param num_step: The current inner loop step.
+        :return: A tuple of (running_mean, running_var).
+        """
+        if self.use_per_step_bn_statistics:
+            return self.running_mean[num_step], self.running_var[num_step]
+        else:
+            return self.running_mean, self.running_var
+
+    def update_running_stats(self, batch_mean, batch_var, num_step):
+        """
+        Updates the running statistics of the given step with the statistics of a batch, in the same way F.batch_norm
+        does in training mode. Used by the functional forward passes, which normalize without touching the layer state.
+        :param batch_mean: The per channel mean of the batch.
+        :param batch_var: The per channel unbiased variance of the batch.
+        :param num_step: The current inner loop step.
+        """
+        if self.use_per_step_bn_statistics:
+            running_mean = self.running_mean[num_step]
+            running_var = self.running_var[num_step]
+        else:
+            running_mean = self.running_mean
+            running_var = self.running_var
+
+        with torch.no_grad():
+            running_mean.mul_(1 - self.momentum).add_(batch_mean, alpha=self.momentum)
+            running_var.mul_(1 - self.momentum).add_(batch_var, alpha=self.momentum)
+
     def restore_backup_stats(self):
         """
         Resets batch statistics to their backup values which are collected after each forward pass.
         """
         if self.use_per_step_bn_statistics:
-            self.running_mean = nn.Parameter(self.backup_running_mean, requires_grad=False)
-            self.running_var = nn.Parameter(self.backup_running_var, requires_grad=False)
-
-        self.to(self.weight.device)
+            with torch.no_grad():
+                self.running_mean.copy_(self.backup_running_mean)
+                self.running_var.copy_(self.backup_running_var)
 
     def extra_repr(self):
         return '{num_features}, eps={eps}, momentum={momentum}, affine={affine}, ' \
@@ -420,14 +544,109 @@ class MetaConvNormLayerLeakyReLU(nn.Module):
         out = F.leaky_relu(out)
         return out
 
+    def get_fused_conv_params(self, num_step, params=None):
+        """
+        Folds the batch norm of the given step into the convolution, using the step's running statistics, so that
+        conv followed by batch norm in inference mode becomes a single convolution.
+        :param num_step: The inner loop step whose batch norm parameters and running statistics are folded.
+        :param params: A dictionary containing the weights of this layer, as passed to forward. If None the stored
+        weights are used.
+        :return: A tuple of the fused (weight, bias).
+        """
+        if params is not None:
+            conv_params = extract_top_level_dict(current_dict=extract_top_level_dict(current_dict=params)['conv'])
+            weight, bias = conv_params['weight'], conv_params.get('bias')
+        else:
+            weight, bias = self.conv.weight, self.conv.bias if self.conv.use_bias else None
+
+        if not self.use_normalization:
+            return weight, bias
+
+        norm_weight, norm_bias = self.norm_layer.get_step_affine_params(num_step=num_step)
+        running_mean, running_var = self.norm_layer.get_step_running_stats(num_step=num_step)
+
+        return fuse_conv_batch_norm(conv_weight=weight, conv_bias=bias, norm_weight=norm_weight, norm_bias=norm_bias,
+                                    running_mean=running_mean, running_var=running_var, eps=self.norm_layer.eps)
+
+    def fused_forward(self, x, fused_weight, fused_bias):
+        """
+        Forward propagates with the weights returned by get_fused_conv_params, as a single conv followed by LeakyReLU.
+        :param x: Input data batch.
+        :param fused_weight: The fused convolutional weights.
+        :param fused_bias: The fused convolutional bias.
+        :return: The same output as forward with the batch norm in inference mode.
+        """
+        out = F.conv2d(input=x, weight=fused_weight.contiguous(memory_format=self.conv.weight_memory_format),
+                       bias=fused_bias, stride=self.conv.stride, padding=self.conv.padding,
+                       dilation=self.conv.dilation_rate, groups=self.conv.groups)
+        return F.leaky_relu(out)
+
     def restore_backup_stats(self):
         """
         Restore stored statistics from the backup, replacing the current ones.
         """
-        if self.normalization:
+        if self.use_normalization:
             self.norm_layer.restore_backup_stats()
 
 
+def set_weight_memory_format(module, memory_format):
+    """
+    Sets the memory format in which the convolutional layers of a module pass their weights to F.conv2d. Parameters
+    are converted by module.to(memory_format=...), but the inner loop fast weights are created in the default format,
+    so the layers convert them on the fly.
+    :param module: The module whose layers to set.
+    :param memory_format: A torch.memory_format, e.g. torch.channels_last.
+    """
+    for layer in module.modules():
+        if hasattr(layer, 'weight_memory_format'):
+            layer.weight_memory_format = memory_format
+
+
+def fuse_conv_batch_norm(conv_weight, conv_bias, norm_weight, norm_bias, running_mean, running_var, eps):
+    """
+    Folds an inference mode batch norm into the preceding convolution: bn(conv(x, w, b)) = conv(x, w * s, (b - mean) *
+    s + beta), with s = gamma / sqrt(var + eps).
+    :param conv_weight: The convolutional weights.
+    :param conv_bias: The convolutional bias, or None.
+    :param norm_weight: The batch norm weight (gamma).
+    :param norm_bias: The batch norm bias (beta).
+    :param running_mean: The running mean used for normalization.
+    :param running_var: The running variance used for normalization.
+    :param eps: The batch norm epsilon.
+    :return: A tuple of the fused (weight, bias).
+    """
+    scale = norm_weight * torch.rsqrt(running_var + eps)
+    weight = conv_weight * scale.view(-1, 1, 1, 1)
+    bias = norm_bias - running_mean * scale
+
+    if conv_bias is not None:
+        bias = bias + conv_bias * scale
+
+    return weight, bias
+
+
+def functional_conv_norm_leaky_relu(x, conv_weight, conv_bias, norm_weight, norm_bias, stride, padding, eps):
+    """
+    A pure tensor version of MetaConvNormLayerLeakyReLU.forward. The batch norm weight and bias of the current step
+    are selected by the caller and the batch statistics are returned instead of being written to the running stats, so
+    the function can be traced once by torch.compile and reused for every inner loop step.
+    :param x: Input data batch.
+    :param conv_weight: The convolutional weights.
+    :param conv_bias: The convolutional bias.
+    :param norm_weight: The batch norm weight of the current step.
+    :param norm_bias: The batch norm bias of the current step.
+    :param stride: The convolutional stride.
+    :param padding: The convolutional padding.
+    :param eps: The batch norm epsilon.
+    :return: A tuple of the layer output, the batch mean and the unbiased batch variance.
+    """
+    out = F.conv2d(input=x, weight=conv_weight, bias=conv_bias, stride=stride, padding=padding)
+    batch_var, batch_mean = torch.var_mean(out.detach(), dim=[0, 2, 3], correction=1)
+    out = F.batch_norm(out, None, None, norm_weight, norm_bias, training=True, eps=eps)
+    out = F.leaky_relu(out)
+    return out, batch_mean, batch_var
+
+
 class VGGActivationNormNetwork(nn.Module):
     def __init__(self, input_shape, num_output_classes, use_channel_wise_attention,
                  num_stages, num_filters, num_support_set_steps, num_target_set_steps):
@@ -452,6 +671,8 @@ class VGGActivationNormNetwork(nn.Module):
         self.num_output_classes = num_output_classes
         self.num_support_set_steps = num_support_set_steps
         self.num_target_set_steps = num_target_set_steps
+        self.compiled_functional_forward = None
+        self.weight_memory_format = torch.contiguous_format
         self.build_network()
 
     def build_network(self):
@@ -478,7 +699,7 @@ class VGGActivationNormNetwork(nn.Module):
 
             out = F.max_pool2d(input=out, kernel_size=2, stride=2, padding=0)
 
-        out = out.view((out.shape[0], -1))
+        out = out.reshape((out.shape[0], -1))
 
         if type(self.num_output_classes) == list:
             for idx, num_output_classes in enumerate(self.num_output_classes):
@@ -494,6 +715,11 @@ class VGGActivationNormNetwork(nn.Module):
             out = self.layer_dict['linear'](out)
         print("VGGNetwork build", out.shape)
 
+        self.functional_weight_names = ['layer_dict.{}'.format(name) for name, param in self.layer_dict.named_parameters()
+                                        if 'norm_layer' not in name]
+        self.register_buffer('batch_norm_stats_backup',
+                             torch.zeros(sum(stat.numel() for stat in self.get_batch_norm_stats())), persistent=False)
+
     def forward(self, x, num_step, dropout_training=None, params=None, training=False,
                 backup_running_statistics=False, return_features=False):
         """
@@ -507,11 +733,25 @@ class VGGActivationNormNetwork(nn.Module):
         then used to reset the stats back to a previous state (usually after an eval loop, when we want to throw away stored statistics)
         :return: Logits of shape b, num_output_classes.
         """
+        features = self.trunk_forward(x=x, num_step=num_step, params=params, training=training,
+                                      backup_running_statistics=backup_running_statistics)
+        out = self.head_forward(features=features, params=params)
+
+        if return_features:
+            return out, features
+        else:
+            return out
+
+    def get_param_dict(self, params):
+        """
+        Maps the fast weights passed to forward to a dictionary of per layer weights, with None for the layers that
+        use their stored weights.
+        :param params: The fast weights, as passed to forward, or None.
+        """
         param_dict = dict()
 
         if params is not None:
             params = {key: value[0] for key, value in params.items()}
-            # print([key for key, value in param_dict.items()])
             param_dict = extract_top_level_dict(current_dict=params)
 
         for name, param in list(self.layer_dict.named_parameters()) + list(self.layer_dict.items()):
@@ -520,9 +760,20 @@ class VGGActivationNormNetwork(nn.Module):
             if layer_name not in param_dict:
                 param_dict[layer_name] = None
 
-        out = x
+        return param_dict
 
-        # print([key for key, value in param_dict.items() if value is not None])
+    def trunk_forward(self, x, num_step, params=None, training=False, backup_running_statistics=False):
+        """
+        Forward propagates through the conv layers of the network, up to the features the linear layer is applied to.
+        :param x: Input image batch.
+        :param num_step: The current inner loop step number
+        :param params: The fast weights, as passed to forward, or None.
+        :param training: Whether this is training (True) or eval time.
+        :param backup_running_statistics: Whether to backup the running statistics in their backup store.
+        :return: The features of shape b, c, h, w.
+        """
+        param_dict = self.get_param_dict(params)
+        out = x
 
         for i in range(self.num_stages):
             out = self.layer_dict['conv_{}'.format(i)](out, params=param_dict['conv_{}'.format(i)], training=training,
@@ -531,9 +782,18 @@ class VGGActivationNormNetwork(nn.Module):
 
             out = F.max_pool2d(input=out, kernel_size=(2, 2), stride=2, padding=0)
 
-        features = out
+        return out
 
-        out = out.view(out.size(0), -1)
+    def head_forward(self, features, params=None):
+        """
+        Applies the linear layer(s) of the network to the features returned by trunk_forward.
+        :param features: The features of shape b, c, h, w.
+        :param params: The fast weights, as passed to forward, or None.
+        :return: Logits of shape b, num_output_classes.
+        """
+        param_dict = self.get_param_dict(params)
+
+        out = features.reshape(features.size(0), -1)
 
         if type(self.num_output_classes) == list:
             pred_list = []
@@ -545,6 +805,154 @@ class VGGActivationNormNetwork(nn.Module):
 
             out = self.layer_dict['linear'](out, params=param_dict['linear'])
 
+        return out
+
+    def get_fused_params(self, num_step, params=None):
+        """
+        Folds the batch norm of every conv layer, with the running statistics of the given step, into the conv weights.
+        :param num_step: The inner loop step whose batch norm parameters and running statistics are folded.
+        :param params: The fast weights, as passed to forward. If None the stored weights are used.
+        :return: A dictionary with the fused (weight, bias) of every conv layer and the params of the linear layers,
+        to be passed to fused_forward.
+        """
+        param_dict = dict()
+
+        if params is not None:
+            params = {key: value[0] for key, value in params.items()}
+            param_dict = extract_top_level_dict(current_dict=params)
+
+        fused_params = {name: param_dict.get(name) for name in self.layer_dict.keys() if 'linear' in name}
+
+        for i in range(self.num_stages):
+            layer_name = 'conv_{}'.format(i)
+            fused_params[layer_name] = self.layer_dict[layer_name].get_fused_conv_params(
+                num_step=num_step, params=param_dict.get(layer_name))
+
+        return fused_params
+
+    def fused_forward(self, x, fused_params, return_features=False):
+        """
+        Inference forward pass with the weights returned by get_fused_params, running each conv layer as a single
+        fused conv followed by LeakyReLU. Equivalent to forward with the batch norm layers in inference mode.
+        :param x: Input image batch.
+        :param fused_params: The fused weights returned by get_fused_params.
+        :param return_features: Whether to also return the features before the linear layer.
+        :return: Logits of shape b, num_output_classes.
+        """
+        out = x
+
+        for i in range(self.num_stages):
+            out = self.layer_dict['conv_{}'.format(i)].fused_forward(out, *fused_params['conv_{}'.format(i)])
+            out = F.max_pool2d(input=out, kernel_size=(2, 2), stride=2, padding=0)
+
+        features = out
+
+        out = out.reshape(out.size(0), -1)
+
+        if type(self.num_output_classes) == list:
+            out = [self.layer_dict['linear_{}'.format(idx)](out, params=fused_params['linear_{}'.format(idx)])
+                   for idx in range(len(self.num_output_classes))]
+        else:
+            out = self.layer_dict['linear'](out, params=fused_params['linear'])
+
+        if return_features:
+            return out, features
+        else:
+            return out
+
+    def get_norm_layers(self):
+        """
+        Returns the batch norm layers in the order functional_forward expects their parameters.
+        """
+        return [self.layer_dict['conv_{}'.format(i)].norm_layer for i in range(self.num_stages)]
+
+    def functional_forward(self, x, fast_weights, norm_weights, norm_biases):
+        """
+        A pure tensor version of forward, which can be compiled with torch.compile(fullgraph=True).
+        :param x: Input image batch.
+        :param fast_weights: A flat tuple of the inner loop weights, ordered as in functional_weight_names.
+        :param norm_weights: A tuple with the current step's batch norm weight of each conv layer.
+        :param norm_biases: A tuple with the current step's batch norm bias of each conv layer.
+        :return: The logits, the features before the linear layer and a list with the (mean, var) batch statistics
+        of each conv layer.
+        """
+        weights = dict(zip(self.functional_weight_names, fast_weights))
+        batch_statistics = []
+        out = x
+
+        for i in range(self.num_stages):
+            layer_name = 'layer_dict.conv_{}'.format(i)
+            layer = self.layer_dict['conv_{}'.format(i)]
+            out, batch_mean, batch_var = functional_conv_norm_leaky_relu(
+                out, conv_weight=weights['{}.conv.weight'.format(layer_name)],
+                conv_bias=weights['{}.conv.bias'.format(layer_name)], norm_weight=norm_weights[i],
+                norm_bias=norm_biases[i], stride=layer.conv.stride, padding=layer.conv.padding,
+                eps=layer.norm_layer.eps)
+            batch_statistics.append((batch_mean, batch_var))
+
+            out = F.max_pool2d(input=out, kernel_size=(2, 2), stride=2, padding=0)
+
+        features = out
+
+        out = out.reshape(out.size(0), -1)
+
+        if type(self.num_output_classes) == list:
+            out = [F.linear(out, weights['layer_dict.linear_{}.weights'.format(idx)],
+                            weights['layer_dict.linear_{}.bias'.format(idx)])
+                   for idx in range(len(self.num_output_classes))]
+        else:
+            out = F.linear(out, weights['layer_dict.linear.weights'], weights['layer_dict.linear.bias'])
+
+        return out, features, batch_statistics
+
+    def compile_functional_forward(self):
+        """
+        Compiles functional_forward with torch.compile. The graphs are specialised on the episode shapes, so a fixed
+        support and target set size only compiles a handful of graphs, which are then reused by every inner loop step.
+        """
+        self.compiled_functional_forward = torch.compile(self.functional_forward, fullgraph=True, dynamic=False)
+
+    def run_functional_forward(self, x, num_step, params, training=False, backup_running_statistics=False,
+                               return_features=False, use_compiled=True):
+        """
+        Same as forward, but runs the network through functional_forward. The per step batch norm parameters are
+        selected and the running statistics updated here, outside of the pure tensor function.
+        :param x: Input image batch.
+        :param num_step: The current inner loop step number
+        :param params: A dictionary with the fast weights, keyed as in functional_weight_names.
+        :param training: Whether this is training (True) or eval time.
+        :param backup_running_statistics: Whether to backup the running statistics in their backup store.
+        :param return_features: Whether to also return the features before the linear layer.
+        :param use_compiled: Whether to use the compiled function, if it has been compiled. Should be False when the
+        caller differentiates through the backward pass (second order).
+        :return: Logits of shape b, num_output_classes.
+        """
+        if params is None:
+            return self.forward(x=x, num_step=num_step, training=training,
+                                backup_running_statistics=backup_running_statistics, return_features=return_features)
+
+        fast_weights = tuple(params[name][0].contiguous(memory_format=self.weight_memory_format)
+                             if params[name][0].dim() == 4 else params[name][0]
+                             for name in self.functional_weight_names)
+        norm_layers = self.get_norm_layers()
+
+        if backup_running_statistics:
+            for norm_layer in norm_layers:
+                norm_layer.backup_stats()
+
+        norm_params = [norm_layer.get_step_affine_params(num_step=num_step) for norm_layer in norm_layers]
+        norm_weights = tuple(weight for weight, bias in norm_params)
+        norm_biases = tuple(bias for weight, bias in norm_params)
+
+        if use_compiled and self.compiled_functional_forward is not None:
+            out, features, batch_statistics = self.compiled_functional_forward(x, fast_weights, norm_weights,
+                                                                               norm_biases)
+        else:
+            out, features, batch_statistics = self.functional_forward(x, fast_weights, norm_weights, norm_biases)
+
+        for norm_layer, (batch_mean, batch_var) in zip(norm_layers, batch_statistics):
+            norm_layer.update_running_stats(batch_mean=batch_mean, batch_var=batch_var, num_step=num_step)
+
         if return_features:
             return out, features
         else:
@@ -558,22 +966,36 @@ class VGGActivationNormNetwork(nn.Module):
             if type(module) == MetaBatchNormLayer:
                 module.restore_backup_stats()
 
+    def get_batch_norm_stats(self):
+        """
+        Returns the running means and variances of all the batch norm layers of the network.
+        """
+        return [stat for module in self.modules() if type(module) == MetaBatchNormLayer
+                for stat in (module.running_mean, module.running_var)]
+
+    def snapshot_batch_norm_stats(self):
+        """
+        Copies the running statistics of all batch norm layers into the preallocated flat backup buffer, in a single
+        kernel and without allocating. Used with restore_batch_norm_stats to throw away the statistics collected while
+        adapting to an evaluation task.
+        """
+        with torch.no_grad():
+            torch.cat([stat.view(-1) for stat in self.get_batch_norm_stats()], out=self.batch_norm_stats_backup)
+
+    def restore_batch_norm_stats(self):
+        """
+        Restores the running statistics of all batch norm layers in place from the flat backup buffer.
+        """
+        stats = self.get_batch_norm_stats()
+        with torch.no_grad():
+            for stat, backup in zip(stats, self.batch_norm_stats_backup.split([stat.numel() for stat in stats])):
+                stat.copy_(backup.view_as(stat))
+
     def zero_grad(self, params=None):
         if params is None:
-            for param in self.parameters():
-                if param.requires_grad == True:
-                    if param.grad is not None:
-                        if torch.sum(param.grad) > 0:
-                            print(param.grad)
-                            param.grad.zero_()
-        else:
-            for name, param in params.items():
-                if param.requires_grad == True:
-                    if param.grad is not None:
-                        if torch.sum(param.grad) > 0:
-                            print(param.grad)
-                            param.grad.zero_()
-                            params[name].grad = None
+            params = dict(self.named_parameters())
+
+        clear_grads(names_params_dict=params)
 
 
 class FCCActivationNormNetwork(nn.Module):
@@ -609,7 +1031,7 @@ class FCCActivationNormNetwork(nn.Module):
         """
         x = torch.zeros(self.input_shape)
         out = x
-        out = out.view(out.size(0), -1)
+        out = out.reshape(out.size(0), -1)
         self.layer_dict = nn.ModuleDict()
 
         for i in range(self.num_stages):
@@ -655,7 +1077,7 @@ class FCCActivationNormNetwork(nn.Module):
                 param_dict[layer_name] = None
 
         out = x
-        out = out.view(out.size(0), -1)
+        out = out.reshape(out.size(0), -1)
         for i in range(self.num_stages):
             out = self.layer_dict['fcc_{}'.format(i)](out, params=param_dict['fcc_{}'.format(i)])
             if self.use_bn:
@@ -665,7 +1087,7 @@ class FCCActivationNormNetwork(nn.Module):
             out = F.leaky_relu(out)
             features = out
 
-        out = out.view(out.size(0), -1)
+        out = out.reshape(out.size(0), -1)
         out = self.layer_dict['preds_linear'](out, param_dict['preds_linear'])
 
         if return_features:
@@ -689,20 +1111,9 @@ class FCCActivationNormNetwork(nn.Module):
 
     def zero_grad(self, params=None):
         if params is None:
-            for param in self.parameters():
-                if param.requires_grad == True:
-                    if param.grad is not None:
-                        if torch.sum(param.grad) > 0:
-                            print(param.grad)
-                            param.grad.zero_()
-        else:
-            for name, param in params.items():
-                if param.requires_grad == True:
-                    if param.grad is not None:
-                        if torch.sum(param.grad) > 0:
-                            print(param.grad)
-                            param.grad.zero_()
-                            params[name].grad = None
+            params = dict(self.named_parameters())
+
+        clear_grads(names_params_dict=params)
 
 
 class SqueezeExciteLayer(nn.ModuleDict):
@@ -776,6 +1187,24 @@ class SqueezeExciteLayer(nn.ModuleDict):
         return out
 
 
+def functional_squeeze_excite(x, hidden_weights, output_weight, output_bias):
+    """
+    A pure tensor version of SqueezeExciteLayer.forward.
+    :param x: Input data batch, in the form (b, c, h, w).
+    :param hidden_weights: A list of (weights, bias) tuples, one per hidden layer.
+    :param output_weight: The weights of the attention output layer.
+    :param output_bias: The bias of the attention output layer.
+    :return: The input scaled by the channel wise attention.
+    """
+    out = F.avg_pool2d(x, x.shape[-1]).flatten(1)
+
+    for weight, bias in hidden_weights:
+        out = F.leaky_relu(F.linear(out, weight, bias))
+
+    channel_wise_attention_regions = torch.sigmoid(F.linear(out, output_weight, output_bias))
+    return x * channel_wise_attention_regions.unsqueeze(2).unsqueeze(2)
+
+
 class VGGActivationNormNetworkWithAttention(nn.Module):
     def __init__(self, input_shape, num_output_classes, use_channel_wise_attention,
                  num_stages, num_filters, num_support_set_steps, num_target_set_steps, num_blocks_per_stage):
@@ -801,6 +1230,8 @@ class VGGActivationNormNetworkWithAttention(nn.Module):
         self.num_blocks_per_stage = num_blocks_per_stage
         self.num_support_set_steps = num_support_set_steps
         self.num_target_set_steps = num_target_set_steps
+        self.compiled_functional_forward = None
+        self.weight_memory_format = torch.contiguous_format
         self.build_network()
 
     def build_network(self):
@@ -856,6 +1287,11 @@ class VGGActivationNormNetworkWithAttention(nn.Module):
         out = self.layer_dict['linear'](out)
         print("VGGNetwork build", out.shape)
 
+        self.functional_weight_names = ['layer_dict.{}'.format(name) for name, param in self.layer_dict.named_parameters()
+                                        if 'norm_layer' not in name]
+        self.register_buffer('batch_norm_stats_backup',
+                             torch.zeros(sum(stat.numel() for stat in self.get_batch_norm_stats())), persistent=False)
+
     def forward(self, x, num_step, dropout_training=None, params=None, training=False,
                 backup_running_statistics=False, return_features=False):
         """
@@ -869,11 +1305,25 @@ class VGGActivationNormNetworkWithAttention(nn.Module):
         then used to reset the stats back to a previous state (usually after an eval loop, when we want to throw away stored statistics)
         :return: Logits of shape b, num_output_classes.
         """
+        features = self.trunk_forward(x=x, num_step=num_step, params=params, training=training,
+                                      backup_running_statistics=backup_running_statistics)
+        out = self.head_forward(features=features, params=params)
+
+        if return_features:
+            return out, features
+        else:
+            return out
+
+    def get_param_dict(self, params):
+        """
+        Maps the fast weights passed to forward to a dictionary of per layer weights, with None for the layers that
+        use their stored weights.
+        :param params: The fast weights, as passed to forward, or None.
+        """
         param_dict = dict()
 
         if params is not None:
             params = {key: value[0] for key, value in params.items()}
-            # print([key for key, value in param_dict.items()])
             param_dict = extract_top_level_dict(current_dict=params)
 
         for name, param in list(self.layer_dict.named_parameters()) + list(self.layer_dict.items()):
@@ -882,6 +1332,20 @@ class VGGActivationNormNetworkWithAttention(nn.Module):
             if layer_name not in param_dict:
                 param_dict[layer_name] = None
 
+        return param_dict
+
+    def trunk_forward(self, x, num_step, params=None, training=False, backup_running_statistics=False):
+        """
+        Forward propagates through the attention and conv layers of the network, up to the features that are pooled
+        and fed to the linear layer. As in forward, the conv layers always normalize with batch statistics.
+        :param x: Input image batch.
+        :param num_step: The current inner loop step number
+        :param params: The fast weights, as passed to forward, or None.
+        :param training: Whether this is training (True) or eval time.
+        :param backup_running_statistics: Whether to backup the running statistics in their backup store.
+        :return: The features of shape b, c, h, w.
+        """
+        param_dict = self.get_param_dict(params)
         out = x
 
         # print([key for key, value in param_dict.items() if value is not None])
@@ -903,8 +1367,18 @@ class VGGActivationNormNetworkWithAttention(nn.Module):
         if self.use_channel_wise_attention:
             out = self.layer_dict['attention_pre_logit_layer'].forward(out, params=param_dict[
                 'attention_pre_logit_layer'])
-        features = out
-        features_avg = F.avg_pool2d(out, out.shape[-1]).squeeze()
+
+        return out
+
+    def head_forward(self, features, params=None):
+        """
+        Average pools the features returned by trunk_forward and applies the linear layer of the network.
+        :param features: The features of shape b, c, h, w.
+        :param params: The fast weights, as passed to forward, or None.
+        :return: Logits of shape b, num_output_classes.
+        """
+        param_dict = self.get_param_dict(params)
+        features_avg = F.avg_pool2d(features, features.shape[-1]).squeeze()
 
         # out = F.avg_pool2d(out, out.shape[-1])
 
@@ -914,6 +1388,124 @@ class VGGActivationNormNetworkWithAttention(nn.Module):
 
         out = self.layer_dict['linear'](out, param_dict['linear'])
 
+        return out
+
+    def get_norm_layers(self):
+        """
+        Returns the batch norm layers in the order functional_forward expects their parameters.
+        """
+        return [self.layer_dict['conv_{}_{}'.format(i, j)].norm_layer for i in range(self.num_stages)
+                for j in range(self.num_blocks_per_stage)]
+
+    def get_functional_attention_weights(self, weights, layer_name):
+        """
+        Collects the weights of a squeeze excite layer from the weight dictionary built in functional_forward.
+        :param weights: A dictionary of the fast weights, keyed as in functional_weight_names.
+        :param layer_name: The name of the squeeze excite layer in the layer dict.
+        :return: A tuple of the hidden layer (weights, bias) list, the output weights and the output bias.
+        """
+        prefix = 'layer_dict.{}.layer_dict.'.format(layer_name)
+        hidden_weights = [(weights['{}attention_network_hidden_{}.weights'.format(prefix, i)],
+                           weights['{}attention_network_hidden_{}.bias'.format(prefix, i)])
+                          for i in range(self.layer_dict[layer_name].num_layers - 1)]
+        return (hidden_weights, weights['{}attention_network_output_layer.weights'.format(prefix)],
+                weights['{}attention_network_output_layer.bias'.format(prefix)])
+
+    def functional_forward(self, x, fast_weights, norm_weights, norm_biases):
+        """
+        A pure tensor version of forward, which can be compiled with torch.compile(fullgraph=True).
+        :param x: Input image batch.
+        :param fast_weights: A flat tuple of the inner loop weights, ordered as in functional_weight_names.
+        :param norm_weights: A tuple with the current step's batch norm weight of each conv layer.
+        :param norm_biases: A tuple with the current step's batch norm bias of each conv layer.
+        :return: The logits, the features before the pooling and linear layer and a list with the (mean, var) batch
+        statistics of each conv layer.
+        """
+        weights = dict(zip(self.functional_weight_names, fast_weights))
+        batch_statistics = []
+        out = x
+
+        for i in range(self.num_stages):
+            for j in range(self.num_blocks_per_stage):
+
+                if self.use_channel_wise_attention:
+                    hidden_weights, output_weight, output_bias = self.get_functional_attention_weights(
+                        weights=weights, layer_name='attention_layer_{}_{}'.format(i, j))
+                    out = functional_squeeze_excite(out, hidden_weights=hidden_weights, output_weight=output_weight,
+                                                    output_bias=output_bias)
+
+                layer_name = 'layer_dict.conv_{}_{}'.format(i, j)
+                layer = self.layer_dict['conv_{}_{}'.format(i, j)]
+                norm_idx = len(batch_statistics)
+                out, batch_mean, batch_var = functional_conv_norm_leaky_relu(
+                    out, conv_weight=weights['{}.conv.weight'.format(layer_name)],
+                    conv_bias=weights['{}.conv.bias'.format(layer_name)], norm_weight=norm_weights[norm_idx],
+                    norm_bias=norm_biases[norm_idx], stride=layer.conv.stride, padding=layer.conv.padding,
+                    eps=layer.norm_layer.eps)
+                batch_statistics.append((batch_mean, batch_var))
+
+            out = F.max_pool2d(input=out, kernel_size=(2, 2), stride=2, padding=0)
+
+        if self.use_channel_wise_attention:
+            hidden_weights, output_weight, output_bias = self.get_functional_attention_weights(
+                weights=weights, layer_name='attention_pre_logit_layer')
+            out = functional_squeeze_excite(out, hidden_weights=hidden_weights, output_weight=output_weight,
+                                            output_bias=output_bias)
+        features = out
+        features_avg = F.avg_pool2d(out, out.shape[-1]).flatten(1)
+
+        out = F.linear(features_avg, weights['layer_dict.linear.weights'], weights['layer_dict.linear.bias'])
+
+        return out, features, batch_statistics
+
+    def compile_functional_forward(self):
+        """
+        Compiles functional_forward with torch.compile. The graphs are specialised on the episode shapes, so a fixed
+        support and target set size only compiles a handful of graphs, which are then reused by every inner loop step.
+        """
+        self.compiled_functional_forward = torch.compile(self.functional_forward, fullgraph=True, dynamic=False)
+
+    def run_functional_forward(self, x, num_step, params, training=False, backup_running_statistics=False,
+                               return_features=False, use_compiled=True):
+        """
+        Same as forward, but runs the network through functional_forward. The per step batch norm parameters are
+        selected and the running statistics updated here, outside of the pure tensor function.
+        :param x: Input image batch.
+        :param num_step: The current inner loop step number
+        :param params: A dictionary with the fast weights, keyed as in functional_weight_names.
+        :param training: Whether this is training (True) or eval time.
+        :param backup_running_statistics: Whether to backup the running statistics in their backup store.
+        :param return_features: Whether to also return the features before the linear layer.
+        :param use_compiled: Whether to use the compiled function, if it has been compiled. Should be False when the
+        caller differentiates through the backward pass (second order).
+        :return: Logits of shape b, num_output_classes.
+        """
+        if params is None:
+            return self.forward(x=x, num_step=num_step, training=training,
+                                backup_running_statistics=backup_running_statistics, return_features=return_features)
+
+        fast_weights = tuple(params[name][0].contiguous(memory_format=self.weight_memory_format)
+                             if params[name][0].dim() == 4 else params[name][0]
+                             for name in self.functional_weight_names)
+        norm_layers = self.get_norm_layers()
+
+        if backup_running_statistics:
+            for norm_layer in norm_layers:
+                norm_layer.backup_stats()
+
+        norm_params = [norm_layer.get_step_affine_params(num_step=num_step) for norm_layer in norm_layers]
+        norm_weights = tuple(weight for weight, bias in norm_params)
+        norm_biases = tuple(bias for weight, bias in norm_params)
+
+        if use_compiled and self.compiled_functional_forward is not None:
+            out, features, batch_statistics = self.compiled_functional_forward(x, fast_weights, norm_weights,
+                                                                               norm_biases)
+        else:
+            out, features, batch_statistics = self.functional_forward(x, fast_weights, norm_weights, norm_biases)
+
+        for norm_layer, (batch_mean, batch_var) in zip(norm_layers, batch_statistics):
+            norm_layer.update_running_stats(batch_mean=batch_mean, batch_var=batch_var, num_step=num_step)
+
         if return_features:
             return out, features
         else:
@@ -927,27 +1519,54 @@ class VGGActivationNormNetworkWithAttention(nn.Module):
             if type(module) == MetaBatchNormLayer:
                 module.restore_backup_stats()
 
+    def get_batch_norm_stats(self):
+        """
+        Returns the running means and variances of all the batch norm layers of the network.
+        """
+        return [stat for module in self.modules() if type(module) == MetaBatchNormLayer
+                for stat in (module.running_mean, module.running_var)]
+
+    def snapshot_batch_norm_stats(self):
+        """
+        Copies the running statistics of all batch norm layers into the preallocated flat backup buffer, in a single
+        kernel and without allocating. Used with restore_batch_norm_stats to throw away the statistics collected while
+        adapting to an evaluation task.
+        """
+        with torch.no_grad():
+            torch.cat([stat.view(-1) for stat in self.get_batch_norm_stats()], out=self.batch_norm_stats_backup)
+
+    def restore_batch_norm_stats(self):
+        """
+        Restores the running statistics of all batch norm layers in place from the flat backup buffer.
+        """
+        stats = self.get_batch_norm_stats()
+        with torch.no_grad():
+            for stat, backup in zip(stats, self.batch_norm_stats_backup.split([stat.numel() for stat in stats])):
+                stat.copy_(backup.view_as(stat))
+
     def zero_grad(self, params=None):
         if params is None:
-            for param in self.parameters():
-                if param.requires_grad == True:
-                    if param.grad is not None:
-                        if torch.sum(param.grad) > 0:
-                            print(param.grad)
-                            param.grad.zero_()
-        else:
-            for name, param in params.items():
-                if param.requires_grad == True:
-                    if param.grad is not None:
-                        if torch.sum(param.grad) > 0:
-                            print(param.grad)
-                            param.grad.zero_()
-                            params[name].grad = None
+            params = dict(self.named_parameters())
+
+        clear_grads(names_params_dict=params)
 
 
 class MetaBatchRelationalModule(nn.Module):
     def __init__(self, input_shape, use_coordinates=True, num_support_set_steps=0, num_target_set_steps=0,
-                 output_units=32):
+                 output_units=32, pair_chunk_size=16, max_spatial_size=5):
+        """
+        A relational embedding of the spatial locations of a batch of feature maps, able to receive external weights
+        at the forward pass. The first linear layer of g is factorized over the two locations of a pair, so the
+        (b x h*w x h*w x 2c) pair tensor is never built.
+        :param input_shape: The shape of the feature maps, in the form (b, c, h, w) or (b, c, length)
+        :param use_coordinates: Whether to append the location index to the features of each location.
+        :param num_support_set_steps: Number of inner loop steps on the support set.
+        :param num_target_set_steps: Number of inner loop steps on the target set.
+        :param output_units: Number of units of the output layer.
+        :param pair_chunk_size: Number of locations whose pairs are evaluated at once by the later layers of g.
+        :param max_spatial_size: Feature maps larger than this are average pooled down to it. If None the full
+        feature map is used.
+        """
         super(MetaBatchRelationalModule, self).__init__()
 
         self.input_shape = input_shape
@@ -957,6 +1576,8 @@ class MetaBatchRelationalModule(nn.Module):
         self.num_target_set_steps = num_target_set_steps
         self.num_support_set_steps = num_support_set_steps
         self.output_units = output_units
+        self.pair_chunk_size = pair_chunk_size
+        self.max_spatial_size = max_spatial_size
         self.build_block()
 
     def build_block(self):
@@ -964,8 +1585,8 @@ class MetaBatchRelationalModule(nn.Module):
         """g"""
         if len(out_img.shape) > 3:
             b, c, h, w = out_img.shape
-            if h > 5:
-                out_img = F.adaptive_avg_pool2d(out_img, output_size=5)
+            if self.max_spatial_size is not None and h > self.max_spatial_size:
+                out_img = F.adaptive_avg_pool2d(out_img, output_size=self.max_spatial_size)
             print(out_img.shape)
             b, c, h, w = out_img.shape
             out_img = out_img.view(b, c, h * w)
@@ -984,43 +1605,22 @@ class MetaBatchRelationalModule(nn.Module):
             if self.coord_tensor.shape[0] != out_img.shape[0]:
                 self.coord_tensor = self.coord_tensor[0].unsqueeze(0).repeat([out_img.shape[0], 1, 1])
 
-            out_img = torch.cat([out_img, self.coord_tensor], dim=2)
-
-        x_i = torch.unsqueeze(out_img, 1)  # (1xh*wxc)
-        x_i = x_i.repeat(1, length, 1, 1)  # (h*wxh*wxc)
-        x_j = torch.unsqueeze(out_img, 2)  # (h*wx1xc)
-        x_j = x_j.repeat(1, 1, length, 1)  # (h*wxh*wxc)
-
-        # concatenate all together
-        per_location_feature = torch.cat([x_i, x_j], 3)  # (h*wxh*wx2*c)
+            c += 1
 
-        out = per_location_feature.view(
-            per_location_feature.shape[0] * per_location_feature.shape[1] * per_location_feature.shape[2],
-            per_location_feature.shape[3])
-        # print(out.shape)
+        in_features = 2 * c
         for idx_layer in range(2):
-            # print('test', out.shape)
-            self.layer_dict['g_fcc_{}'.format(idx_layer)] = MetaLinearLayer(input_shape=out.shape, num_filters=64,
-                                                                            use_bias=True)
-            out = self.layer_dict['g_fcc_{}'.format(idx_layer)].forward(out)
+            self.layer_dict['g_fcc_{}'.format(idx_layer)] = MetaLinearLayer(input_shape=(b, in_features),
+                                                                            num_filters=64, use_bias=True)
             self.layer_dict['LeakyReLU_{}'.format(idx_layer)] = nn.LeakyReLU()
-            out = self.layer_dict['LeakyReLU_{}'.format(idx_layer)].forward(out)
+            in_features = 64
 
-        # reshape again and sum
-        print(out.shape)
-        out = out.view(per_location_feature.shape[0], per_location_feature.shape[1], per_location_feature.shape[2], -1)
-        out = out.sum(1).sum(1)
-        print('here', out.shape)
         """f"""
-        self.layer_dict['post_processing_layer'] = MetaLinearLayer(input_shape=out.shape, num_filters=64, use_bias=True)
-        out = self.layer_dict['post_processing_layer'].forward(out)
+        self.layer_dict['post_processing_layer'] = MetaLinearLayer(input_shape=(b, 64), num_filters=64, use_bias=True)
         self.layer_dict['LeakyReLU_post_processing'] = nn.LeakyReLU()
-        out = self.layer_dict['LeakyReLU_post_processing'].forward(out)
-        self.layer_dict['output_layer'] = MetaLinearLayer(input_shape=out.shape, num_filters=self.output_units,
+        self.layer_dict['output_layer'] = MetaLinearLayer(input_shape=(b, 64), num_filters=self.output_units,
                                                           use_bias=True)
-        out = self.layer_dict['output_layer'].forward(out)
         self.layer_dict['LeakyReLU_output'] = nn.LeakyReLU()
-        out = self.layer_dict['LeakyReLU_output'].forward(out)
+        out = self.forward(torch.zeros(self.input_shape), num_step=0)
         print('Block built with output volume shape', out.shape)
 
     def forward(self, x_img, num_step, params=None):
@@ -1044,8 +1644,8 @@ class MetaBatchRelationalModule(nn.Module):
         """g"""
         if len(out_img.shape) > 3:
             b, c, h, w = out_img.shape
-            if h > 5:
-                out_img = F.adaptive_avg_pool2d(out_img, output_size=5)
+            if self.max_spatial_size is not None and h > self.max_spatial_size:
+                out_img = F.adaptive_avg_pool2d(out_img, output_size=self.max_spatial_size)
             b, c, h, w = out_img.shape
             out_img = out_img.view(b, c, h * w)
 
@@ -1059,29 +1659,24 @@ class MetaBatchRelationalModule(nn.Module):
             out_img = torch.cat([out_img, self.coord_tensor.to(x_img.device)], dim=2)
         # x_flat = (64 x 25 x 24)
         # print('out_img', out_img.shape)
-        x_i = torch.unsqueeze(out_img, 1)  # (1xh*wxc)
-        x_i = x_i.repeat(1, length, 1, 1)  # (h*wxh*wxc)
-        x_j = torch.unsqueeze(out_img, 2)  # (h*wx1xc)
-        x_j = x_j.repeat(1, 1, length, 1)  # (h*wxh*wxc)
-
-        # concatenate all together
-        per_location_feature = torch.cat([x_i, x_j], 3)  # (h*wxh*wx2*c)
-        out = per_location_feature.view(
-            per_location_feature.shape[0] * per_location_feature.shape[1] * per_location_feature.shape[2],
-            per_location_feature.shape[3])
-        # print(out.shape)
-        for idx_layer in range(2):
-            # print('test', out.shape)
-            # print(param_dict['g_fcc_{}'.format(idx_layer)])
-            out = self.layer_dict['g_fcc_{}'.format(idx_layer)].forward(out,
-                                                                        params=param_dict['g_fcc_{}'.format(idx_layer)])
-            # print('test', out.shape)
-            out = self.layer_dict['LeakyReLU_{}'.format(idx_layer)].forward(out)
-
-        # reshape again and sum
-        # print(out.shape)
-        out = out.view(per_location_feature.shape[0], per_location_feature.shape[1], per_location_feature.shape[2], -1)
-        out = out.sum(1).sum(1)
+        if param_dict['g_fcc_0'] is not None:
+            first_layer_params = extract_top_level_dict(current_dict=param_dict['g_fcc_0'])
+            first_layer_weight, first_layer_bias = first_layer_params['weights'], first_layer_params['bias']
+        else:
+            first_layer_weight = self.layer_dict['g_fcc_0'].weights
+            first_layer_bias = self.layer_dict['g_fcc_0'].bias
+
+        def apply_pair_layers(pair_features):
+            out = self.layer_dict['LeakyReLU_0'].forward(pair_features)
+            out = self.layer_dict['g_fcc_1'].forward(out, params=param_dict['g_fcc_1'])
+            return self.layer_dict['LeakyReLU_1'].forward(out)
+
+        out = factorized_pairwise_relations(items=out_img, first_layer_weight=first_layer_weight,
+                                            first_layer_bias=first_layer_bias, pair_function=apply_pair_layers,
+                                            chunk_size=self.pair_chunk_size)
+
+        # sum over all pairs
+        out = out.sum(1)
 
         """f"""
         out = self.layer_dict['post_processing_layer'].forward(out, params=param_dict['post_processing_layer'])
@@ -12,3 +12,85 @@ def int_to_one_hot(int_labels):
     labels_one_hot = labels_one_hot.view((-1, num_output_units))
 
     return labels_one_hot
+
+
+def conjugate_gradient(matrix_vector_product, b, num_steps):
+    """
+    Approximately solves the linear system A x = b for a symmetric positive definite matrix A, which is only accessed
+    through matrix vector products. x and b are lists of tensors (e.g. one per parameter), treated as one flat vector.
+    A fixed number of steps is ran, such that no host synchronization is needed to check for convergence.
+    :param matrix_vector_product: A function mapping a list of tensors v to the list of tensors A v.
+    :param b: A list of tensors with the right hand side of the system.
+    :param num_steps: The number of conjugate gradient steps to run.
+    :return: A list of tensors with the approximate solution x.
+    """
+    x = [torch.zeros_like(item) for item in b]
+    r = [item.clone() for item in b]
+    p = [item.clone() for item in b]
+    r_dot_r = sum(torch.sum(item * item) for item in r)
+
+    for step in range(num_steps):
+        a_p = matrix_vector_product(p)
+        alpha = r_dot_r / (sum(torch.sum(p_item * a_p_item) for p_item, a_p_item in zip(p, a_p)) + 1e-10)
+        x = [x_item + alpha * p_item for x_item, p_item in zip(x, p)]
+        r = [r_item - alpha * a_p_item for r_item, a_p_item in zip(r, a_p)]
+        new_r_dot_r = sum(torch.sum(item * item) for item in r)
+        beta = new_r_dot_r / (r_dot_r + 1e-10)
+        p = [r_item + beta * p_item for r_item, p_item in zip(r, p)]
+        r_dot_r = new_r_dot_r
+
+    return x
+
+
+def woodbury_ridge_update(inverse_gram, weights, x, y):
+    """
+    Updates a ridge regression solution with a new batch of samples, as in recursive least squares. With
+    inverse_gram = (lambda I + X^T X)^-1 and weights = inverse_gram X^T Y for the samples seen so far, the Woodbury
+    identity gives the solution including the new samples with a single n x n Cholesky solve, where n is the number of
+    new samples, instead of a d x d solve. Every operation is differentiable.
+    :param inverse_gram: The inverse regularized gram matrix of the samples seen so far, of shape d, d.
+    :param weights: The ridge regression weights of the samples seen so far, of shape d, k.
+    :param x: The new samples, of shape n, d.
+    :param y: The regression targets of the new samples, of shape n, k.
+    :return: A tuple of the updated inverse gram matrix and weights.
+    """
+    inverse_gram_x = torch.matmul(inverse_gram, x.t())
+    innovation_covariance = torch.eye(x.shape[0], dtype=x.dtype, device=x.device) + torch.matmul(x, inverse_gram_x)
+    cholesky_factor = torch.linalg.cholesky(innovation_covariance)
+    gain = torch.cholesky_solve(inverse_gram_x.t(), cholesky_factor).t()
+
+    weights = weights + torch.matmul(gain, y - torch.matmul(x, weights))
+    inverse_gram = inverse_gram - torch.matmul(gain, inverse_gram_x.t())
+    inverse_gram = (inverse_gram + inverse_gram.t()) / 2.
+
+    return inverse_gram, weights
+
+
+def factorized_pairwise_relations(items, first_layer_weight, first_layer_bias, pair_function, chunk_size=None):
+    """
+    Computes the relational features sum_q g([x_q; x_p]) of every item p of a set, where g is an MLP whose first layer
+    is linear. Since W [x_q; x_p] + b = W_q x_q + (W_p x_p + b), the first layer is applied once per item and the pairs
+    are formed by a broadcast add, instead of materializing every concatenated pair. The rest of g is evaluated on
+    chunks of chunk_size items p at a time, bounding the peak memory to chunk_size x num_items pairs.
+    :param items: A tensor of shape (b, num_items, c).
+    :param first_layer_weight: The weights of the first layer of g, of shape (units, 2 * c). The first c columns apply
+    to x_q and the last c columns to x_p.
+    :param first_layer_bias: The bias of the first layer of g, or None.
+    :param pair_function: A function applying the rest of g (starting with the first activation) to pre-activations
+    of shape (b, chunk_size, num_items, units).
+    :param chunk_size: Number of items p evaluated per chunk. If None all pairs are evaluated at once.
+    :return: A tensor of shape (b, num_items, output_units) with the relational features of each item p.
+    """
+    num_items, c = items.shape[1], items.shape[2]
+    q_features = nn.functional.linear(items, first_layer_weight[:, :c])
+    p_features = nn.functional.linear(items, first_layer_weight[:, c:], first_layer_bias)
+
+    if chunk_size is None:
+        chunk_size = num_items
+
+    per_item_relations = []
+    for start in range(0, num_items, chunk_size):
+        pair_features = q_features.unsqueeze(1) + p_features[:, start:start + chunk_size].unsqueeze(2)
+        per_item_relations.append(pair_function(pair_features).sum(2))
+
+    return torch.cat(per_item_relations, dim=1)
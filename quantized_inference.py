@@ -0,0 +1,243 @@
+import time
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.ao.quantization import DeQuantStub, QuantStub, convert, get_default_qconfig, prepare
+
+from meta_neural_network_architectures import VGGActivationNormNetworkWithAttention, extract_top_level_dict, \
+    functional_squeeze_excite
+
+
+class ConvLeakyReLU(nn.Module):
+    def __init__(self, weight, bias, stride, padding, dilation, groups):
+        """
+        A conv followed by LeakyReLU, initialized with the batch norm folded weights of a MetaConvNormLayerLeakyReLU.
+        Built from standard modules, so that it can be swapped for its quantized counterpart.
+        :param weight: The fused convolutional weights.
+        :param bias: The fused convolutional bias.
+        :param stride: The convolutional stride.
+        :param padding: The convolutional padding.
+        :param dilation: The convolutional dilation.
+        :param groups: The number of convolutional groups.
+        """
+        super(ConvLeakyReLU, self).__init__()
+        self.conv = nn.Conv2d(in_channels=weight.shape[1] * groups, out_channels=weight.shape[0],
+                              kernel_size=weight.shape[-1], stride=stride, padding=padding, dilation=dilation,
+                              groups=groups, bias=True)
+        with torch.no_grad():
+            self.conv.weight.copy_(weight)
+            self.conv.bias.copy_(bias)
+
+        self.relu = nn.LeakyReLU()
+
+    def forward(self, x):
+        return self.relu(self.conv(x))
+
+
+class FloatSqueezeExcite(nn.Module):
+    def __init__(self, hidden_weights, output_weight, output_bias):
+        """
+        A squeeze excite layer with fixed weights, which dequantizes its input and runs in float between quantized
+        layers.
+        :param hidden_weights: A list of (weights, bias) tuples, one per hidden layer.
+        :param output_weight: The weights of the attention output layer.
+        :param output_bias: The bias of the attention output layer.
+        """
+        super(FloatSqueezeExcite, self).__init__()
+        self.num_hidden_layers = len(hidden_weights)
+        for i, (weight, bias) in enumerate(hidden_weights):
+            self.register_buffer('hidden_weight_{}'.format(i), weight.detach().cpu())
+            self.register_buffer('hidden_bias_{}'.format(i), bias.detach().cpu())
+
+        self.register_buffer('output_weight', output_weight.detach().cpu())
+        self.register_buffer('output_bias', output_bias.detach().cpu())
+        self.dequant = DeQuantStub()
+        self.quant = QuantStub()
+
+    def forward(self, x):
+        hidden_weights = [(getattr(self, 'hidden_weight_{}'.format(i)), getattr(self, 'hidden_bias_{}'.format(i)))
+                          for i in range(self.num_hidden_layers)]
+        out = functional_squeeze_excite(self.dequant(x), hidden_weights=hidden_weights,
+                                        output_weight=self.output_weight, output_bias=self.output_bias)
+        return self.quant(out)
+
+
+class QuantizableFewShotClassifier(nn.Module):
+    def __init__(self, layers, linear_weight, linear_bias, average_pool_features, embedding=None):
+        """
+        A fixed weight inference copy of an adapted classifier, with quant/dequant stubs around the parts that
+        quantize_classifier turns into int8 operations.
+        :param layers: The conv, pooling and squeeze excite layers of the classifier, in order.
+        :param linear_weight: The weights of the linear output layer.
+        :param linear_bias: The bias of the linear output layer.
+        :param average_pool_features: Whether the features are average pooled (True) or flattened (False) before the
+        linear output layer.
+        :param embedding: An optional float module mapping images to the classifier inputs, e.g. the dense net
+        embedding. It is not quantized.
+        """
+        super(QuantizableFewShotClassifier, self).__init__()
+        self.embedding = embedding
+        self.quant = QuantStub()
+        self.layers = nn.ModuleList(layers)
+        self.average_pool_features = average_pool_features
+        self.linear = nn.Linear(in_features=linear_weight.shape[1], out_features=linear_weight.shape[0], bias=True)
+        with torch.no_grad():
+            self.linear.weight.copy_(linear_weight)
+            self.linear.bias.copy_(linear_bias)
+
+        self.dequant = DeQuantStub()
+
+    def forward(self, x):
+        out = x
+
+        if self.embedding is not None:
+            out = self.embedding(out, dropout_training=False)
+
+        out = self.quant(out)
+
+        for layer in self.layers:
+            out = layer(out)
+
+        if self.average_pool_features:
+            out = F.avg_pool2d(out, out.shape[-1])
+
+        out = out.reshape(out.shape[0], -1)
+        out = self.linear(out)
+
+        return self.dequant(out)
+
+
+def build_quantizable_classifier(classifier, num_step, params=None, embedding=None):
+    """
+    Builds a QuantizableFewShotClassifier from a VGGActivationNormNetwork or VGGActivationNormNetworkWithAttention and
+    its adapted fast weights. The batch norm of every conv layer is folded into the conv weights with the running
+    statistics of the given step, as in VGGActivationNormNetwork.get_fused_params.
+    :param classifier: The classifier network.
+    :param num_step: The inner loop step whose batch norm parameters and running statistics are folded.
+    :param params: The adapted fast weights, as passed to the classifier's forward. If None the stored weights are used.
+    :param embedding: An optional float module applied to the images before the classifier.
+    :return: A float QuantizableFewShotClassifier on the cpu.
+    """
+    if type(classifier.num_output_classes) == list:
+        raise NotImplementedError('Quantized export only supports classifiers with a single output layer')
+
+    param_dict = dict()
+
+    if params is not None:
+        param_dict = extract_top_level_dict(current_dict={key: value[0] for key, value in params.items()})
+
+    def get_layer_weights(layer_name):
+        if param_dict.get(layer_name) is not None:
+            return param_dict[layer_name]
+
+        return {name.replace('layer_dict.', ''): param
+                for name, param in classifier.layer_dict[layer_name].named_parameters()}
+
+    def build_conv_layer(layer_name):
+        layer = classifier.layer_dict[layer_name]
+        weight, bias = layer.get_fused_conv_params(num_step=num_step, params=param_dict.get(layer_name))
+        if bias is None:
+            bias = torch.zeros(weight.shape[0])
+
+        return ConvLeakyReLU(weight=weight.detach().cpu(), bias=bias.detach().cpu(), stride=layer.conv.stride,
+                             padding=layer.conv.padding, dilation=layer.conv.dilation_rate, groups=layer.conv.groups)
+
+    def build_squeeze_excite_layer(layer_name):
+        weights = get_layer_weights(layer_name)
+        hidden_weights = [(weights['attention_network_hidden_{}.weights'.format(i)],
+                           weights['attention_network_hidden_{}.bias'.format(i)])
+                          for i in range(classifier.layer_dict[layer_name].num_layers - 1)]
+        return FloatSqueezeExcite(hidden_weights=hidden_weights,
+                                  output_weight=weights['attention_network_output_layer.weights'],
+                                  output_bias=weights['attention_network_output_layer.bias'])
+
+    layers = []
+
+    if isinstance(classifier, VGGActivationNormNetworkWithAttention):
+        for i in range(classifier.num_stages):
+            for j in range(classifier.num_blocks_per_stage):
+                if classifier.use_channel_wise_attention:
+                    layers.append(build_squeeze_excite_layer('attention_layer_{}_{}'.format(i, j)))
+                layers.append(build_conv_layer('conv_{}_{}'.format(i, j)))
+
+            layers.append(nn.MaxPool2d(kernel_size=2, stride=2, padding=0))
+
+        if classifier.use_channel_wise_attention:
+            layers.append(build_squeeze_excite_layer('attention_pre_logit_layer'))
+
+        average_pool_features = True
+    else:
+        for i in range(classifier.num_stages):
+            layers.append(build_conv_layer('conv_{}'.format(i)))
+            layers.append(nn.MaxPool2d(kernel_size=2, stride=2, padding=0))
+
+        average_pool_features = False
+
+    linear_weights = get_layer_weights('linear')
+
+    return QuantizableFewShotClassifier(layers=layers, linear_weight=linear_weights['weights'].detach().cpu(),
+                                        linear_bias=linear_weights['bias'].detach().cpu(),
+                                        average_pool_features=average_pool_features, embedding=embedding)
+
+
+def quantize_classifier(quantizable_classifier, calibration_inputs, backend='fbgemm'):
+    """
+    Statically quantizes the conv and linear layers of a QuantizableFewShotClassifier to int8, calibrating the
+    activation ranges on the given inputs (usually the support set the classifier was adapted on).
+    :param quantizable_classifier: A float QuantizableFewShotClassifier, as returned by build_quantizable_classifier.
+    :param calibration_inputs: A cpu image batch of shape b, c, h, w.
+    :param backend: The quantized engine to target, 'fbgemm' for x86 or 'qnnpack' for arm cpus.
+    :return: The quantized classifier. The float classifier is left unchanged.
+    """
+    torch.backends.quantized.engine = backend
+    quantizable_classifier.eval()
+    quantizable_classifier.qconfig = get_default_qconfig(backend)
+
+    if quantizable_classifier.embedding is not None:
+        quantizable_classifier.embedding.qconfig = None
+
+    prepared_classifier = prepare(quantizable_classifier, inplace=False)
+
+    with torch.no_grad():
+        prepared_classifier(calibration_inputs)
+
+    return convert(prepared_classifier, inplace=False)
+
+
+def evaluate_quantized_inference(model, episode_bank, backend='fbgemm'):
+    """
+    Adapts the model to every task of a fixed bank of episodes, exports a float and an int8 copy of each adapted
+    classifier and compares their target set accuracy and query scoring time on the cpu.
+    :param model: A few shot learning system with an export_quantized_classifier method.
+    :param episode_bank: A list of data batches.
+    :param backend: The quantized engine to target.
+    :return: A dictionary with the fp32 and int8 accuracy, the accuracy delta and the query scoring time of both.
+    """
+    accuracies = {'fp32': [], 'int8': []}
+    scoring_times = {'fp32': 0., 'int8': 0.}
+
+    for data_batch in episode_bank:
+        x_support_set, x_target_set, y_support_set, y_target_set, _, _ = data_batch
+
+        for x_support_set_task, y_support_set_task, x_target_set_task, y_target_set_task in \
+                zip(x_support_set, y_support_set, x_target_set, y_target_set):
+            float_classifier, quantized_classifier = model.export_quantized_classifier(
+                x_support_set=x_support_set_task, y_support_set=y_support_set_task, backend=backend)
+
+            x_target_set_task = x_target_set_task.reshape((-1,) + tuple(x_target_set_task.shape[-3:])).cpu()
+            y_target_set_task = y_target_set_task.reshape(-1).cpu()
+
+            for name, classifier in [('fp32', float_classifier), ('int8', quantized_classifier)]:
+                start_time = time.time()
+                with torch.no_grad():
+                    preds = classifier(x_target_set_task)
+                scoring_times[name] += time.time() - start_time
+                accuracies[name].append(float(torch.eq(preds.argmax(dim=1), y_target_set_task).float().mean()))
+
+    results = {'{}_accuracy'.format(name): float(torch.tensor(values).mean()) for name, values in accuracies.items()}
+    results['accuracy_delta'] = results['int8_accuracy'] - results['fp32_accuracy']
+    results.update({'{}_scoring_time'.format(name): value for name, value in scoring_times.items()})
+    results['scoring_speedup'] = scoring_times['fp32'] / max(scoring_times['int8'], 1e-12)
+
+    return results
@@ -0,0 +1,88 @@
+import sys
+import traceback
+
+from torch.utils.data import DataLoader
+
+from utils.parser_utils import get_args
+
+args, device = get_args()
+
+from utils.dataset_tools import check_download_dataset
+from data import ConvertToThreeChannels, FewShotLearningDatasetParallel
+from torchvision import transforms
+from few_shot_learning_system import EmbeddingMAMLFewShotClassifier, VGGMAMLFewShotClassifier
+
+# Runs one meta training iteration and one evaluation iteration of a MAML based classifier in every meta-gradient mode
+# and with truncated meta-backpropagation horizons.
+# Takes the same arguments as train_continual_learning_few_shot_system.py, and should be run on a high-end (SCA) config
+# with critic (target set) steps as well as on a low-end config, e.g.
+# python smoke_test_meta_gradient_modes.py --name_of_args_json_file experiment_config/<SCA high-end experiment>.json
+# python smoke_test_meta_gradient_modes.py --name_of_args_json_file experiment_config/<low-end experiment>.json
+# Exits with a non-zero status if any of the modes fails.
+
+classifier_types = {'maml++_high-end': EmbeddingMAMLFewShotClassifier,
+                    'maml++_low-end': VGGMAMLFewShotClassifier}
+meta_gradient_options = [dict(meta_gradient_type='maml'),
+                         dict(meta_gradient_type='first_order_maml'),
+                         dict(meta_gradient_type='reptile'),
+                         dict(meta_gradient_type='imaml'),
+                         dict(meta_gradient_type='maml', meta_backprop_horizon=1),
+                         dict(meta_gradient_type='maml', critic_meta_backprop_horizon=0)]
+
+check_download_dataset(dataset_name=args.dataset_name)
+
+if args.image_channels == 3:
+    transforms = [transforms.Resize(size=(args.image_height, args.image_width)), transforms.ToTensor(),
+                  ConvertToThreeChannels(),
+                  transforms.Normalize((0.485, 0.456, 0.406), (0.229, 0.224, 0.225))]
+elif args.image_channels == 1:
+    transforms = [transforms.Resize(size=(args.image_height, args.image_width)), transforms.ToTensor()]
+
+data_batches = dict()
+for set_name in ['train', 'val']:
+    setup_dict = dict(dataset_name=args.dataset_name,
+                      indexes_of_folders_indicating_class=args.indexes_of_folders_indicating_class,
+                      train_val_test_split=args.train_val_test_split,
+                      labels_as_int=args.labels_as_int, transforms=transforms,
+                      num_classes_per_set=args.num_classes_per_set,
+                      num_samples_per_support_class=args.num_samples_per_support_class,
+                      num_samples_per_target_class=args.num_samples_per_target_class,
+                      seed=args.seed,
+                      sets_are_pre_split=args.sets_are_pre_split,
+                      load_into_memory=args.load_into_memory, set_name=set_name,
+                      num_tasks_per_epoch=args.batch_size,
+                      num_channels=args.image_channels,
+                      num_support_sets=args.num_support_sets,
+                      overwrite_classes_in_each_task=args.overwrite_classes_in_each_task,
+                      class_change_interval=args.class_change_interval)
+    data_batches[set_name] = next(iter(DataLoader(FewShotLearningDatasetParallel(**setup_dict),
+                                                  batch_size=args.batch_size,
+                                                  num_workers=args.num_dataprovider_workers)))
+
+if args.classifier_type not in classifier_types:
+    raise NotImplementedError('The meta-gradient modes are only available for the MAML based classifiers')
+
+# every mode starts from the arguments given, only the options it lists are changed
+default_options = {key: getattr(args, key) for options in meta_gradient_options for key in options}
+
+failures = []
+for options in meta_gradient_options:
+    for key, value in dict(default_options, **options).items():
+        setattr(args, key, value)
+    description = ', '.join('{}={}'.format(key, value) for key, value in options.items())
+
+    try:
+        model = classifier_types[args.classifier_type](**args.__dict__)
+        model.run_train_iter(data_batch=data_batches['train'], epoch=0, current_iter=0)
+        model.run_validation_iter(data_batch=data_batches['val'])
+        print("{} num_target_set_steps={} {}: ok".format(args.classifier_type, args.num_target_set_steps,
+                                                          description))
+    except Exception:
+        traceback.print_exc()
+        print("{} num_target_set_steps={} {}: failed".format(args.classifier_type, args.num_target_set_steps,
+                                                              description))
+        failures.append(description)
+    finally:
+        model = None
+
+sys.exit(1 if failures else 0)
@@ -4,6 +4,9 @@ import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
+
+from pytorch_utils import factorized_pairwise_relations
 
 
 class Conv2dNormLeakyReLU(nn.Module):
@@ -47,6 +50,14 @@ class Conv2dNormLeakyReLU(nn.Module):
 
         out = self.layer_dict['conv'].forward(out)
 
+        return self.normalize_and_activate(out)
+
+    def normalize_and_activate(self, out):
+        """
+        Applies the normalization and activation that follow the convolution, to an already convolved input.
+        :param out: The output of this layer's convolution.
+        :return: The normalized and activated output.
+        """
         if self.normalization:
             out = self.layer_dict['norm_layer'](out)
 
@@ -169,7 +180,8 @@ class DenseNetActivationNormNetwork(nn.Module):
 
 class SqueezeExciteDenseNet(nn.Module):
     def __init__(self, im_shape, num_filters, num_stages, num_blocks_per_stage, dropout_rate, average_pool_output,
-                 reduction_rate, output_spatial_dim, use_channel_wise_attention):
+                 reduction_rate, output_spatial_dim, use_channel_wise_attention, memory_efficient=False,
+                 stem_num_filters=64):
         """
         Builds a multilayer convolutional network. It also provides functionality for passing external parameters to be
         used at inference time. Enables inner loop optimization readily.
@@ -179,6 +191,9 @@ class SqueezeExciteDenseNet(nn.Module):
         :param device: The device to run this on.
         :param meta_classifier: A flag indicating whether the system's meta-learning (inner-loop) functionalities should
         be enabled.
+        :param memory_efficient: Whether to recompute the concatenated bottleneck inputs and convolutions in the
+        backward pass instead of storing them, which makes the activation memory linear in the number of blocks.
+        :param stem_num_filters: The number of filters of the stem convolution.
         """
         super(SqueezeExciteDenseNet, self).__init__()
         self.input_shape = list(im_shape)
@@ -193,6 +208,8 @@ class SqueezeExciteDenseNet(nn.Module):
         self.conv_type = Conv2dNormLeakyReLU
         self.layer_dict = nn.ModuleDict()
         self.use_channel_wise_attention = use_channel_wise_attention
+        self.memory_efficient = memory_efficient
+        self.stem_num_filters = stem_num_filters
         self.build_network()
 
     def build_network(self):
@@ -204,7 +221,7 @@ class SqueezeExciteDenseNet(nn.Module):
         x = torch.zeros(self.input_shape)
         out = x
 
-        self.layer_dict['stem_conv'] = Conv2dNormLeakyReLU(input_shape=out.shape, num_filters=64,
+        self.layer_dict['stem_conv'] = Conv2dNormLeakyReLU(input_shape=out.shape, num_filters=self.stem_num_filters,
                                                            kernel_size=3, padding=1, groups=1)
 
         out = self.layer_dict['stem_conv'](out)
@@ -252,6 +269,102 @@ class SqueezeExciteDenseNet(nn.Module):
 
         print(out.shape)
 
+    def concatenated_bottleneck_conv(self, bottleneck, channel_scale, *features):
+        """
+        Concatenates the features of a dense stage, applies the accumulated channel wise attention and the bottleneck
+        convolution. Kept separate so that it can be recomputed in the backward pass.
+        :param bottleneck: The bottleneck layer.
+        :param channel_scale: A (b, c) tensor with the accumulated channel wise attention, or None.
+        :param features: The features of the stage so far, concatenated along the channel dimension.
+        :return: The bottleneck convolution output, before normalization.
+        """
+        out = features[0] if len(features) == 1 else torch.cat(features, dim=1)
+
+        if channel_scale is not None:
+            out = out * channel_scale.unsqueeze(2).unsqueeze(2)
+
+        return bottleneck.layer_dict['conv'].forward(out)
+
+    def stage_forward(self, x, stage_idx, dropout_training):
+        """
+        Forward propagates through the dense blocks of a stage. Rather than concatenating the growing feature map after
+        every block, the block outputs are kept as separate tensors (or, when no graph is built, written by channel
+        slice into a feature buffer preallocated for the whole stage) and only concatenated as bottleneck inputs. The
+        channel wise attention, which rescales all previous channels, is accumulated as a per channel scale instead of
+        being applied to the stored features.
+        :param x: The stage input.
+        :param stage_idx: The index of the stage.
+        :param dropout_training: Whether to apply dropout.
+        :return: The stage output, average pooled but before the transition layer.
+        """
+        b, num_channels, h, w = x.shape
+        use_feature_buffer = not torch.is_grad_enabled()
+
+        if use_feature_buffer:
+            memory_format = torch.channels_last if x.is_contiguous(memory_format=torch.channels_last) else \
+                torch.contiguous_format
+            feature_buffer = torch.empty(b, num_channels + self.num_blocks_per_stage * self.num_filters, h, w,
+                                         dtype=x.dtype, device=x.device, memory_format=memory_format)
+            feature_buffer[:, :num_channels] = x
+        else:
+            features = [x]
+
+        feature_means = [x.mean(dim=(2, 3))] if self.use_channel_wise_attention else []
+        channel_scale = None
+
+        for j in range(self.num_blocks_per_stage):
+            if channel_scale is not None and channel_scale.shape[1] < num_channels:
+                channel_scale = torch.cat([channel_scale, channel_scale.new_ones(
+                    b, num_channels - channel_scale.shape[1])], dim=1)
+
+            if self.use_channel_wise_attention:
+                out_channels = torch.cat(feature_means, dim=1)
+                if channel_scale is not None:
+                    out_channels = out_channels * channel_scale
+
+                channel_wise_attention_regions = self.layer_dict[
+                    'channel_wise_attention_output_fcc_{}_{}'.format(j, stage_idx)].forward(out_channels)
+
+                channel_wise_attention_regions = F.sigmoid(channel_wise_attention_regions)
+                channel_scale = channel_wise_attention_regions if channel_scale is None else \
+                    channel_scale * channel_wise_attention_regions
+
+            bottleneck = self.layer_dict['conv_bottleneck_{}_{}'.format(stage_idx, j)]
+            if use_feature_buffer:
+                cur = self.concatenated_bottleneck_conv(bottleneck, channel_scale,
+                                                        feature_buffer[:, :num_channels])
+            elif self.memory_efficient:
+                cur = checkpoint(self.concatenated_bottleneck_conv, bottleneck, channel_scale, *features,
+                                 use_reentrant=False)
+            else:
+                cur = self.concatenated_bottleneck_conv(bottleneck, channel_scale, *features)
+
+            cur = bottleneck.normalize_and_activate(cur)
+            cur = self.layer_dict['conv_{}_{}'.format(stage_idx, j)](cur)
+            cur = F.dropout(cur, p=self.dropout_rate, training=dropout_training)
+
+            if use_feature_buffer:
+                feature_buffer[:, num_channels:num_channels + cur.shape[1]] = cur
+            else:
+                features.append(cur)
+
+            num_channels += cur.shape[1]
+            if self.use_channel_wise_attention:
+                feature_means.append(cur.mean(dim=(2, 3)))
+
+        # the channel wise scale commutes with the average pooling, so each feature is pooled on its own
+        if use_feature_buffer:
+            out = F.avg_pool2d(feature_buffer[:, :num_channels], 2)
+        else:
+            out = torch.cat([F.avg_pool2d(feature, 2) for feature in features], dim=1)
+
+        if channel_scale is not None:
+            channel_scale = torch.cat([channel_scale, channel_scale.new_ones(
+                b, num_channels - channel_scale.shape[1])], dim=1)
+            out = out * channel_scale.unsqueeze(2).unsqueeze(2)
+
+        return out
+
     def forward(self, x, dropout_training):
         """
         Forward propages through the network. If any params are passed then they are used instead of stored params.
@@ -268,23 +381,7 @@ class SqueezeExciteDenseNet(nn.Module):
 
         out = self.layer_dict['stem_conv'](out)
         for i in range(self.num_stages):
-            for j in range(self.num_blocks_per_stage):
-                # out_channels = F.avg_pool2d(out, out.shape[-1]).squeeze()
-                if self.use_channel_wise_attention:
-                    out_channels = F.avg_pool2d(out, out.shape[-1]).squeeze()
-
-                    channel_wise_attention_regions = self.layer_dict[
-                        'channel_wise_attention_output_fcc_{}_{}'.format(j, i)].forward(out_channels)
-
-                    channel_wise_attention_regions = F.sigmoid(channel_wise_attention_regions)
-                    out = out * channel_wise_attention_regions.unsqueeze(2).unsqueeze(2)
-
-                cur = self.layer_dict['conv_bottleneck_{}_{}'.format(i, j)](out)
-                cur = self.layer_dict['conv_{}_{}'.format(i, j)](cur)
-                cur = F.dropout(cur, p=self.dropout_rate, training=dropout_training)
-                out = torch.cat([out, cur], dim=1)
-
-            out = F.avg_pool2d(out, 2)
+            out = self.stage_forward(out, stage_idx=i, dropout_training=dropout_training)
             out = self.layer_dict['transition_layer_{}'.format(i)](out)
 
         if self.average_pool_output:
@@ -667,13 +764,22 @@ class CriticNetwork(nn.Module):
 
 
 class TaskRelationalEmbedding(nn.Module):
-    def __init__(self, input_shape, num_samples_per_support_class, num_classes_per_set):
+    def __init__(self, input_shape, num_samples_per_support_class, num_classes_per_set, pair_chunk_size=16):
+        """
+        Builds a task embedding from the pairwise relations of the support set items. The first linear layer of g is
+        factorized over the two items of a pair, so the (b x b x 2f) pair tensor is never built.
+        :param input_shape: The shape of the support set features, in the form (b, f)
+        :param num_samples_per_support_class: Number of samples per support set class.
+        :param num_classes_per_set: Number of classes per support set.
+        :param pair_chunk_size: Number of items whose pairs are evaluated at once by the later layers of g.
+        """
         super(TaskRelationalEmbedding, self).__init__()
 
         self.input_shape = input_shape
         self.block_dict = nn.ModuleDict()
         self.num_samples_per_class = num_samples_per_support_class
         self.num_classes_per_set = num_classes_per_set
+        self.pair_chunk_size = pair_chunk_size
         self.first_time = True
         self.build_block()
 
@@ -682,38 +788,29 @@ class TaskRelationalEmbedding(nn.Module):
         """g"""
         b, f = out_img.shape
         print(out_img.shape)
-        out_img = out_img.view(b, f)
-        print(out_img.shape)
         # x_flat = (64 x 25 x 24)
         self.coord_tensor = []
         for i in range(b):
             self.coord_tensor.append(torch.Tensor(np.array([i])))
 
         self.coord_tensor = torch.stack(self.coord_tensor, dim=0)
-        out_img = torch.cat([out_img, self.coord_tensor], dim=1)
-
-        x_i = torch.unsqueeze(out_img, 0)  # (1xh*wxc)
-        x_i = x_i.repeat(b, 1, 1)  # (h*wxh*wxc)
-        x_j = torch.unsqueeze(out_img, 1)  # (h*wx1xc)
-        x_j = x_j.repeat(1, b, 1)  # (h*wxh*wxc)
 
-        # concatenate all together
-        out = torch.cat([x_i, x_j], 2)  # (h*wxh*wx2*c)
-        prev_shape = out.shape
-        out = out.view(out.shape[0] * out.shape[1], out.shape[-1])
+        in_features = 2 * (f + 1)
         for idx_layer in range(3):
-            self.block_dict['g_fcc_{}'.format(idx_layer)] = nn.Linear(out.shape[1], out_features=32)
-            out = F.relu(self.block_dict['g_fcc_{}'.format(idx_layer)].forward(out))
+            self.block_dict['g_fcc_{}'.format(idx_layer)] = nn.Linear(in_features, out_features=32)
+            in_features = 32
 
-        # reshape again and sum
-
-        out = out.view(prev_shape[0], prev_shape[1], out.shape[-1])
-        out = out.sum(1)
-        out = out.view(self.num_classes_per_set, self.num_samples_per_class, -1)
-        out = out.mean(1).view(1, -1)
+        out = self.forward(out_img)
 
         print('Task Relational Network Block built with output volume shape', out.shape)
 
+    def apply_pair_layers(self, pair_features):
+        out = F.relu(pair_features)
+        for idx_layer in range(1, 3):
+            out = F.relu(self.block_dict['g_fcc_{}'.format(idx_layer)].forward(out))
+
+        return out
+
     def forward(self, x_img):
 
         out_img = x_img
@@ -725,24 +822,12 @@ class TaskRelationalEmbedding(nn.Module):
         out_img = torch.cat([out_img, self.coord_tensor.to(x_img.device)], dim=1)
         # x_flat = (64 x 25 x 24)
         # print('out_img', out_img.shape)
-        x_i = torch.unsqueeze(out_img, 0)  # (1xh*wxc)
-        x_i = x_i.repeat(b, 1, 1)  # (h*wxh*wxc)
-        x_j = torch.unsqueeze(out_img, 1)  # (h*wx1xc)
-        x_j = x_j.repeat(1, b, 1)  # (h*wxh*wxc)
-
-        # concatenate all together
-        out = torch.cat([x_i, x_j], 2)  # (h*wxh*wx2*c)
-
-        prev_shape = out.shape
-        out = out.view(out.shape[0] * out.shape[1], out.shape[-1])
-        for idx_layer in range(3):
-            print(idx_layer, out.shape)
-            out = F.relu(self.block_dict['g_fcc_{}'.format(idx_layer)].forward(out))
+        first_layer = self.block_dict['g_fcc_0']
+        out = factorized_pairwise_relations(items=out_img.unsqueeze(0), first_layer_weight=first_layer.weight,
+                                            first_layer_bias=first_layer.bias, pair_function=self.apply_pair_layers,
+                                            chunk_size=self.pair_chunk_size)[0]
 
-        # reshape again and sum
-        # print(out.shape)
-        out = out.view(prev_shape[0], prev_shape[1], out.shape[-1])
-        out = out.sum(1)
+        # per item sums, averaged per class
         out = out.view(self.num_classes_per_set, self.num_samples_per_class, -1)
         out = out.mean(1).view(1, -1)
 
@@ -755,11 +840,18 @@ class TaskRelationalEmbedding(nn.Module):
 
 
 class RelationalModule(nn.Module):
-    def __init__(self, input_shape):
+    def __init__(self, input_shape, pair_chunk_size=16):
+        """
+        Builds a relational embedding of the spatial locations of a single feature map. The first linear layer of g is
+        factorized over the two locations of a pair, so the (h*w x h*w x 2c) pair tensor is never built.
+        :param input_shape: The shape of the feature map, in the form (c, h, w)
+        :param pair_chunk_size: Number of locations whose pairs are evaluated at once by the later layers of g.
+        """
         super(RelationalModule, self).__init__()
 
         self.input_shape = input_shape
         self.block_dict = nn.ModuleDict()
+        self.pair_chunk_size = pair_chunk_size
         self.first_time = True
         self.build_block()
 
@@ -768,42 +860,30 @@ class RelationalModule(nn.Module):
         """g"""
         c, h, w = out_img.shape
         print(out_img.shape)
-        out_img = out_img.view(c, h * w)
-        out_img = out_img.permute([1, 0])  # h*w, c
-        print(out_img.shape)
         # x_flat = (64 x 25 x 24)
         self.coord_tensor = []
         for i in range(h * w):
             self.coord_tensor.append(torch.Tensor(np.array([i])))
 
         self.coord_tensor = torch.stack(self.coord_tensor, dim=0)
-        out_img = torch.cat([out_img, self.coord_tensor], dim=1)
-
-        x_i = torch.unsqueeze(out_img, 0)  # (1xh*wxc)
-        x_i = x_i.repeat(h * w, 1, 1)  # (h*wxh*wxc)
-        x_j = torch.unsqueeze(out_img, 1)  # (h*wx1xc)
-        x_j = x_j.repeat(1, h * w, 1)  # (h*wxh*wxc)
-
-        # concatenate all together
-        out = torch.cat([x_i, x_j], 2)  # (h*wxh*wx2*c)
 
-        out = out.view(out.shape[0] * out.shape[1], out.shape[2])
+        in_features = 2 * (c + 1)
         for idx_layer in range(2):
-            self.block_dict['g_fcc_{}'.format(idx_layer)] = nn.Linear(out.shape[1], out_features=32)
-            out = F.leaky_relu(self.block_dict['g_fcc_{}'.format(idx_layer)].forward(out))
-
-        # reshape again and sum
-        print(out.shape)
-        out = out.sum(0).view(1, -1)
+            self.block_dict['g_fcc_{}'.format(idx_layer)] = nn.Linear(in_features, out_features=32)
+            in_features = 32
 
         """f"""
-        self.post_processing_layer = nn.Linear(in_features=out.shape[1], out_features=32)
-        out = self.post_processing_layer.forward(out)
-        out = F.relu(out)
-        self.output_layer = nn.Linear(in_features=out.shape[1], out_features=32)
-        out = self.output_layer.forward(out)
+        self.post_processing_layer = nn.Linear(in_features=32, out_features=32)
+        self.output_layer = nn.Linear(in_features=32, out_features=32)
+        out = self.forward(out_img)
         print('Block built with output volume shape', out.shape)
 
+    def apply_pair_layers(self, pair_features):
+        out = F.leaky_relu(pair_features)
+        out = F.leaky_relu(self.block_dict['g_fcc_1'].forward(out))
+
+        return out
+
     def forward(self, x_img):
 
         out_img = x_img
@@ -815,20 +895,13 @@ class RelationalModule(nn.Module):
         out_img = torch.cat([out_img, self.coord_tensor.to(x_img.device)], dim=1)
         # x_flat = (64 x 25 x 24)
         # print('out_img', out_img.shape)
-        x_i = torch.unsqueeze(out_img, 0)  # (1xh*wxc)
-        x_i = x_i.repeat(h * w, 1, 1)  # (h*wxh*wxc)
-        x_j = torch.unsqueeze(out_img, 1)  # (h*wx1xc)
-        x_j = x_j.repeat(1, h * w, 1)  # (h*wxh*wxc)
-
-        # concatenate all together
-        out = torch.cat([x_i, x_j], 2)  # (h*wxh*wx2*c)
-        out = out.view(out.shape[0] * out.shape[1], out.shape[2])
-        for idx_layer in range(2):
-            out = F.leaky_relu(self.block_dict['g_fcc_{}'.format(idx_layer)].forward(out))
+        first_layer = self.block_dict['g_fcc_0']
+        out = factorized_pairwise_relations(items=out_img.unsqueeze(0), first_layer_weight=first_layer.weight,
+                                            first_layer_bias=first_layer.bias, pair_function=self.apply_pair_layers,
+                                            chunk_size=self.pair_chunk_size)
 
-        # reshape again and sum
-        # print(out.shape)
-        out = out.sum(0).view(1, -1)
+        # sum over all pairs
+        out = out.sum(1)
 
         """f"""
         out = self.post_processing_layer.forward(out)
@@ -839,7 +912,16 @@ class RelationalModule(nn.Module):
 
 
 class BatchRelationalModule(nn.Module):
-    def __init__(self, input_shape, use_coordinates=True, num_layers=2, num_units=64):
+    def __init__(self, input_shape, use_coordinates=True, num_layers=2, num_units=64, pair_chunk_size=16):
+        """
+        Builds a relational embedding of the spatial locations of a batch of feature maps. The first linear layer of g
+        is factorized over the two locations of a pair, so the (b x h*w x h*w x 2c) pair tensor is never built.
+        :param input_shape: The shape of the feature maps, in the form (b, c, h, w) or (b, c, length)
+        :param use_coordinates: Whether to append the location index to the features of each location.
+        :param num_layers: Number of layers of g.
+        :param num_units: Number of units of every layer.
+        :param pair_chunk_size: Number of locations whose pairs are evaluated at once by the later layers of g.
+        """
         super(BatchRelationalModule, self).__init__()
 
         self.input_shape = input_shape
@@ -848,6 +930,7 @@ class BatchRelationalModule(nn.Module):
         self.use_coordinates = use_coordinates
         self.num_layers = num_layers
         self.num_units = num_units
+        self.pair_chunk_size = pair_chunk_size
         self.build_block()
 
     def build_block(self):
@@ -872,43 +955,31 @@ class BatchRelationalModule(nn.Module):
             if self.coord_tensor.shape[0] != out_img.shape[0]:
                 self.coord_tensor = self.coord_tensor[0].unsqueeze(0).repeat([out_img.shape[0], 1, 1])
 
-            out_img = torch.cat([out_img, self.coord_tensor], dim=2)
-
-        x_i = torch.unsqueeze(out_img, 1)  # (1xh*wxc)
-        x_i = x_i.repeat(1, length, 1, 1)  # (h*wxh*wxc)
-        x_j = torch.unsqueeze(out_img, 2)  # (h*wx1xc)
-        x_j = x_j.repeat(1, 1, length, 1)  # (h*wxh*wxc)
-
-        # concatenate all together
-        per_location_feature = torch.cat([x_i, x_j], 3)  # (h*wxh*wx2*c)
+            c += 1
 
-        out = per_location_feature.view(
-            per_location_feature.shape[0] * per_location_feature.shape[1] * per_location_feature.shape[2],
-            per_location_feature.shape[3])
-        print(out.shape)
+        in_features = 2 * c
         for idx_layer in range(self.num_layers):
-            self.block_dict['g_fcc_{}'.format(idx_layer)] = nn.Linear(out.shape[1], out_features=self.num_units,
+            self.block_dict['g_fcc_{}'.format(idx_layer)] = nn.Linear(in_features, out_features=self.num_units,
                                                                       bias=True)
-            out = self.block_dict['g_fcc_{}'.format(idx_layer)].forward(out)
             self.block_dict['LeakyReLU_{}'.format(idx_layer)] = nn.LeakyReLU()
-            out = self.block_dict['LeakyReLU_{}'.format(idx_layer)].forward(out)
+            in_features = self.num_units
 
-        # reshape again and sum
-        print(out.shape)
-        out = out.view(per_location_feature.shape[0], per_location_feature.shape[1], per_location_feature.shape[2], -1)
-        out = out.sum(1).sum(1)
-        print('here', out.shape)
         """f"""
-        self.post_processing_layer = nn.Linear(in_features=out.shape[1], out_features=self.num_units)
-        out = self.post_processing_layer.forward(out)
+        self.post_processing_layer = nn.Linear(in_features=self.num_units, out_features=self.num_units)
         self.block_dict['LeakyReLU_post_processing'] = nn.LeakyReLU()
-        out = self.block_dict['LeakyReLU_post_processing'].forward(out)
-        self.output_layer = nn.Linear(in_features=out.shape[1], out_features=self.num_units)
-        out = self.output_layer.forward(out)
+        self.output_layer = nn.Linear(in_features=self.num_units, out_features=self.num_units)
         self.block_dict['LeakyReLU_output'] = nn.LeakyReLU()
-        out = self.block_dict['LeakyReLU_output'].forward(out)
+        out = self.forward(torch.zeros(self.input_shape))
         print('Block built with output volume shape', out.shape)
 
+    def apply_pair_layers(self, pair_features):
+        out = self.block_dict['LeakyReLU_0'].forward(pair_features)
+        for idx_layer in range(1, self.num_layers):
+            out = self.block_dict['g_fcc_{}'.format(idx_layer)].forward(out)
+            out = self.block_dict['LeakyReLU_{}'.format(idx_layer)].forward(out)
+
+        return out
+
     def forward(self, x_img):
 
         out_img = x_img
@@ -928,25 +999,13 @@ class BatchRelationalModule(nn.Module):
             out_img = torch.cat([out_img, self.coord_tensor.to(x_img.device)], dim=2)
         # x_flat = (64 x 25 x 24)
         # print('out_img', out_img.shape)
-        x_i = torch.unsqueeze(out_img, 1)  # (1xh*wxc)
-        x_i = x_i.repeat(1, length, 1, 1)  # (h*wxh*wxc)
-        x_j = torch.unsqueeze(out_img, 2)  # (h*wx1xc)
-        x_j = x_j.repeat(1, 1, length, 1)  # (h*wxh*wxc)
-
-        # concatenate all together
-        per_location_feature = torch.cat([x_i, x_j], 3)  # (h*wxh*wx2*c)
-        out = per_location_feature.view(
-            per_location_feature.shape[0] * per_location_feature.shape[1] * per_location_feature.shape[2],
-            per_location_feature.shape[3])
-
-        for idx_layer in range(2):
-            out = self.block_dict['g_fcc_{}'.format(idx_layer)].forward(out)
-            out = self.block_dict['LeakyReLU_{}'.format(idx_layer)].forward(out)
+        first_layer = self.block_dict['g_fcc_0']
+        out = factorized_pairwise_relations(items=out_img, first_layer_weight=first_layer.weight,
+                                            first_layer_bias=first_layer.bias, pair_function=self.apply_pair_layers,
+                                            chunk_size=self.pair_chunk_size)
 
-        # reshape again and sum
-        # print(out.shape)
-        out = out.view(per_location_feature.shape[0], per_location_feature.shape[1], per_location_feature.shape[2], -1)
-        out = out.sum(1).sum(1)
+        # sum over all pairs
+        out = out.sum(1)
 
         """f"""
         out = self.post_processing_layer.forward(out)
@@ -1007,7 +1066,13 @@ class SqueezeExciteDenseNetEmbeddingSmallNetwork(nn.Module):
     def __init__(self, im_shape, num_filters, num_blocks_per_stage, num_stages, dropout_rate,
                  output_spatial_dimensionality, use_channel_wise_attention, average_pool_outputs=True,
                  use_vgg_features=False,
-                 conv_type=Conv2dNormLeakyReLU):
+                 conv_type=Conv2dNormLeakyReLU, memory_efficient=False, stem_num_filters=64, output_num_filters=None):
+        """
+        Builds the squeeze excite dense net embedding of the high-end systems.
+        :param stem_num_filters: The number of filters of the stem convolution.
+        :param output_num_filters: If not None, a 1x1 convolution projects the embedding to this number of channels,
+        e.g. to match the embedding of a wider (teacher) backbone whose classifier is reused.
+        """
         super(SqueezeExciteDenseNetEmbeddingSmallNetwork, self).__init__()
         b, c, self.h, self.w = im_shape
         self.total_layers = 0
@@ -1021,6 +1086,9 @@ class SqueezeExciteDenseNetEmbeddingSmallNetwork(nn.Module):
         self.use_channel_wise_attention = use_channel_wise_attention
         self.dropout_rate = dropout_rate
         self.conv_type = conv_type
+        self.memory_efficient = memory_efficient
+        self.stem_num_filters = stem_num_filters
+        self.output_num_filters = output_num_filters
         self.layer_dict = nn.ModuleDict()
         self.build_block()
 
@@ -1035,9 +1103,16 @@ class SqueezeExciteDenseNetEmbeddingSmallNetwork(nn.Module):
                                                                       reduction_rate=1.0,
                                                                       average_pool_output=self.average_pool_outputs,
                                                                       output_spatial_dim=self.output_spatial_dimensionality,
-                                                                      use_channel_wise_attention=self.use_channel_wise_attention)
+                                                                      use_channel_wise_attention=self.use_channel_wise_attention,
+                                                                      memory_efficient=self.memory_efficient,
+                                                                      stem_num_filters=self.stem_num_filters)
         out = self.layer_dict['dense_net_features'].forward(out, dropout_training=False)
 
+        if self.output_num_filters is not None:
+            self.layer_dict['output_projection'] = nn.Conv2d(in_channels=out.shape[1],
+                                                             out_channels=self.output_num_filters, kernel_size=1)
+            out = self.layer_dict['output_projection'].forward(out)
+
         print("DenseEmbeddingSmallNetwork output shape", out.shape)
         return out
 
@@ -1045,6 +1120,9 @@ class SqueezeExciteDenseNetEmbeddingSmallNetwork(nn.Module):
         out = x
         # print("inputs", x.shape)
         out = self.layer_dict['dense_net_features'].forward(out, dropout_training=dropout_training)
+
+        if self.output_num_filters is not None:
+            out = self.layer_dict['output_projection'].forward(out)
         # out = out.view(out.shape[0], out.shape[1], 1, 1)
         # b, c, h, w = out.shape
         return out
@@ -1158,7 +1236,7 @@ class VGGEmbeddingNetwork(nn.Module):
 
         # print(out.shape)
         features = out
-        out = out.view(out.size(0), -1)
+        out = out.reshape(out.size(0), -1)
         return out, features
 
     def reinitialize(self):
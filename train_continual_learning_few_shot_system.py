@@ -1,3 +1,6 @@
+import os
+import sys
+
 from torch.utils.data import DataLoader
 
 from utils.parser_utils import get_args
@@ -9,9 +12,25 @@ from data import ConvertToThreeChannels, FewShotLearningDatasetParallel
 from torchvision import transforms
 from experiment_builder import ExperimentBuilder
 from few_shot_learning_system import *
+from utils.distributed import init_distributed, get_launch_rank, get_launch_world_size
+from utils.parameter_server import run_parameter_server, init_parameter_server_worker, \
+    shutdown_parameter_server_worker
+from utils.storage import build_experiment_folder
 
 # Combines the arguments, model, data and experiment builders to run an experiment
 
+process_rank = get_launch_rank(args.distributed_rank)
+
+if args.parameter_server_num_workers > 0:
+    # rank 0 is the parameter server, ranks 1 to parameter_server_num_workers are the workers, which also form a
+    # process group of their own to shard the tasks and share the validation metrics
+    if process_rank > 0 and args.parameter_server_num_workers > 1:
+        init_distributed(backend=args.distributed_backend, init_method=args.distributed_init_method,
+                         rank=process_rank - 1, world_size=args.parameter_server_num_workers)
+elif args.distributed_world_size > 1:
+    init_distributed(backend=args.distributed_backend, init_method=args.distributed_init_method,
+                     rank=process_rank, world_size=get_launch_world_size(args.distributed_world_size))
+
 if args.classifier_type == 'maml++_high-end':
     model = EmbeddingMAMLFewShotClassifier(**args.__dict__)
 elif args.classifier_type == 'maml++_low-end':
@@ -25,6 +44,24 @@ elif args.classifier_type == 'vgg-matching_network':
 else:
     raise NotImplementedError
 
+if args.parameter_server_num_workers > 0:
+    if not isinstance(model, MAMLFewShotClassifier):
+        raise NotImplementedError('The parameter server mode only supports the MAML based classifiers')
+
+    if process_rank == 0:
+        saved_models_filepath, _, _ = build_experiment_folder(experiment_name=args.experiment_name)
+        if os.path.exists(os.path.join(saved_models_filepath, "train_model_{}".format(args.continue_from_epoch))):
+            model.load_model(model_save_dir=saved_models_filepath, model_name="train_model",
+                             model_idx=args.continue_from_epoch)
+
+        run_parameter_server(model=model, num_workers=args.parameter_server_num_workers,
+                             init_method=args.parameter_server_init_method,
+                             max_staleness=args.parameter_server_max_staleness)
+        sys.exit(0)
+
+    init_parameter_server_worker(worker_idx=process_rank - 1, num_workers=args.parameter_server_num_workers,
+                                 init_method=args.parameter_server_init_method)
+
 check_download_dataset(dataset_name=args.dataset_name)
 
 if args.image_channels == 3:
@@ -103,3 +140,6 @@ maml_system = ExperimentBuilder(model=model, data_dict=data_dict, experiment_nam
                                 evaluate_on_test_set_only=args.evaluate_on_test_set_only,
                                 args=args)
 maml_system.run_experiment()
+
+if args.parameter_server_num_workers > 0:
+    shutdown_parameter_server_worker()
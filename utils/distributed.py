@@ -0,0 +1,129 @@
+import os
+
+import torch
+import torch.distributed as dist
+from torch.utils.data import DataLoader, DistributedSampler
+
+
+def get_launch_rank(rank):
+    """
+    Returns the rank of this process, taken from the RANK environment variable when set (e.g. by torchrun).
+    :param rank: The rank to use otherwise.
+    """
+    return int(os.environ.get('RANK', rank))
+
+
+def get_launch_world_size(world_size):
+    """
+    Returns the number of processes, taken from the WORLD_SIZE environment variable when set (e.g. by torchrun).
+    :param world_size: The number of processes to use otherwise.
+    """
+    return int(os.environ.get('WORLD_SIZE', world_size))
+
+
+def init_distributed(backend, init_method, rank, world_size):
+    """
+    Joins the process group of a distributed (multi process) experiment.
+    :param backend: The torch.distributed backend, e.g. gloo for cpu processes on one or more machines.
+    :param init_method: The url used to find the other processes, e.g. env:// or tcp://127.0.0.1:29500
+    :param rank: The rank of this process.
+    :param world_size: The number of processes.
+    """
+    dist.init_process_group(backend=backend, init_method=init_method, rank=rank, world_size=world_size)
+    print("joined process group as rank {} of {}".format(rank, world_size))
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def shard_data_loader(data_loader):
+    """
+    Rebuilds a task data loader so that every rank loads a disjoint shard of each meta batch. Rank r loads the tasks
+    r, r + world_size, r + 2 * world_size, ... in meta batches of batch_size / world_size tasks, so the ranks together
+    cover the same tasks per iteration as a single process.
+    :param data_loader: A DataLoader over a FewShotLearningDatasetParallel.
+    :return: The sharded DataLoader.
+    """
+    world_size = get_world_size()
+    if data_loader.batch_size % world_size != 0:
+        raise ValueError('The batch size {} is not divisible by the world size {}'.format(data_loader.batch_size,
+                                                                                           world_size))
+
+    sampler = DistributedSampler(data_loader.dataset, num_replicas=world_size, rank=get_rank(), shuffle=False,
+                                 drop_last=True)
+
+    return DataLoader(data_loader.dataset, batch_size=data_loader.batch_size // world_size, sampler=sampler,
+                      num_workers=data_loader.num_workers)
+
+
+def broadcast_module(module, src=0):
+    """
+    Copies the parameters and buffers of the module on rank src to every other rank.
+    :param module: The module to synchronize.
+    :param src: The rank whose values are broadcast.
+    """
+    for tensor in module.state_dict().values():
+        if torch.is_tensor(tensor):
+            dist.broadcast(tensor, src=src)
+
+
+def broadcast_object(obj, src=0):
+    """
+    Returns the value of a picklable python object on rank src, on every rank.
+    :param obj: The object of this rank.
+    :param src: The rank whose object is broadcast.
+    """
+    objects = [obj]
+    dist.broadcast_object_list(objects, src=src)
+
+    return objects[0]
+
+
+def all_reduce_gradients(parameters):
+    """
+    Averages the gradients of the given parameters across the ranks, in a single all-reduce over one flat buffer.
+    Parameters without a gradient contribute zeros, so the ranks always reduce buffers of the same layout, and keep
+    no gradient if no rank computed one, so that the optimizer still skips them.
+    :param parameters: An iterable of the parameters the optimizer steps on, in the same order on every rank.
+    """
+    parameters = list(parameters)
+    if len(parameters) == 0:
+        return
+
+    has_grad = torch.tensor([param.grad is not None for param in parameters], dtype=torch.float32)
+    grads = [param.grad if param.grad is not None else torch.zeros_like(param) for param in parameters]
+    flat_grads = torch.cat([grad.reshape(-1) for grad in grads] + [has_grad.to(grads[0].device)])
+    dist.all_reduce(flat_grads, op=dist.ReduceOp.SUM)
+    flat_grads /= get_world_size()
+
+    offset = 0
+    has_grad = flat_grads[-len(parameters):].cpu() > 0
+    for param, param_has_grad in zip(parameters, has_grad):
+        num_elements = param.numel()
+        param.grad = flat_grads[offset:offset + num_elements].view_as(param) if param_has_grad else None
+        offset += num_elements
+
+
+def gather_metrics(total_losses):
+    """
+    Concatenates the per iteration metric lists of every rank, so that summaries are computed over all the tasks.
+    :param total_losses: A dictionary of lists of python floats.
+    :return: A dictionary with the same keys and the values of all ranks.
+    """
+    gathered_losses = [None for _ in range(get_world_size())]
+    dist.all_gather_object(gathered_losses, total_losses)
+
+    return {key: [value for rank_losses in gathered_losses for value in rank_losses[key]] for key in total_losses}
@@ -0,0 +1,133 @@
+import threading
+
+import torch
+import torch.distributed.rpc as rpc
+
+PARAMETER_SERVER_NAME = "parameter_server"
+
+# the ParameterServer of the server process, used by the functions the workers call over rpc
+_parameter_server = None
+# whether this process is a worker of an asynchronous parameter server experiment
+_is_worker = False
+
+
+class ParameterServer(object):
+    def __init__(self, model, max_staleness):
+        """
+        Holds the meta-parameters of an asynchronous meta-training experiment. Workers pull the meta-parameters,
+        compute the meta-gradients of their own tasks and push them back, and the server applies them with the
+        optimizer and learning rate schedule of the model (as set up by its __init__ and switch_opt_params).
+        :param model: A few shot learning system, whose optimizer steps on the meta-parameters.
+        :param max_staleness: The largest number of server updates applied between a worker's pull and its push for
+        which the pushed meta-gradients are still applied. Staler meta-gradients are dropped.
+        """
+        self.model = model
+        self.max_staleness = max_staleness
+        self.version = 0
+        self.num_dropped_updates = 0
+        self.lock = threading.RLock()
+        self.parameters = {name: param for name, param in model.named_parameters() if param.requires_grad}
+
+    def get_parameters(self):
+        """
+        Returns the current version (number of applied updates) and a cpu copy of the meta-parameters.
+        """
+        with self.lock:
+            return self.version, {name: param.detach().cpu().clone() for name, param in self.parameters.items()}
+
+    def apply_gradients(self, gradients, version, epoch):
+        """
+        Applies the meta-gradients a worker computed with the meta-parameters of the given version, unless more than
+        max_staleness updates were applied since.
+        :param gradients: A dictionary of meta-gradients, keyed by parameter name. Missing parameters get no update.
+        :param version: The version of the meta-parameters the meta-gradients were computed with.
+        :param epoch: The current epoch of the worker, which sets the learning rate.
+        :return: The current version and a copy of the meta-parameters.
+        """
+        with self.lock:
+            if self.version - version <= self.max_staleness:
+                self.model.optimizer.zero_grad()
+                for name, gradient in gradients.items():
+                    param = self.parameters[name]
+                    param.grad = gradient.to(device=param.device, dtype=param.dtype)
+
+                self.model.scheduler.step(epoch=epoch)
+                self.model.optimizer.step()
+                self.model.optimizer.zero_grad()
+                self.version += 1
+            else:
+                self.num_dropped_updates += 1
+
+            return self.get_parameters()
+
+
+def _pull_parameters():
+    return _parameter_server.get_parameters()
+
+
+def _push_gradients(gradients, version, epoch):
+    return _parameter_server.apply_gradients(gradients=gradients, version=version, epoch=epoch)
+
+
+def run_parameter_server(model, num_workers, init_method, max_staleness):
+    """
+    Runs the parameter server of an asynchronous experiment in this process, until every worker has finished.
+    :param model: The few shot learning system whose meta-parameters are served.
+    :param num_workers: The number of worker processes.
+    :param init_method: The url the server and the workers rendezvous at, e.g. tcp://127.0.0.1:29501
+    :param max_staleness: See ParameterServer.
+    :return: The ParameterServer, holding the final meta-parameters.
+    """
+    global _parameter_server
+    _parameter_server = ParameterServer(model=model, max_staleness=max_staleness)
+
+    rpc.init_rpc(PARAMETER_SERVER_NAME, rank=0, world_size=num_workers + 1,
+                 rpc_backend_options=rpc.TensorPipeRpcBackendOptions(init_method=init_method))
+    # blocks until all the workers have shut down
+    rpc.shutdown()
+
+    print("parameter server applied {} updates and dropped {} stale updates".format(
+        _parameter_server.version, _parameter_server.num_dropped_updates))
+
+    return _parameter_server
+
+
+def init_parameter_server_worker(worker_idx, num_workers, init_method):
+    """
+    Connects this process to the parameter server as a worker.
+    :param worker_idx: The index of this worker, between 0 and num_workers - 1.
+    :param num_workers: The number of worker processes.
+    :param init_method: The url the server and the workers rendezvous at.
+    """
+    global _is_worker
+    rpc.init_rpc("worker_{}".format(worker_idx), rank=worker_idx + 1, world_size=num_workers + 1,
+                 rpc_backend_options=rpc.TensorPipeRpcBackendOptions(init_method=init_method))
+    _is_worker = True
+
+
+def shutdown_parameter_server_worker():
+    """
+    Waits for the other workers and disconnects from the parameter server, which stops once all workers are done.
+    """
+    global _is_worker
+    rpc.shutdown()
+    _is_worker = False
+
+
+def is_parameter_server_worker():
+    return _is_worker
+
+
+def pull_parameters():
+    """
+    Returns the current version and meta-parameters of the parameter server.
+    """
+    return rpc.rpc_sync(PARAMETER_SERVER_NAME, _pull_parameters)
+
+
+def push_gradients(gradients, version, epoch):
+    """
+    Sends meta-gradients to the parameter server and returns its current version and meta-parameters.
+    """
+    return rpc.rpc_sync(PARAMETER_SERVER_NAME, _push_gradients,
+                        args=({name: gradient.cpu() for name, gradient in gradients.items()}, version, epoch))
@@ -28,6 +28,110 @@ def get_args():
     parser.add_argument('--dropout_rate_value', type=float, default=0.3, help='Dropout_rate_value')
     parser.add_argument('--num_target_samples', type=int, default=15, help='Dropout_rate_value')
     parser.add_argument('--second_order', type=str, default="False", help='Dropout_rate_value')
+    parser.add_argument('--meta_gradient_type', type=str, default="maml",
+                        help='How the meta-gradient is computed through the inner loop, one of maml, '
+                             'first_order_maml, reptile or imaml')
+    parser.add_argument('--imaml_proximal_lambda', type=float, default=1.0,
+                        help='Strength of the proximal regularization of the inner loop in imaml mode')
+    parser.add_argument('--imaml_cg_steps', type=int, default=5,
+                        help='Number of conjugate gradient steps used to compute the implicit meta-gradient')
+    parser.add_argument('--inner_loop_checkpoint_interval', type=int, default=0,
+                        help='Number of support sets per recomputed segment of the second order inner loop, '
+                             'lower values reduce the peak memory at the cost of extra compute (0 disables it)')
+    parser.add_argument('--meta_backprop_horizon', type=int, default=-1,
+                        help='Number of final support set inner loop steps the meta-gradient is backpropagated '
+                             'through, earlier steps are treated as first order (-1 backpropagates through all steps)')
+    parser.add_argument('--critic_meta_backprop_horizon', type=int, default=-1,
+                        help='Number of final critic (target set) inner loop steps the meta-gradient is '
+                             'backpropagated through (-1 backpropagates through all steps)')
+    parser.add_argument('--use_bf16_autocast', type=str, default="False",
+                        help='Whether to run the classifier, embedding and critic forward passes in bfloat16 autocast')
+    parser.add_argument('--mixed_precision_guard_num_batches', type=int, default=10,
+                        help='Number of validation batches used to compare the bf16 accuracy against fp32')
+    parser.add_argument('--mixed_precision_accuracy_tolerance', type=float, default=0.01,
+                        help='Largest accepted accuracy drop of bf16 against fp32 before falling back to fp32')
+    parser.add_argument('--compile_inner_loop_classifier', type=str, default="False",
+                        help='Whether to run the inner loop classifier through its functional forward pass, '
+                             'compiled with torch.compile whenever no second order gradients are needed')
+    parser.add_argument('--graph_free_evaluation', type=str, default="False",
+                        help='Whether evaluation only builds the first order support set graphs needed by the inner '
+                             'loop and runs the target set passes in inference mode')
+    parser.add_argument('--metrics_sync_interval', type=int, default=1,
+                        help='Number of iterations between the batched device to host copies of the logged metrics')
+    parser.add_argument('--dense_net_memory_efficient', type=str, default="False",
+                        help='Whether the dense net embedding recomputes its concatenated bottleneck inputs in the '
+                             'backward pass instead of storing them, trading compute for activation memory')
+    parser.add_argument('--memory_format', type=str, default="contiguous_format",
+                        help='Memory format of the episode images, the backbone and the meta classifier convolutions, '
+                             'either contiguous_format (NCHW) or channels_last (NHWC)')
+    parser.add_argument('--fused_target_set_inference', type=str, default="False",
+                        help='Whether the graph free evaluation target set passes run the classifier with its batch '
+                             'norm folded into the conv weights, normalizing with the per step running statistics '
+                             'instead of the target set batch statistics')
+    parser.add_argument('--quantized_inference_num_batches', type=int, default=0,
+                        help='Number of test batches whose adapted classifiers are exported to int8 cpu inference '
+                             'modules and compared against their fp32 exports after training (0 disables the check)')
+    parser.add_argument('--quantized_inference_backend', type=str, default="fbgemm",
+                        help='Quantized engine of the int8 inference modules, fbgemm (x86) or qnnpack (arm)')
+    parser.add_argument('--embedding_stem_num_filters', type=int, default=64,
+                        help='Number of filters of the stem convolution of the dense net embedding')
+    parser.add_argument('--embedding_output_num_filters', type=int, default=0,
+                        help='Number of channels the dense net embedding is projected to with a 1x1 convolution, e.g. '
+                             'the embedding width of the teacher of a distilled backbone (0 disables the projection)')
+    parser.add_argument('--distillation_teacher_name_of_args_json_file', type=str, default="None",
+                        help='Experiment config of the trained teacher of distill_embedding_backbone.py, whose saved '
+                             'model is loaded from its experiment folder')
+    parser.add_argument('--distillation_teacher_model_idx', type=str, default="latest",
+                        help='Index (epoch or latest) of the saved teacher model')
+    parser.add_argument('--distillation_num_iters', type=int, default=5000,
+                        help='Number of episode batches the student backbone is distilled on')
+    parser.add_argument('--distillation_learning_rate', type=float, default=0.001,
+                        help='Learning rate of the student backbone during distillation')
+    parser.add_argument('--distillation_temperature', type=float, default=4.0,
+                        help='Softmax temperature of the distillation prediction loss')
+    parser.add_argument('--distillation_embedding_loss_weight', type=float, default=1.0,
+                        help='Weight of the embedding mean squared error relative to the prediction loss')
+    parser.add_argument('--num_task_threads', type=int, default=1,
+                        help='Number of worker threads the tasks of a meta batch run in, each with an equal share of '
+                             'the intra-op threads (1 runs the tasks one after another)')
+    parser.add_argument('--distributed_world_size', type=int, default=1,
+                        help='Number of processes of a distributed experiment, each training on a shard of every '
+                             'meta batch and all-reducing the meta-gradients (1 disables distributed training)')
+    parser.add_argument('--distributed_rank', type=int, default=0,
+                        help='Rank of this process in a distributed experiment, overridden by the RANK environment '
+                             'variable')
+    parser.add_argument('--distributed_backend', type=str, default="gloo",
+                        help='torch.distributed backend of distributed experiments')
+    parser.add_argument('--distributed_init_method', type=str, default="env://",
+                        help='Url the ranks of a distributed experiment rendezvous at, e.g. tcp://127.0.0.1:29500')
+    parser.add_argument('--parameter_server_num_workers', type=int, default=0,
+                        help='Number of worker processes of an asynchronous parameter server experiment, in which '
+                             'rank 0 runs the parameter server (0 disables the parameter server mode)')
+    parser.add_argument('--parameter_server_init_method', type=str, default="tcp://127.0.0.1:29501",
+                        help='Url the parameter server and its workers rendezvous at')
+    parser.add_argument('--parameter_server_max_staleness', type=int, default=4,
+                        help='Largest number of server updates between a worker pulling the meta-parameters and '
+                             'pushing its meta-gradients for which the meta-gradients are still applied')
+    parser.add_argument('--stream_task_backward', type=str, default="False",
+                        help='Backpropagate the outer loss of every task right after its inner loop and free its '
+                             'graph, so that the peak memory does not grow with the batch size')
+    parser.add_argument('--head_only_adaptation', type=str, default="False",
+                        help='Only adapt the linear head of the classifier in the inner loop (ANIL), computing the '
+                             'features of the rest of the classifier once per support set and target set')
+    parser.add_argument('--ridge_regression_head', type=str, default="False",
+                        help='Replace the inner loop gradient steps by a closed form ridge regression head, fitted '
+                             'on the classifier features and updated incrementally as each support set arrives')
+    parser.add_argument('--ridge_regression_init_lambda', type=float, default=1.0,
+                        help='Initial (meta-learned) regularization strength of the ridge regression head')
+    parser.add_argument('--low_rank_fast_weights_rank', type=int, default=0,
+                        help='Adapt every conv and linear weight of the classifier as the meta-learned weight plus a '
+                             'rank r update A B, with only A and B as inner loop parameters (0 adapts at full rank)')
+    parser.add_argument('--eval_early_exit_tolerance', type=float, default=0.0,
+                        help='At evaluation, stop the inner loop on a support set once its support loss changes by at '
+                             'most this relative tolerance over a step, or the support set is fit perfectly '
+                             '(0 always runs num_support_set_steps)')
+    parser.add_argument('--eval_early_exit_min_steps', type=int, default=1,
+                        help='Minimum number of inner loop steps per support set before an evaluation early exit')
 
     parser.add_argument('--total_epochs', type=int, default=200, help='Number of epochs per experiment')
     parser.add_argument('--total_iter_per_epoch', type=int, default=500, help='Number of iters per epoch')